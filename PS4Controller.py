@@ -2,12 +2,21 @@
 # Ruben Cardenes -- Mar 2020
 #
 # File:        PS4ControllerServer.py
+# Description: start() runs the controller on its own thread, which
+#              initializes pygame and the joystick (the event queue belongs to
+#              that thread), sleeps until a joystick event arrives and keeps
+#              the newest steering and throttle in a LatestValue, so read()
+#              never blocks or polls. Needs pygame 2 (event.wait with a
+#              timeout, JOYDEVICEREMOVED).
+#              If the controller is unplugged the car gets (0, 0).
 #
 # ###################################################################
 
 import pygame
 import pprint
 import sys
+from threading import Thread, Event
+from pipeline import LatestValue
 
 
 class PS4Controller(object):
@@ -19,16 +28,25 @@ class PS4Controller(object):
     hat_data = None
 
     def __init__(self, verbose=False):
-        """Initialize the joystick components"""
+        """Initialize the joystick components, pygame itself is initialized by the event thread"""
 
-        pygame.init()
-        pygame.joystick.init()
-        self.controller = pygame.joystick.Joystick(0)
-        self.controller.init()
         self.event_dict = {}
         self.axis_data = {i: 0 for i in range(7)}
         self.verbose = verbose
         self.steering, self.throttle = 0, 0
+        self.state = LatestValue((0.0, 0.0))
+        self.thread = None
+        self.running = False
+        self.ready = Event()
+        self.error = None
+        self.events = 0
+
+    def init_joystick(self):
+        """pygame events are tied to the thread that initialized it, this is the event thread"""
+        pygame.init()
+        pygame.joystick.init()
+        self.controller = pygame.joystick.Joystick(0)
+        self.controller.init()
         if not self.axis_data:
             self.axis_data = {}
 
@@ -51,47 +69,82 @@ class PS4Controller(object):
             throttle = -1*event_dict['axis'][1]
         return steering, throttle
 
-    def generate_event(self):
-        """Listen for events to happen and send commands"""
-        print("Generating event")
-        hadEvent = False
-
-        while True:
-
-            for event in pygame.event.get():
+    def start(self):
+        '''
+        Start the event thread, read() returns the newest state from then on.
+        Waits until the thread has opened the joystick and raises its error,
+        e.g. when no controller is connected
+        '''
+        if self.thread is None:
+            self.running = True
+            self.ready.clear()
+            self.error = None
+            self.thread = Thread(target=self.event_loop, daemon=True)
+            self.thread.start()
+            self.ready.wait()
+            if self.error is not None:
+                self.thread.join()
+                self.thread = None
+                self.running = False
+                raise self.error
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def read(self):
+        '''Newest (steering, throttle), never blocks'''
+        return self.state.get()[0]
+
+    def event_loop(self, timeout_ms=100):
+        try:
+            self.init_joystick()
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+        # only the joystick events wake the thread up
+        pygame.event.set_allowed(None)
+        pygame.event.set_allowed([pygame.JOYAXISMOTION, pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP,
+                                  pygame.JOYHATMOTION, pygame.JOYDEVICEREMOVED])
+        while self.running:
+            # sleeps until an event arrives, the timeout only checks for stop()
+            event = pygame.event.wait(timeout_ms)
+            if event.type == pygame.NOEVENT:
+                continue
+            # handle everything queued meanwhile, the state is published once
+            changed = False
+            for event in [event] + pygame.event.get():
+                self.events += 1
                 if event.type == pygame.JOYAXISMOTION:
                     self.axis_data[event.axis] = round(event.value, 2)
+                    changed = True
                 elif event.type == pygame.JOYBUTTONDOWN:
                     self.button_data[event.button] = True
+                    changed = True
                 elif event.type == pygame.JOYBUTTONUP:
                     self.button_data[event.button] = False
                 elif event.type == pygame.JOYHATMOTION:
                     self.hat_data[event.hat] = event.value
+                elif event.type == pygame.JOYDEVICEREMOVED:
+                    print("PS4 controller disconnected, stopping the car")
+                    self.axis_data = {i: 0.0 for i in self.axis_data}
+                    changed = True
+            if changed:
+                self.event_dict['axis'] = self.axis_data
+                self.event_dict['button'] = self.button_data
+                if self.verbose:
+                    print("Axis ")
+                    pprint.pprint(self.axis_data)
+                self.steering, self.throttle = self.convert_dict_into_steer_throttle(self.event_dict)
+                self.state.set((self.steering, self.throttle))
 
-                if event.type == pygame.JOYBUTTONDOWN:
-                    # A button on the joystick just got pushed down
-                    hadEvent = True
-                elif event.type == pygame.JOYAXISMOTION:
-                    # A joystick has been moved
-                    hadEvent = True
-
-                if hadEvent:
-                    self.event_dict['axis'] = self.axis_data
-                    self.event_dict['button'] = self.button_data
-
-                    # if self.button_data[4]:
-                    #    self.verbose = not self.verbose
-
-                    if self.verbose:
-                        # print("Button ")
-                        # pprint.pprint(self.button_data)
-                        print("Axis ")
-                        pprint.pprint(self.axis_data)
-                        # print("Motion ")
-                        # pprint.pprint(self.hat_data)
-
-                    self.steering, self.throttle = self.convert_dict_into_steer_throttle(self.event_dict)
-
-            print("Generating ", self.steering, self.throttle)
-            yield [self.steering, self.throttle]
-
+    def generate_event(self):
+        """Generator of the newest [steering, throttle], runs the event thread"""
+        self.start()
+        while True:
+            yield list(self.read())
@@ -0,0 +1,118 @@
+# ###################################################################
+#
+# File:        adaptive_stream.py
+# Description: Adapts the frame rate and the JPEG quality of the car camera
+#              to what the server and the network can take, from the
+#              feedback packets of the server (see control_protocol.py) and
+#              the command round trip measured on the car:
+#                  server busy or dropping frames -> lower the frame rate
+#                  server receives less than is sent -> lower the quality,
+#                                                       then the frame rate
+#                  latency over the target -> lower the quality, then the frame rate
+#                  headroom everywhere -> raise the frame rate, then the quality
+#              Decreases are multiplicative and increases additive, and after
+#              a change the settings hold for a while so the next feedback
+#              already measures them. Every change is printed with its reason.
+# ###################################################################
+
+import time
+
+
+class AdaptiveStreamController(object):
+    '''
+    Changes settings.fps and settings.quality (a car_hardware.StreamSettings)
+    within the given limits to keep the command round trip under latency_target
+    seconds. The sender calls frame_sent(), the command receiver command_received()
+    and update() with every feedback packet
+    '''
+
+    def __init__(self, settings, min_fps=5, max_fps=30, min_quality=30, max_quality=90,
+                 latency_target=0.1, hold=2.0, quality_step=10):
+        self.settings = settings
+        self.min_fps = min_fps
+        self.max_fps = max_fps
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.latency_target = latency_target
+        self.hold = hold
+        self.quality_step = quality_step
+        settings.fps = max(min_fps, min(max_fps, settings.fps))
+        settings.quality = max(min_quality, min(max_quality, settings.quality))
+        # exponential average of the command round trip
+        self.latency = None
+        self.frames_sent = 0
+        self.last_frames_sent = 0
+        self.last_feedback_at = None
+        self.changed_at = 0.0
+        self.changes = []
+
+    def frame_sent(self):
+        self.frames_sent += 1
+
+    def command_received(self, rtt, alpha=0.2):
+        if self.latency is None:
+            self.latency = rtt
+        else:
+            self.latency += alpha * (rtt - self.latency)
+
+    def update(self, feedback, now=None):
+        '''
+        Returns the reason of the change if the settings were changed, else None
+        '''
+        if now is None:
+            now = time.time()
+        if self.last_feedback_at is None:
+            self.last_feedback_at = now
+            self.last_frames_sent = self.frames_sent
+            return None
+        elapsed = now - self.last_feedback_at
+        if elapsed <= 0:
+            return None
+        send_fps = (self.frames_sent - self.last_frames_sent) / elapsed
+        self.last_feedback_at = now
+        self.last_frames_sent = self.frames_sent
+        if now - self.changed_at < self.hold:
+            return None
+
+        # the server stages run in parallel, the slowest one sets how many frames it can take
+        stage_ms = max(feedback.decode_ms, feedback.infer_ms)
+        busy = stage_ms / 1000.0 * feedback.receive_fps
+        capacity = 1000.0 / stage_ms if stage_ms > 0 else float(self.max_fps)
+        fps, quality = self.settings.fps, self.settings.quality
+        latency = self.latency
+
+        if feedback.drop_rate > 0.1 or busy > 0.9:
+            fps = min(fps * 0.8, capacity * 0.8)
+            reason = f"server busy {busy:.0%} and dropping {feedback.drop_rate:.0%} of the frames"
+        elif send_fps > 0 and feedback.receive_fps < 0.8 * send_fps:
+            fps, quality = self._reduce(fps, quality)
+            reason = f"server receives {feedback.receive_fps:.1f} of the {send_fps:.1f} fps sent"
+        elif latency is not None and latency > self.latency_target:
+            fps, quality = self._reduce(fps, quality)
+            reason = f"latency {latency * 1000:.0f} ms over the {self.latency_target * 1000:.0f} ms target"
+        elif (latency is None or latency < 0.7 * self.latency_target) and busy < 0.6 and feedback.drop_rate == 0:
+            if fps < self.max_fps:
+                fps += 1
+            else:
+                quality += self.quality_step // 2
+            latency_ms = f"{latency * 1000:.0f} ms" if latency is not None else "unknown"
+            reason = f"headroom: server busy {busy:.0%}, latency {latency_ms}"
+        else:
+            return None
+
+        fps = int(round(max(self.min_fps, min(self.max_fps, fps))))
+        quality = int(max(self.min_quality, min(self.max_quality, quality)))
+        if (fps, quality) == (self.settings.fps, self.settings.quality):
+            return None
+        self.settings.fps = fps
+        self.settings.quality = quality
+        self.changed_at = now
+        self.changes.append((now, fps, quality, reason))
+        print(f"Stream set to {fps} fps, JPEG quality {quality}: {reason}")
+        return reason
+
+    def _reduce(self, fps, quality):
+        '''Smaller frames first, they keep the frame rate the pilot sees'''
+        if quality > self.min_quality:
+            return fps, quality - self.quality_step
+        return fps * 0.8, quality
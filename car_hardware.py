@@ -0,0 +1,378 @@
+# ###################################################################
+#
+# File:        car_hardware.py
+# Description: Hardware of the car behind swappable backends, so that
+#              run_client.py also runs on a PC without a Raspberry PI:
+#                  cameras: PiCameraSource (RPi camera) or SimulatedCamera,
+#                           which plays back a video file or a folder of
+#                           images at the camera frame rate
+#                  motors:  L298N_HBridge_DC_Motor (GPIO pins of the PI) or
+#                           SimulatedMotor, which records the duty cycle it
+#                           would set, with a timestamp
+#              Motors look the duty cycle of a speed up in a table computed
+#              once, and only write the PWM duty and the direction pins that
+#              change, the writes are counted in gpio_writes.
+#              Cameras give raw BGR frames (frames()) or write JPEGs into the
+#              streams taken from an iterator (capture_jpeg(outputs)), as in
+#              picamera capture_sequence: a stream holds a complete JPEG when
+#              the next one is requested, or as soon as it is passed to the
+#              finished callback, so the caller can reuse a small pool of
+#              buffers.
+#              The frame rate and JPEG quality of capture_jpeg() are read from
+#              camera.settings on every frame, so they can be changed while
+#              the camera runs (see adaptive_stream.py).
+#              create_camera() and create_motors() pick the backends.
+#
+# Note: the class L298N_HBridge_DC_Motor has been taken from the donkey-car project
+#       and slightly modified
+# ###################################################################
+
+import io
+import os
+import csv
+import time
+import numpy as np
+from collections import deque
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+DUTY_STEPS = 1000
+CAMERA_RESOLUTION = (160, 120)
+CAMERA_FRAMERATE = 10
+CAMERA_QUALITY = 85
+
+
+def map_range(x, X_min, X_max, Y_min, Y_max):
+    '''
+    Linear mapping between two ranges of values
+    '''
+    X_range = X_max - X_min
+    Y_range = Y_max - Y_min
+    XY_ratio = X_range/Y_range
+
+    y = ((x-X_min) / XY_ratio + Y_min) // 1
+
+    return int(y)
+
+
+def duty_cycle(speed, max_duty, min_value=0):
+    '''
+    Signed duty cycle for a speed between -1 and 1, positive is forward
+    '''
+    if speed > 1 or speed < -1:
+        raise ValueError("Speed must be between 1(forward) and -1(reverse)")
+    throttle = int(map_range(speed, -1, 1, -max_duty, max_duty))
+    if throttle < min_value and min_value > 0:
+        throttle = throttle + 10
+    return throttle
+
+
+def duty_table(max_duty, min_value=0, steps=DUTY_STEPS):
+    '''
+    duty_cycle() of steps + 1 speeds evenly spaced from -1 to 1
+    '''
+    return [duty_cycle(-1.0 + 2.0 * i / steps, max_duty, min_value) for i in range(steps + 1)]
+
+
+class StreamSettings(object):
+    '''
+    Frame rate and JPEG quality of a camera, they can change while it runs
+    '''
+
+    def __init__(self, fps=CAMERA_FRAMERATE, quality=CAMERA_QUALITY):
+        self.fps = fps
+        self.quality = quality
+
+
+class PiCameraSource(object):
+    '''
+    Frames of the RPi camera video port. Raw frames are captured straight into
+    a numpy array that is reused for every frame: copy a frame to keep it.
+    The camera runs at max_framerate, JPEGs are delivered at settings.fps
+    '''
+
+    def __init__(self, resolution=CAMERA_RESOLUTION, framerate=CAMERA_FRAMERATE, max_framerate=None,
+                 quality=CAMERA_QUALITY):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.max_framerate = max(framerate, max_framerate or framerate)
+        self.settings = StreamSettings(framerate, quality)
+
+    def _open(self, framerate=None):
+        import picamera
+        camera = picamera.PiCamera()
+        camera.resolution = self.resolution
+        camera.framerate = framerate or self.framerate
+        time.sleep(2)  # give 2 secs for camera to initilize
+        return camera
+
+    def frames(self):
+        width, height = self.resolution
+        # the camera pads the width to a multiple of 32 and the height to a multiple of 16
+        buffer = np.empty(((height + 15) // 16 * 16, (width + 31) // 32 * 32, 3), dtype=np.uint8)
+        with self._open() as camera:
+            for foo in camera.capture_continuous(buffer, 'bgr', use_video_port=True):
+                yield buffer[:height, :width]
+
+    def capture_jpeg(self, outputs, finished=None):
+        '''
+        The camera can't change its frame rate while capturing, so it runs at
+        max_framerate and the frames in between are encoded into a scratch
+        buffer and dropped. The quality is fixed for a capture_sequence, a
+        new one starts when it changes. finished(stream) is called as soon as
+        a stream of outputs holds its JPEG, without waiting for the next one
+        '''
+        scratch = io.BytesIO()
+        with self._open(self.max_framerate) as camera:
+            while True:
+                quality = self.settings.quality
+                camera.capture_sequence(self._paced(outputs, quality, scratch, finished), 'jpeg',
+                                        use_video_port=True, quality=quality)
+                if self.settings.quality == quality:
+                    # outputs is exhausted
+                    break
+
+    def _paced(self, outputs, quality, scratch, finished=None):
+        '''Streams of outputs at settings.fps at most, until the quality changes'''
+        tolerance = 0.5 / self.max_framerate
+        next_frame = 0.0
+        stream = None
+        while True:
+            # the camera asks for a buffer once the previous JPEG is complete,
+            # hand it over now and not at the next paced frame
+            if stream is not None and finished is not None:
+                finished(stream)
+            stream = None
+            if self.settings.quality != quality:
+                return
+            now = time.time()
+            if now < next_frame - tolerance:
+                scratch.seek(0)
+                yield scratch
+                continue
+            period = 1.0 / self.settings.fps
+            # on time the frames keep to the schedule, when late it starts again from now
+            next_frame = next_frame + period if now - next_frame < period else now + period
+            stream = next(outputs, None)
+            if stream is None:
+                return
+            yield stream
+
+    def close(self):
+        pass
+
+
+class SimulatedCamera(object):
+    '''
+    Plays back a video file or a folder of images (in name order) as if they
+    came from the camera, at framerate frames per second, resized to resolution.
+    With loop the playback starts again at the end
+    '''
+
+    def __init__(self, path, resolution=CAMERA_RESOLUTION, framerate=CAMERA_FRAMERATE, loop=True,
+                 quality=CAMERA_QUALITY):
+        self.path = path
+        self.resolution = resolution
+        self.framerate = framerate
+        self.loop = loop
+        self.settings = StreamSettings(framerate, quality)
+        self.frames_read = 0
+
+    def _read(self):
+        import cv2
+        if os.path.isdir(self.path):
+            names = sorted(n for n in os.listdir(self.path) if n.lower().endswith(IMAGE_EXTENSIONS))
+            for name in names:
+                image = cv2.imread(os.path.join(self.path, name))
+                if image is not None:
+                    yield image
+            return
+        cap = cv2.VideoCapture(self.path)
+        try:
+            while True:
+                ret, image = cap.read()
+                if not ret:
+                    break
+                yield image
+        finally:
+            cap.release()
+
+    def frames(self):
+        import cv2
+        next_frame = time.time()
+        while True:
+            empty = True
+            for image in self._read():
+                empty = False
+                if image.shape[1::-1] != tuple(self.resolution):
+                    image = cv2.resize(image, tuple(self.resolution), interpolation=cv2.INTER_AREA)
+                if self.settings.fps > 0:
+                    next_frame += 1.0 / self.settings.fps
+                    time.sleep(max(0.0, next_frame - time.time()))
+                self.frames_read += 1
+                yield image
+            if empty:
+                raise IOError(f"No frames could be read from {self.path}")
+            if not self.loop:
+                break
+
+    def capture_jpeg(self, outputs, finished=None):
+        '''Encoded like the camera would, the encoding time is part of the frame period'''
+        import cv2
+        stream = next(outputs, None)
+        for image in self.frames():
+            if stream is None:
+                break
+            stream.write(cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.settings.quality])[1])
+            if finished is not None:
+                finished(stream)
+            stream = next(outputs, None)
+
+    def close(self):
+        pass
+
+
+class DutyCycleMotor(object):
+    '''
+    Common part of the motors. run(speed) takes the duty cycle from the table
+    of the nearest of DUTY_STEPS + 1 speeds and calls write_duty() and
+    write_pin() (pin 0 forward, 1 backward) only for the outputs that change
+    '''
+
+    def __init__(self, max_duty=90, min_value=0):
+        self.max_duty = max_duty
+        self.min_value = min_value
+        self.duties = duty_table(max_duty, min_value)
+        self.half_steps = (len(self.duties) - 1) / 2.0
+        self.speed = 0.0
+        self.throttle = 0
+        self.duty = 0
+        self.levels = [False, False]
+        self.updates = 0
+        self.gpio_writes = 0
+
+    def run(self, speed):
+        '''
+        Update the speed of the motor where 1 is full forward and
+        -1 is full backwards.
+        '''
+        if speed > 1 or speed < -1:
+            raise ValueError("Speed must be between 1(forward) and -1(reverse)")
+        self.speed = speed
+        self.updates += 1
+        self.throttle = self.duties[int((speed + 1.0) * self.half_steps + 0.5)]
+        writes = self.gpio_writes
+        duty = abs(self.throttle)
+        if duty != self.duty:
+            self.write_duty(duty)
+            self.duty = duty
+            self.gpio_writes += 1
+        for pin, level in enumerate((self.throttle > 0, self.throttle < 0)):
+            if level != self.levels[pin]:
+                self.write_pin(pin, level)
+                self.levels[pin] = level
+                self.gpio_writes += 1
+        return self.gpio_writes != writes
+
+    def write_duty(self, duty):
+        pass
+
+    def write_pin(self, pin, level):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class L298N_HBridge_DC_Motor(DutyCycleMotor):
+    '''
+    Motor controlled with an L298N hbridge from the gpio pins on Rpi
+    '''
+
+    def __init__(self, pin_forward, pin_backward, pwm_pin, freq=50, max_duty=90, min_value=0):
+        import RPi.GPIO as GPIO
+        DutyCycleMotor.__init__(self, max_duty, min_value)
+        self.GPIO = GPIO
+        self.pin_forward = pin_forward
+        self.pin_backward = pin_backward
+        self.pwm_pin = pwm_pin
+
+        GPIO.setmode(GPIO.BOARD)
+        GPIO.setup(self.pin_forward, GPIO.OUT, initial=GPIO.LOW)
+        GPIO.setup(self.pin_backward, GPIO.OUT, initial=GPIO.LOW)
+        GPIO.setup(self.pwm_pin, GPIO.OUT)
+        self.pins = (self.pin_forward, self.pin_backward)
+
+        self.pwm = GPIO.PWM(self.pwm_pin, freq)
+        self.pwm.start(0)
+
+    def write_duty(self, duty):
+        self.pwm.ChangeDutyCycle(duty)
+
+    def write_pin(self, pin, level):
+        self.GPIO.output(self.pins[pin], self.GPIO.HIGH if level else self.GPIO.LOW)
+
+    def shutdown(self):
+        self.pwm.stop()
+        self.GPIO.cleanup()
+
+
+class SimulatedMotor(DutyCycleMotor):
+    '''
+    Same interface as L298N_HBridge_DC_Motor. Instead of setting the pins it
+    records (time, speed, duty cycle) of the last max_commands commands that
+    change an output
+    '''
+
+    def __init__(self, name, max_duty=90, min_value=0, max_commands=100000):
+        DutyCycleMotor.__init__(self, max_duty, min_value)
+        self.name = name
+        self.commands = deque(maxlen=max_commands)
+
+    def run(self, speed):
+        written = DutyCycleMotor.run(self, speed)
+        if written:
+            self.commands.append((time.time(), speed, self.throttle))
+        return written
+
+
+def create_camera(source='pi', resolution=CAMERA_RESOLUTION, framerate=CAMERA_FRAMERATE, max_framerate=None):
+    '''
+    'pi' for the RPi camera, otherwise the video file or image folder to play back.
+    max_framerate is the highest frame rate settings.fps can be raised to later
+    '''
+    if source == 'pi':
+        return PiCameraSource(resolution, framerate, max_framerate)
+    return SimulatedCamera(source, resolution, framerate)
+
+
+def create_motors(backend='l298n'):
+    '''
+    Steering and throttle motors of the car: 'l298n' or 'sim'
+    '''
+    if backend == 'sim':
+        return (SimulatedMotor('steering', max_duty=80),
+                SimulatedMotor('throttle', max_duty=60, min_value=30))
+
+    HBRIDGE_PIN_LEFT  = 16
+    HBRIDGE_PIN_RIGHT = 18
+
+    HBRIDGE_PIN_FWD   = 11
+    HBRIDGE_PIN_BWD   = 13
+
+    HBRIDGE_EN_PW_LR  = 33
+    HBRIDGE_EN_PW_FB  = 32
+
+    print("Init of steering")
+    steering = L298N_HBridge_DC_Motor(HBRIDGE_PIN_LEFT, HBRIDGE_PIN_RIGHT, HBRIDGE_EN_PW_LR, max_duty=80)
+    print("Init of throttle")
+    throttle = L298N_HBridge_DC_Motor(HBRIDGE_PIN_FWD, HBRIDGE_PIN_BWD, HBRIDGE_EN_PW_FB, max_duty=60, min_value=30)
+    return steering, throttle
+
+
+def save_motor_log(path, motors):
+    '''Write the commands recorded by SimulatedMotors as CSV: time, motor, speed, duty'''
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time', 'motor', 'speed', 'duty'])
+        rows = [(t, motor.name, speed, duty) for motor in motors for t, speed, duty in motor.commands]
+        writer.writerows(sorted(rows))
@@ -0,0 +1,128 @@
+# ###################################################################
+#
+# File:        control_protocol.py
+# Description: Binary protocol for the commands sent from the server to the
+#              car. Every command is a fixed size little endian packet:
+#                  magic       uint16  0xCA5E, used to resync after corrupt data
+#                  type        uint16  packet type (1: steering/throttle command)
+#                  seq         uint32  sequence number of the command
+#                  frame_id    uint32  number of the video frame it was computed from
+#                  timestamp   float64 server time.time() when it was sent
+#                  received_at float64 server time.time() when the frame was received
+#                  steering    float32
+#                  throttle    float32
+#              Frames are numbered from 1 in the order they are sent, which is
+#              also the order in which the server receives them over TCP, so
+#              both ends agree on frame ids without sending them.
+#              Feedback packets (type 2) report how well the server keeps up,
+#              for the client to adapt its frame rate and JPEG quality:
+#                  magic, type, seq, frame_id (newest frame received), timestamp
+#                  receive_fps float32 frames received per second
+#                  decode_ms   float32 mean JPEG decode time
+#                  infer_ms    float32 mean model (or controller) time
+#                  drop_rate   float32 fraction of the received frames that got no command
+# ###################################################################
+
+import struct
+import time
+from collections import namedtuple
+
+PACKET = struct.Struct('<HHIIddff')
+FEEDBACK_PACKET = struct.Struct('<HHIIdffff')
+MAGIC = 0xCA5E
+MAGIC_BYTES = struct.pack('<H', MAGIC)
+TYPE_CONTROL = 1
+TYPE_FEEDBACK = 2
+TYPE = struct.Struct('<H')
+
+ControlPacket = namedtuple('ControlPacket', ['type', 'seq', 'frame_id', 'timestamp', 'received_at',
+                                             'steering', 'throttle'])
+FeedbackPacket = namedtuple('FeedbackPacket', ['type', 'seq', 'frame_id', 'timestamp', 'receive_fps',
+                                               'decode_ms', 'infer_ms', 'drop_rate'])
+# packet layout of every type
+PACKETS = {TYPE_CONTROL: (PACKET, ControlPacket), TYPE_FEEDBACK: (FEEDBACK_PACKET, FeedbackPacket)}
+
+
+class ControlPacketEncoder(object):
+    """Builds command packets with increasing sequence numbers"""
+
+    def __init__(self):
+        self.seq = 0
+
+    def pack(self, frame_id, steering, throttle, timestamp=None, received_at=0.0):
+        self.seq += 1
+        if timestamp is None:
+            timestamp = time.time()
+        return PACKET.pack(MAGIC, TYPE_CONTROL, self.seq, frame_id, timestamp, received_at,
+                           steering, throttle)
+
+    def pack_feedback(self, frame_id, receive_fps, decode_ms, infer_ms, drop_rate, timestamp=None):
+        self.seq += 1
+        if timestamp is None:
+            timestamp = time.time()
+        return FEEDBACK_PACKET.pack(MAGIC, TYPE_FEEDBACK, self.seq, frame_id, timestamp, receive_fps,
+                                    decode_ms, infer_ms, drop_rate)
+
+
+class ControlPacketDecoder(object):
+    """Splits a byte stream into packets, whatever way TCP merged or split them
+
+    newest() keeps track of the last accepted packet, so commands that are
+    older than one already applied are dropped.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.last_seq = 0
+        self.last_frame_id = 0
+        self.packets = 0
+        self.stale = 0
+        self.resyncs = 0
+
+    def feed(self, data):
+        """Add received bytes and return the list of complete packets"""
+        self.buffer += data
+        packets = []
+        start = 0
+        while len(self.buffer) - start >= 4:
+            layout = None
+            if self.buffer[start:start + 2] == MAGIC_BYTES:
+                layout = PACKETS.get(TYPE.unpack_from(self.buffer, start + 2)[0])
+            if layout is None:
+                self.resyncs += 1
+                start = self.buffer.find(MAGIC_BYTES, start + 1)
+                if start == -1:
+                    # keep the last byte, it can be the first half of a magic
+                    start = len(self.buffer) - 1
+                continue
+            packet, packet_type = layout
+            if len(self.buffer) - start < packet.size:
+                break
+            packets.append(packet_type(*packet.unpack_from(self.buffer, start)[1:]))
+            start += packet.size
+        del self.buffer[:start]
+        self.packets += len(packets)
+        return packets
+
+    def recv(self, connection, size=4096):
+        """Receive once from a socket. Returns None when the connection is closed"""
+        data = connection.recv(size)
+        if not data:
+            return None
+        return self.feed(data)
+
+    def newest(self, packets):
+        """Return the newest command among packets, None if all of them are stale"""
+        newest = None
+        for packet in packets:
+            if packet.type != TYPE_CONTROL:
+                continue
+            if packet.seq <= self.last_seq or packet.frame_id < self.last_frame_id:
+                self.stale += 1
+                continue
+            if newest is not None:
+                self.stale += 1
+            newest = packet
+            self.last_seq = packet.seq
+            self.last_frame_id = packet.frame_id
+        return newest
@@ -0,0 +1,103 @@
+# ###################################################################
+#
+# File:        display.py
+# Description: Video window running in its own thread. Stages that produce
+#              frames only drop the newest frame in a slot per window, they
+#              never wait for the GUI, so cv2.imshow/waitKey can't slow down
+#              the video socket or the autopilot. The window can be shown at
+#              full rate or limited to a number of frames per second.
+#              Pressing 'q' in a window calls on_quit.
+#              A frame handed over with a release callback (e.g. of a pooled
+#              frame, see frame_pool.py) is released once it has been shown or
+#              replaced by a newer one.
+# ###################################################################
+
+import time
+from threading import Thread, Condition
+from argparse import ArgumentTypeError
+
+DISPLAY_CHOICES = "off, full or a number of frames per second"
+
+
+def parse_display(value):
+    '''
+    argparse type of the --display option: 'off' gives None, 'full' gives 0
+    (no limit) and a number gives that many frames per second
+    '''
+    if value == 'off':
+        return None
+    if value == 'full':
+        return 0.0
+    try:
+        fps = float(value)
+    except ValueError:
+        raise ArgumentTypeError(f"must be {DISPLAY_CHOICES}, not {value}")
+    if fps <= 0:
+        raise ArgumentTypeError(f"must be {DISPLAY_CHOICES}, not {value}")
+    return fps
+
+
+class DisplayThread(Thread):
+    """Shows the newest frame of each window, at most fps times per second (0: no limit)"""
+
+    def __init__(self, fps=0.0, on_quit=None):
+        Thread.__init__(self, daemon=True)
+        self.period = 1.0 / fps if fps else 0.0
+        self.on_quit = on_quit
+        self.cond = Condition()
+        self.latest = {}
+        self.running = True
+        self.frames_shown = 0
+        self.frames_skipped = 0
+
+    def show(self, name, image, release=None):
+        """Hand over a frame to the display, never blocks"""
+        with self.cond:
+            replaced = self.latest.get(name)
+            if replaced is not None:
+                self.frames_skipped += 1
+            self.latest[name] = (image, release)
+            self.cond.notify()
+        if replaced is not None and replaced[1] is not None:
+            replaced[1]()
+
+    def stats(self):
+        return {'frames_shown': self.frames_shown, 'frames_skipped': self.frames_skipped,
+                'windows': len(self.latest)}
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def run(self):
+        import cv2
+        windows = set()
+        next_show = 0.0
+        while self.running:
+            with self.cond:
+                # wake up regularly anyway, waitKey keeps the windows responsive
+                self.cond.wait_for(lambda: not self.running or any(v is not None for v in self.latest.values()),
+                                   0.05)
+                frames = []
+                if time.time() >= next_show:
+                    frames = [(name, frame) for name, frame in self.latest.items() if frame is not None]
+                    for name in self.latest:
+                        self.latest[name] = None
+            for name, (image, release) in frames:
+                if name not in windows:
+                    cv2.namedWindow(name, cv2.WINDOW_KEEPRATIO)
+                    windows.add(name)
+                cv2.imshow(name, image)
+                if release is not None:
+                    release()
+                self.frames_shown += 1
+            if frames and self.period:
+                next_show = time.time() + self.period
+            if windows and cv2.waitKey(1) & 0xFF == ord('q'):
+                if self.on_quit is not None:
+                    self.on_quit()
+                break
+            if not frames and next_show > time.time():
+                time.sleep(min(0.01, next_show - time.time()))
+        cv2.destroyAllWindows()
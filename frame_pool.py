@@ -0,0 +1,153 @@
+# ###################################################################
+#
+# File:        frame_pool.py
+# Description: Pool of reusable image arrays (acquire()) and reference
+#              counted frames, which tell how much memory frames hold.
+#              Each PooledFrame counts the stages that still use it (display,
+#              model or controller, recorder): every stage that takes the
+#              frame calls retain() and release() when done, and the array
+#              goes back to the pool when the last one releases it.
+#              FramePool.decode() reads the JPEG bytes through np.frombuffer,
+#              no copy. The Python binding of cv2.imdecode has no dst
+#              argument, it allocates a new array for every frame: decode()
+#              saves no allocation. It only counts the decoded array like a
+#              pooled one while it is in use, and lets it be freed when
+#              released, since no other frame could be decoded into it.
+#              stats() reports the arrays allocated, the bytes in use at the
+#              peak and held by the pool, and the RSS of the process.
+# ###################################################################
+
+import resource
+import numpy as np
+from threading import Lock
+
+PAGE_SIZE = resource.getpagesize()
+
+
+def process_memory():
+    '''(current RSS, peak RSS) of this process in bytes'''
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        rss = 0
+    # ru_maxrss is in kilobytes on Linux
+    return rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PooledFrame(object):
+    '''
+    An array of a FramePool and the number of users holding it. The array must
+    not be used after the last release()
+    '''
+
+    __slots__ = ('array', 'pool', 'refs', 'lock', 'keep')
+
+    def __init__(self, array, pool=None, keep=True):
+        self.array = array
+        self.pool = pool
+        self.refs = 1
+        self.lock = Lock()
+        self.keep = keep
+
+    def retain(self):
+        with self.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            last = self.refs == 0
+        if last and self.pool is not None:
+            self.pool.give_back(self.array, self.keep)
+
+
+class FramePool(object):
+    '''
+    Arrays by shape. Up to max_free released arrays of each shape are kept for
+    the next frames, more are left to be freed. wrap() makes a PooledFrame of
+    an array that does not belong to the pool, e.g. a raw frame from shm_video.py
+    '''
+
+    def __init__(self, max_free=8):
+        self.max_free = max_free
+        self.lock = Lock()
+        self.free = {}
+        self.acquired = 0
+        self.allocated = 0
+        self.pool_bytes = 0
+        self.in_use_bytes = 0
+        self.peak_in_use_bytes = 0
+
+    def acquire(self, shape, dtype=np.uint8):
+        key = (tuple(shape), np.dtype(dtype))
+        with self.lock:
+            free = self.free.get(key)
+            if free:
+                array = free.pop()
+            else:
+                array = np.empty(key[0], dtype=key[1])
+                self.allocated += 1
+                self.pool_bytes += array.nbytes
+            self.acquired += 1
+            self.in_use_bytes += array.nbytes
+            self.peak_in_use_bytes = max(self.peak_in_use_bytes, self.in_use_bytes)
+        return PooledFrame(array, self)
+
+    def give_back(self, array, keep=True):
+        key = (array.shape, array.dtype)
+        with self.lock:
+            self.in_use_bytes -= array.nbytes
+            free = self.free.setdefault(key, [])
+            if keep and len(free) < self.max_free:
+                free.append(array)
+            else:
+                self.pool_bytes -= array.nbytes
+
+    def adopt(self, array, keep=True):
+        '''
+        A PooledFrame of an array allocated elsewhere, it joins the pool when
+        released, or is left to be freed without keep
+        '''
+        with self.lock:
+            self.acquired += 1
+            self.allocated += 1
+            self.pool_bytes += array.nbytes
+            self.in_use_bytes += array.nbytes
+            self.peak_in_use_bytes = max(self.peak_in_use_bytes, self.in_use_bytes)
+        return PooledFrame(array, self, keep)
+
+    def wrap(self, array):
+        return PooledFrame(array)
+
+    def decode(self, jpg, flags=None):
+        '''
+        Decode JPEG bytes (any buffer) into a PooledFrame of the new array of
+        imdecode, not kept by the pool. Returns None if jpg can't be decoded
+        '''
+        import cv2
+        flags = cv2.IMREAD_COLOR if flags is None else flags
+        image = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), flags)
+        if image is None:
+            return None
+        return self.adopt(image, keep=False)
+
+    def stats(self):
+        rss, peak_rss = process_memory()
+        with self.lock:
+            free = sum(len(arrays) for arrays in self.free.values())
+            return {'acquired': self.acquired,
+                    'allocated': self.allocated,
+                    'free': free,
+                    'pool_mb': self.pool_bytes / 1e6,
+                    'in_use_mb': self.in_use_bytes / 1e6,
+                    'peak_in_use_mb': self.peak_in_use_bytes / 1e6,
+                    'rss_mb': rss / 1e6,
+                    'peak_rss_mb': peak_rss / 1e6}
+
+    def summary(self):
+        s = self.stats()
+        return (f"frames: {s['allocated']} arrays for {s['acquired']} frames, pool {s['pool_mb']:.2f} MB "
+                f"(peak in use {s['peak_in_use_mb']:.2f} MB), RSS {s['rss_mb']:.1f} MB "
+                f"(peak {s['peak_rss_mb']:.1f} MB)")
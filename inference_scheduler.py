@@ -0,0 +1,113 @@
+# ###################################################################
+#
+# File:        inference_scheduler.py
+# Description: Batches the frames of all the connected cars into a single
+#              model forward pass. Most of the cost of a batch-of-1
+#              model.predict is fixed overhead, so with several cars one
+#              forward pass for all of them is much cheaper than one per car.
+#              A batch is run as soon as it is full or when the deadline
+#              (in microseconds, counted from the first frame of the batch)
+#              expires, whichever comes first.
+#              The pilot can be a Future of a pilot still loading: frames are
+#              queued until it is ready.
+# ###################################################################
+
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Condition
+
+
+class BatchInferenceScheduler(Thread):
+    """Thread running a KerasCategorical pilot on batches of frames
+
+    submit() returns a concurrent.futures.Future with the (steering, throttle)
+    of that frame. In asyncio code wrap it with asyncio.wrap_future.
+    """
+
+    def __init__(self, pilot, max_batch=8, deadline_us=2000):
+        Thread.__init__(self, daemon=True)
+        self.pilot = pilot
+        self.max_batch = max_batch
+        self.deadline = deadline_us / 1e6
+        self.pending = deque()
+        self.cond = Condition()
+        self.running = True
+        self.batches = 0
+        self.frames = 0
+        self.full_flushes = 0
+        self.deadline_flushes = 0
+
+    def submit(self, image):
+        future = Future()
+        if image is None:
+            # same answer as KerasCategorical.run for a missing image
+            future.set_result((0.0, 0.0))
+            return future
+        with self.cond:
+            if not self.running:
+                future.cancel()
+                return future
+            self.pending.append((image, future))
+            self.cond.notify()
+        return future
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def run(self):
+        if isinstance(self.pilot, Future):
+            try:
+                self.pilot = self.pilot.result()
+            except Exception as e:
+                print(f"Could not load the model: {e}")
+                self.stop()
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            images, futures = zip(*batch)
+            try:
+                results = self.predict(np.stack(images))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+        with self.cond:
+            while self.pending:
+                self.pending.popleft()[1].cancel()
+
+    def _next_batch(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending or not self.running)
+            if not self.running:
+                return None
+            flush_at = time.perf_counter() + self.deadline
+            while len(self.pending) < self.max_batch and self.running:
+                remaining = flush_at - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            if len(self.pending) >= self.max_batch:
+                self.full_flushes += 1
+            else:
+                self.deadline_flushes += 1
+            batch = [self.pending.popleft() for _ in range(min(self.max_batch, len(self.pending)))]
+        self.batches += 1
+        self.frames += len(batch)
+        return batch
+
+    def predict(self, images):
+        """Run one forward pass on a (N, H, W, C) array, returns N (steering, throttle)"""
+        steering, throttle = self.pilot.run_batch(images)
+        return list(zip(steering.tolist(), throttle.tolist()))
+
+    def stats(self):
+        mean_batch = self.frames / self.batches if self.batches else 0.0
+        return {'batches': self.batches, 'frames': self.frames, 'mean_batch': mean_batch,
+                'full_flushes': self.full_flushes, 'deadline_flushes': self.deadline_flushes}
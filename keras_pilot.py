@@ -6,17 +6,37 @@
 #              it only contains the superclass and the linear and categorical classes
 #              From my experience, the categorical model is better suited
 #              I slightly modified some small things
+#              For inference the pilots run a session callable instead of
+#              model.predict, and a .h5 model can be frozen into a graph that is
+#              cached next to it, keyed by the hash of the file, so the next
+#              starts load the frozen graph directly. To export it beforehand:
+#                  python keras_pilot.py models/pilot_home_day_cat_aug.h5
+#              With --tflite it writes a TensorFlow Lite version instead, next
+#              to the .h5, for the on-car pilot (see local_pilot.py)
+#              tensorflow is only imported when it is first needed, it takes
+#              seconds, and load_pilot() gives a pilot ready for inference
+#              without building and compiling a model that is thrown away.
 # ###################################################################
 
 
-import tensorflow as tf
+import os
+import json
+import hashlib
+import time
 import numpy as np
-from tensorflow.python import keras
-from tensorflow import ConfigProto, Session
-from tensorflow.python.keras.layers import Input, Dense
-from tensorflow.python.keras.models import Model, Sequential
-from tensorflow.python.keras.layers import Convolution2D, MaxPooling2D, Reshape, BatchNormalization
-from tensorflow.python.keras.layers import Activation, Dropout, Flatten, Cropping2D, Lambda
+from argparse import ArgumentParser
+
+# set by import_tensorflow()
+tf = None
+keras = None
+
+
+def import_tensorflow():
+    global tf, keras
+    if tf is None:
+        import tensorflow
+        from tensorflow.python import keras as tf_keras
+        tf, keras = tensorflow, tf_keras
 
 
 class KerasPilot(object):
@@ -25,18 +45,100 @@ class KerasPilot(object):
     '''
 
     def __init__(self):
+        import_tensorflow()
         self.model = None
         self.optimizer = "adam"
         self.graph = tf.get_default_graph()
-        config = ConfigProto()
-        config.gpu_options.allow_growth = True
-        self.session = Session(config=config)
+        self.session = tf.Session(config=session_config())
         keras.backend.set_session(self.session)
+        self.predictor = None
+        self.input_buffer = None
 
-    def load(self, model_path):
+    def load(self, model_path, compile=True):
+        '''
+        Load a keras model. Without compile the optimizer is not set up, enough for inference
+        '''
         with self.graph.as_default():
             with self.session.as_default():
-                self.model = keras.models.load_model(model_path)
+                self.model = keras.models.load_model(model_path, compile=compile)
+        self.compile_predictor()
+
+    def load_frozen(self, path):
+        '''
+        Load a graph written by export_frozen. There is no keras model afterwards,
+        only the session callable used by predict()
+        '''
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        with open(path + '.json') as f:
+            names = json.load(f)
+        self.session.close()
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.session = tf.Session(graph=self.graph, config=session_config())
+        self.model = None
+        self._make_predictor(self.graph.get_tensor_by_name(names['input']),
+                             [self.graph.get_tensor_by_name(name) for name in names['outputs']])
+
+    def load_cached(self, model_path, cache_dir=''):
+        '''
+        Load the frozen graph of model_path from the cache, exporting it first if
+        it is not there yet. Falls back to the keras model if it can't be frozen
+        '''
+        path = cached_model_path(model_path, cache_dir)
+        if not os.path.exists(path):
+            print(f"Exporting {model_path} to {path}")
+            try:
+                export_frozen(model_path, path)
+            except Exception as e:
+                print(f"Could not freeze {model_path}, using the keras model: {e}")
+                self.load(model_path, compile=False)
+                return
+        self.load_frozen(path)
+
+    def warm_up(self, runs=2):
+        '''
+        The first forward passes allocate memory and pick kernels, run them
+        before the first frame arrives
+        '''
+        if self.predictor is None:
+            return
+        images = np.zeros_like(self.input_buffer)
+        for _ in range(runs):
+            self.predict(images)
+
+    def compile_predictor(self, batch_size=1):
+        '''
+        Build a session callable from the model input to its outputs. It skips
+        the batching and callbacks set up by model.predict on every call
+        '''
+        with self.graph.as_default():
+            self._make_predictor(self.model.inputs[0], self.model.outputs, batch_size)
+
+    def _make_predictor(self, input_tensor, output_tensors, batch_size=1):
+        self.predictor = self.session.make_callable(output_tensors, feed_list=[input_tensor])
+        shape = tuple(input_tensor.shape.as_list()[1:])
+        self.input_buffer = np.zeros((batch_size,) + shape, dtype=np.float32)
+
+    def predict(self, images):
+        '''
+        Forward pass on a (N, H, W, C) batch, returns the list of model outputs.
+        Batches are copied into input_buffer, which grows to the largest batch
+        seen, so uint8 camera frames reach the session callable as float32
+        without a new array per call. Not thread safe, call it from one thread
+        '''
+        if self.predictor is None:
+            with self.graph.as_default():
+                with self.session.as_default():
+                    return self.model.predict(images, batch_size=len(images))
+        # the session callable does not cast, it only takes float32
+        if len(images) > len(self.input_buffer):
+            self.input_buffer = np.zeros((len(images),) + self.input_buffer.shape[1:], dtype=np.float32)
+        batch = self.input_buffer[:len(images)]
+        np.copyto(batch, images)
+        return self.predictor(batch)
 
     def load_weights(self, model_path, by_name=True):
         with self.graph.as_default():
@@ -105,10 +207,12 @@ class KerasLinear(KerasPilot):
     The output is not bounded.
     '''
 
-    def __init__(self, num_outputs=2, input_shape=(120, 160, 3), roi_crop=(0, 0), *args, **kwargs):
+    def __init__(self, num_outputs=2, input_shape=(120, 160, 3), roi_crop=(0, 0), build=True, *args, **kwargs):
         super(KerasLinear, self).__init__(*args, **kwargs)
-        self.model = default_n_linear(num_outputs, input_shape, roi_crop)
-        self.compile()
+        # without build the model must be loaded afterwards
+        if build:
+            self.model = default_n_linear(num_outputs, input_shape, roi_crop)
+            self.compile()
 
     def compile(self):
         with self.graph.as_default():
@@ -117,13 +221,16 @@ class KerasLinear(KerasPilot):
                                    loss='mse')
 
     def run(self, img_arr):
-        with self.graph.as_default():
-            with self.session.as_default():
-                img_arr = img_arr.reshape((1,) + img_arr.shape)
-                outputs = self.model.predict(img_arr)
-                steering = outputs[0]
-                throttle = outputs[1]
-                return steering[0][0], throttle[0][0]
+        steering, throttle = self.run_batch(img_arr.reshape((1,) + img_arr.shape))
+        return steering[0], throttle[0]
+
+    def run_batch(self, images):
+        '''
+        Steering and throttle for a batch of frames (array or list of images),
+        as two arrays with one value per frame
+        '''
+        outputs = self.predict(np.asarray(images))
+        return outputs[0][:, 0], outputs[1][:, 0]
 
 
 class KerasCategorical(KerasPilot):
@@ -139,10 +246,13 @@ class KerasCategorical(KerasPilot):
     enable a higher throttle range. And cars with larger steering throw may want more bins.
     '''
 
-    def __init__(self, input_shape=(120, 160, 3), throttle_range=0.5, roi_crop=(0, 0), *args, **kwargs):
+    def __init__(self, input_shape=(120, 160, 3), throttle_range=0.5, roi_crop=(0, 0), build=True,
+                 *args, **kwargs):
         super(KerasCategorical, self).__init__(*args, **kwargs)
-        self.model = default_categorical(input_shape, roi_crop)
-        self.compile()
+        # without build the model must be loaded afterwards
+        if build:
+            self.model = default_categorical(input_shape, roi_crop)
+            self.compile()
         self.throttle_range = throttle_range
 
     def compile(self):
@@ -154,18 +264,111 @@ class KerasCategorical(KerasPilot):
                                    loss_weights={'angle_out': 0.5, 'throttle_out': 1.0})
 
     def run(self, img_arr):
-        with self.graph.as_default():
-            with self.session.as_default():
-                if img_arr is None:
-                    print('no image')
-                    return 0.0, 0.0
+        if img_arr is None:
+            print('no image')
+            return 0.0, 0.0
+
+        steering, throttle = self.run_batch(img_arr.reshape((1,) + img_arr.shape))
+        return steering[0], throttle[0]
+
+    def run_batch(self, images, with_confidence=False):
+        '''
+        Steering and throttle for a batch of frames (array or list of images),
+        as two arrays with one value per frame. With with_confidence it also
+        returns the expected value and confidence of each of them, see
+        linear_unbin_array
+        '''
+        angle_binned, throttle_binned = self.predict(np.asarray(images))
+        steering = linear_unbin_array(angle_binned, with_confidence=with_confidence)
+        throttle = linear_unbin_array(throttle_binned, N=throttle_binned.shape[1], offset=0.0,
+                                      R=self.throttle_range, with_confidence=with_confidence)
+        return steering, throttle
+
+
+def load_pilot(model_path, throttle_range=0.5):
+    '''
+    KerasCategorical ready to drive: no model is built, the frozen graph of
+    model_path is loaded from the cache (see load_cached) and warmed up
+    '''
+    start = time.time()
+    pilot = KerasCategorical(throttle_range=throttle_range, build=False)
+    pilot.load_cached(model_path)
+    loaded = time.time()
+    pilot.warm_up()
+    print(f"Model {model_path} loaded in {loaded - start:.2f} s, warm up {(time.time() - loaded) * 1000:.0f} ms")
+    return pilot
+
+
+def session_config():
+    import_tensorflow()
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    return config
+
+
+def model_hash(model_path):
+    '''
+    Hash of the model file and of the tensorflow version, a frozen graph is
+    only reused by the same version that wrote it
+    '''
+    import_tensorflow()
+    h = hashlib.sha1(tf.__version__.encode())
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()[:16]
 
-                img_arr = img_arr.reshape((1,) + img_arr.shape)
-                angle_binned, throttle = self.model.predict(img_arr)
-                N = len(throttle[0])
-                throttle = linear_unbin(throttle, N=N, offset=0.0, R=self.throttle_range)
-                angle_unbinned = linear_unbin(angle_binned)
-                return angle_unbinned, throttle
+
+def cached_model_path(model_path, cache_dir=''):
+    '''By default the cache is a "cache" folder next to the model'''
+    if not cache_dir:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(model_path)), 'cache')
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_dir, f"{name}_{model_hash(model_path)}.pb")
+
+
+def export_frozen(model_path, output_path):
+    '''
+    Freeze a keras model for inference: it is loaded in its own graph with the
+    learning phase set to 0, so dropout is removed, variables become constants
+    and training nodes are stripped. The input and output tensor names are
+    written to output_path + '.json'
+    '''
+    import_tensorflow()
+    graph = tf.Graph()
+    with graph.as_default():
+        session = tf.Session(graph=graph, config=session_config())
+        with session.as_default():
+            keras.backend.set_learning_phase(0)
+            model = keras.models.load_model(model_path, compile=False)
+            output_names = [t.op.name for t in model.outputs]
+            graph_def = tf.graph_util.convert_variables_to_constants(session, graph.as_graph_def(),
+                                                                     output_names)
+            graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+            names = {'input': model.inputs[0].name, 'outputs': [t.name for t in model.outputs]}
+        session.close()
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    # write to a temporary file first so that an interrupted export is never loaded
+    with open(output_path + '.json', 'w') as f:
+        json.dump(names, f)
+    with open(output_path + '.tmp', 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    os.replace(output_path + '.tmp', output_path)
+
+
+def export_tflite(model_path, output_path=''):
+    '''
+    Convert a keras model to TensorFlow Lite with weight quantization, small and
+    fast enough to run on the Raspberry PI. By default it is written next to the model
+    '''
+    if not output_path:
+        output_path = os.path.splitext(model_path)[0] + '.tflite'
+    import_tensorflow()
+    converter = tf.lite.TFLiteConverter.from_keras_model_file(model_path)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+    return output_path
 
 
 def clamp(n, min, max):
@@ -201,6 +404,36 @@ def linear_unbin(arr, N=15, offset=-1, R=2.0):
     return a
 
 
+def linear_bin_array(a, N=15, offset=1, R=2.0):
+    '''
+    linear_bin for an array of M values, returns an (M, N) array
+    with one one hot bin per row
+    '''
+    a = np.asarray(a, dtype=np.float64) + offset
+    b = np.clip(np.round(a / (R / (N - offset))), 0, N - 1).astype(np.intp)
+    arr = np.zeros((len(b), N))
+    arr[np.arange(len(b)), b] = 1
+    return arr
+
+
+def linear_unbin_array(arr, N=15, offset=-1, R=2.0, with_confidence=False):
+    '''
+    linear_unbin for an (M, N) array, returns the M values of the bins
+    with the highest score. With with_confidence it returns
+    (values, expected, confidence): expected is the mean value under the
+    softmax distribution of each row and confidence the probability of
+    the chosen bin
+    '''
+    arr = np.asarray(arr)
+    scale = R / (N + offset)
+    values = np.argmax(arr, axis=1) * scale + offset
+    if not with_confidence:
+        return values
+    expected = arr.dot(np.arange(N)) / arr.sum(axis=1) * scale + offset
+    confidence = arr.max(axis=1)
+    return values, expected, confidence
+
+
 def adjust_input_shape(input_shape, roi_crop):
     height = input_shape[0]
     new_height = height - roi_crop[0] - roi_crop[1]
@@ -208,7 +441,8 @@ def adjust_input_shape(input_shape, roi_crop):
 
 
 def default_categorical(input_shape=(120, 160, 3), roi_crop=(0, 0)):
-    opt = keras.optimizers.Adam()
+    from tensorflow.python.keras.layers import Input, Dense, Convolution2D, Dropout, Flatten
+    from tensorflow.python.keras.models import Model
     drop = 0.2
 
     # we now expect that cropping done elsewhere. we will adjust our expeected image size here:
@@ -258,6 +492,8 @@ def default_categorical(input_shape=(120, 160, 3), roi_crop=(0, 0)):
 
 
 def default_n_linear(num_outputs, input_shape=(120, 160, 3), roi_crop=(0, 0)):
+    from tensorflow.python.keras.layers import Input, Dense, Convolution2D, Dropout, Flatten
+    from tensorflow.python.keras.models import Model
     drop = 0.1
 
     # we now expect that cropping done elsewhere. we will adjust our expeected image size here:
@@ -290,3 +526,29 @@ def default_n_linear(num_outputs, input_shape=(120, 160, 3), roi_crop=(0, 0)):
     model = Model(inputs=[img_in], outputs=outputs)
 
     return model
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('models', nargs='+', help='keras .h5 models to freeze')
+    parser.add_argument('--tflite',
+                        dest='tflite',
+                        action='store_const', const=True,
+                        default=False,
+                        help='write a TensorFlow Lite model next to each .h5 for the on-car pilot',
+                        required=False)
+    parser.add_argument('--cache-dir', type=str,
+                        dest='cache_dir',
+                        default='',
+                        help='where to write the frozen graphs, by default a cache folder next to each model',
+                        required=False)
+    args = vars(parser.parse_args())
+
+    for model_path in args['models']:
+        if args['tflite']:
+            path = export_tflite(model_path)
+        else:
+            path = cached_model_path(model_path, args['cache_dir'])
+            export_frozen(model_path, path)
+        print(f"{model_path} -> {path}")
@@ -0,0 +1,269 @@
+# ###################################################################
+#
+# File:        latency_trace.py
+# Description: Per-frame latency tracing across the car and the server.
+#              Every frame is tagged with the time it reaches each stage:
+#                  car:     capture, send,                               command receive, actuation
+#                  server:  receive complete, decode, inference start/end, command send
+#              The server stamps its receive and send times in every command
+#              packet (see control_protocol.py). With them the car estimates
+#              the clock offset between both machines, NTP style, and puts
+#              the server stages of each frame on its own clock.
+#              Each side keeps p50/p95/p99 histograms of the time between
+#              consecutive stages and can write the raw traces to a compact
+#              binary log. Running this file prints the percentiles of one or
+#              more logs:
+#                  python latency_trace.py trace_car.bin [trace_server.bin]
+# ###################################################################
+
+import math
+import struct
+import time
+from collections import deque
+from threading import Lock
+from argparse import ArgumentParser
+
+CAPTURE = 0
+SEND = 1
+RECEIVE = 2
+DECODE = 3
+INFER_START = 4
+INFER_END = 5
+COMMAND_SEND = 6
+COMMAND_RECEIVE = 7
+ACTUATION = 8
+STAGES = ['capture', 'send', 'receive', 'decode', 'infer_start', 'infer_end',
+          'command_send', 'command_receive', 'actuation']
+
+SIDE_CAR = 0
+SIDE_SERVER = 1
+
+# frame id, side, clock offset (server - car) and one timestamp per stage, NaN if unknown
+RECORD = struct.Struct('<IBd' + 'd' * len(STAGES))
+NAN = float('nan')
+
+
+class LatencyHistogram(object):
+    """Histogram with logarithmic buckets from 10 us to 100 s, cheap to update"""
+
+    BUCKETS_PER_DECADE = 20
+    MIN_VALUE = 1e-5
+    NUM_BUCKETS = 7 * BUCKETS_PER_DECADE + 1
+
+    def __init__(self):
+        self.counts = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds != seconds:
+            return
+        if seconds <= self.MIN_VALUE:
+            bucket = 0
+        else:
+            bucket = min(int(math.log10(seconds / self.MIN_VALUE) * self.BUCKETS_PER_DECADE) + 1,
+                         self.NUM_BUCKETS - 1)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        """Upper edge of the bucket holding the p-th percentile (0-100), in seconds"""
+        if self.count == 0:
+            return NAN
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.MIN_VALUE * 10 ** (bucket / self.BUCKETS_PER_DECADE), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else NAN
+
+    def summary(self):
+        return {'count': self.count, 'mean_ms': self.mean() * 1000,
+                'p50_ms': self.percentile(50) * 1000, 'p95_ms': self.percentile(95) * 1000,
+                'p99_ms': self.percentile(99) * 1000, 'max_ms': self.max * 1000}
+
+    def copy(self):
+        """Copy for a reader in another thread, taken without a lock while add() may run:
+        the totals can be one value off the bucket counts, the count matches the buckets"""
+        h = LatencyHistogram()
+        h.counts = list(self.counts)
+        h.count = sum(h.counts)
+        h.total = self.total
+        h.max = self.max
+        return h
+
+    def buckets(self):
+        """(upper edge in ms, count) of the buckets holding values"""
+        return [(round(self.MIN_VALUE * 10 ** (bucket / self.BUCKETS_PER_DECADE) * 1000, 4), n)
+                for bucket, n in enumerate(self.counts) if n]
+
+
+class ClockOffsetEstimator(object):
+    """NTP style estimate of server clock minus car clock
+
+    t0: car sends a frame, t1: server receives it, t2: server sends the
+    command, t3: car receives it. Among the last samples the one with the
+    smallest network delay gives the most accurate offset.
+    """
+
+    def __init__(self, window=64):
+        self.samples = deque(maxlen=window)
+        self.offset = 0.0
+        self.delay = NAN
+
+    def add(self, t0, t1, t2, t3):
+        delay = (t3 - t0) - (t2 - t1)
+        if not delay >= 0:
+            # negative or NaN (a timestamp is missing)
+            return self.offset
+        self.samples.append((delay, ((t1 - t0) + (t2 - t3)) / 2))
+        self.delay, self.offset = min(self.samples)
+        return self.offset
+
+
+class FrameTracer(object):
+    """Collects the stage timestamps of the frames seen by one side
+
+    mark() can be called from any thread. A frame is closed by finish(), or
+    when its slot is reused by a newer frame (e.g. a frame dropped by the
+    pipeline). Closed frames feed the stage histograms and the binary log.
+    """
+
+    def __init__(self, side, log_path='', slots=256):
+        self.side = side
+        self.lock = Lock()
+        self.slots = [None] * slots
+        # one histogram per pair of consecutive stages seen, e.g. (SEND, RECEIVE)
+        self.histograms = {}
+        self.total = LatencyHistogram()
+        self.clock = ClockOffsetEstimator()
+        self.log = open(log_path, 'ab') if log_path else None
+
+    def mark(self, frame_id, stage, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            # stage timestamps start at index 1, index 0 is the frame id
+            self._record(frame_id)[stage + 1] = timestamp
+
+    def get(self, frame_id, stage):
+        with self.lock:
+            record = self.slots[frame_id % len(self.slots)]
+            if record is None or record[0] != frame_id:
+                return NAN
+            return record[stage + 1]
+
+    def finish(self, frame_id):
+        with self.lock:
+            index = frame_id % len(self.slots)
+            record = self.slots[index]
+            if record is not None and record[0] == frame_id:
+                self.slots[index] = None
+                self._close(record)
+
+    def _record(self, frame_id):
+        index = frame_id % len(self.slots)
+        record = self.slots[index]
+        if record is None or record[0] != frame_id:
+            if record is not None:
+                self._close(record)
+            record = self.slots[index] = [frame_id] + [NAN] * len(STAGES)
+        return record
+
+    def _close(self, record):
+        stamps = record[1:]
+        previous = None
+        first = NAN
+        for stage, t in enumerate(stamps):
+            if t != t:
+                continue
+            if previous is not None:
+                key = (previous, stage)
+                if key not in self.histograms:
+                    self.histograms[key] = LatencyHistogram()
+                self.histograms[key].add(t - stamps[previous])
+            else:
+                first = t
+            previous = stage
+        if previous is not None and stamps[previous] != first:
+            self.total.add(stamps[previous] - first)
+        if self.log is not None:
+            self.log.write(RECORD.pack(record[0], self.side, self.clock.offset, *stamps))
+
+    def to_local(self, server_time):
+        """Convert a server timestamp to this (car) clock"""
+        return server_time - self.clock.offset
+
+    def stats(self):
+        """Histogram summaries as a dict, keyed 'stage->stage' and 'total'"""
+        stats = {f"{STAGES[previous]}->{STAGES[stage]}": h.summary()
+                 for (previous, stage), h in sorted(self.histograms.items()) if h.count}
+        if self.total.count:
+            stats['total'] = self.total.summary()
+        return stats
+
+    def summary(self):
+        lines = []
+        for (previous, stage), h in sorted(self.histograms.items()):
+            if h.count:
+                s = h.summary()
+                lines.append(f"{STAGES[previous]:>15} -> {STAGES[stage]:<15} n {s['count']:>6} "
+                             f"p50 {s['p50_ms']:7.2f} ms p95 {s['p95_ms']:7.2f} ms p99 {s['p99_ms']:7.2f} ms")
+        if self.total.count:
+            s = self.total.summary()
+            lines.append(f"{'total':>34} n {s['count']:>6} "
+                         f"p50 {s['p50_ms']:7.2f} ms p95 {s['p95_ms']:7.2f} ms p99 {s['p99_ms']:7.2f} ms")
+        if self.side == SIDE_CAR and self.clock.samples:
+            lines.append(f"clock offset server - car {self.clock.offset * 1000:.2f} ms "
+                         f"(network delay {self.clock.delay * 1000:.2f} ms)")
+        return "\n".join(lines)
+
+    def close(self):
+        with self.lock:
+            for index, record in enumerate(self.slots):
+                if record is not None:
+                    self._close(record)
+                    self.slots[index] = None
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+
+def read_trace(path):
+    """Yield (frame_id, side, clock_offset, stamps) for every record of a binary trace log"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    for offset in range(0, len(data) - RECORD.size + 1, RECORD.size):
+        values = RECORD.unpack_from(data, offset)
+        yield values[0], values[1], values[2], list(values[3:])
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('logs', nargs='+', help='binary trace logs (car and/or server)')
+    args = vars(parser.parse_args())
+
+    tracer = FrameTracer(SIDE_CAR)
+    offsets = {}
+    records = {}
+    for path in args['logs']:
+        for frame_id, side, clock_offset, stamps in read_trace(path):
+            if side == SIDE_CAR:
+                offsets[frame_id] = clock_offset
+            records.setdefault(frame_id, []).append((side, stamps))
+    for frame_id, parts in sorted(records.items()):
+        offset = offsets.get(frame_id, 0.0)
+        for side, stamps in parts:
+            for stage, t in enumerate(stamps):
+                if t == t:
+                    tracer.mark(frame_id, stage, t - offset if side == SIDE_SERVER else t)
+        tracer.finish(frame_id)
+    print(tracer.summary())
@@ -0,0 +1,55 @@
+# ###################################################################
+#
+# File:        local_pilot.py
+# Description: Runs a categorical pilot on the Raspberry PI itself, from a
+#              TensorFlow Lite export of the keras model:
+#                  python keras_pilot.py --tflite models/pilot_home_day_cat_aug.h5
+#              It only needs the tflite_runtime package on the PI (the full
+#              tensorflow package is used instead if it is installed), and
+#              takes the raw frames of the camera, no JPEG involved.
+# ###################################################################
+
+import numpy as np
+from keras_pilot import linear_unbin
+
+
+def load_interpreter(model_path):
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    interpreter = Interpreter(model_path=model_path)
+    interpreter.allocate_tensors()
+    return interpreter
+
+
+class TFLitePilot(object):
+    '''
+    Same outputs as KerasCategorical.run for a single frame
+    '''
+
+    def __init__(self, model_path, throttle_range=0.5):
+        self.interpreter = load_interpreter(model_path)
+        self.throttle_range = throttle_range
+        details = self.interpreter.get_input_details()[0]
+        self.input_index = details['index']
+        self.input_buffer = np.zeros(details['shape'], dtype=details['dtype'])
+        outputs = self.interpreter.get_output_details()
+        angle = next((o for o in outputs if 'angle' in o['name']), outputs[0])
+        throttle = next(o for o in outputs if o is not angle)
+        self.angle_index = angle['index']
+        self.throttle_index = throttle['index']
+
+    def run(self, img_arr):
+        if img_arr is None:
+            return 0.0, 0.0
+        # converts the uint8 frame into the preallocated float input
+        np.copyto(self.input_buffer[0], img_arr)
+        self.interpreter.set_tensor(self.input_index, self.input_buffer)
+        self.interpreter.invoke()
+        angle_binned = self.interpreter.get_tensor(self.angle_index)
+        throttle_binned = self.interpreter.get_tensor(self.throttle_index)
+        steering = linear_unbin(angle_binned, N=angle_binned.shape[-1])
+        throttle = linear_unbin(throttle_binned, N=throttle_binned.shape[-1], offset=0.0, R=self.throttle_range)
+        return float(steering), float(throttle)
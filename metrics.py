@@ -0,0 +1,185 @@
+# ###################################################################
+#
+# File:        metrics.py
+# Description: Live metrics of the server over HTTP, to tell whether a car
+#              drives badly because of the network, the decoding, the model
+#              or the display while it drives:
+#                  curl http://127.0.0.1:8890/metrics
+#              returns JSON with, for every connection: frames and bytes
+#              received per second, decode and inference latency histograms,
+#              commands sent, and the stats() of its queues (depths, drops),
+#              video reader, frame pool and display, plus the sources
+#              registered for the whole server (e.g. the inference batches).
+#              Rates are over the time since the previous request, or since
+#              the connection started for the first one.
+#              The counters are plain attributes, each written by the one
+#              stage thread that owns it, and the histograms are
+#              latency_trace.LatencyHistograms, so the hot loop updates them
+#              without a lock. Requests read them without a lock too, a
+#              snapshot may be a frame apart between two counters.
+# ###################################################################
+
+import json
+import time
+from threading import Thread, Lock
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from latency_trace import LatencyHistogram
+
+METRICS_PORT = 8890
+
+
+def histogram_stats(histogram):
+    '''summary() and buckets of a copy of a LatencyHistogram, None instead of NaN while it is empty'''
+    h = histogram.copy()
+    stats = {key: (None if value != value else value) for key, value in h.summary().items()}
+    stats['buckets'] = h.buckets()
+    return stats
+
+
+class ConnectionMetrics(object):
+    '''
+    Counters of one car connection. received() is called by the receive
+    stage, decoded() by the decode stage and command_sent() by the control
+    stage. sources are objects with a stats() dict, read with every snapshot
+    '''
+
+    def __init__(self, name, sources=None):
+        self.name = name
+        self.sources = dict(sources or {})
+        self.connected_at = time.time()
+        self.closed_at = None
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.frames_decoded = 0
+        self.decode_failures = 0
+        self.commands_sent = 0
+        self.decode = LatencyHistogram()
+        self.infer = LatencyHistogram()
+
+    def received(self, frames, nbytes):
+        self.frames_received += frames
+        self.bytes_received += nbytes
+
+    def decoded(self, seconds, ok=True):
+        self.frames_decoded += 1
+        if not ok:
+            self.decode_failures += 1
+        self.decode.add(seconds)
+
+    def command_sent(self, seconds):
+        self.commands_sent += 1
+        self.infer.add(seconds)
+
+    def close(self):
+        self.closed_at = time.time()
+
+    def counters(self):
+        return (self.frames_received, self.bytes_received, self.frames_decoded, self.commands_sent)
+
+    def snapshot(self, now, previous=None):
+        '''
+        Dict of the metrics. previous is (time, counters()) of the previous
+        snapshot for the rates, else they are since the connection started
+        '''
+        counters = self.counters()
+        since, last = previous if previous is not None else (self.connected_at, (0, 0, 0, 0))
+        end = self.closed_at or now
+        elapsed = max(end - since, 1e-6)
+        received, nbytes, decoded, commands = (a - b for a, b in zip(counters, last))
+        snapshot = {'name': self.name,
+                    'connected': self.closed_at is None,
+                    'uptime_s': round(end - self.connected_at, 3),
+                    'fps': received / elapsed,
+                    'bytes_per_s': nbytes / elapsed,
+                    'decoded_fps': decoded / elapsed,
+                    'commands_per_s': commands / elapsed,
+                    'frames_received': counters[0],
+                    'bytes_received': counters[1],
+                    'frames_decoded': counters[2],
+                    'decode_failures': self.decode_failures,
+                    'commands_sent': counters[3],
+                    'decode_ms': histogram_stats(self.decode),
+                    'infer_ms': histogram_stats(self.infer)}
+        for name, source in self.sources.items():
+            snapshot[name] = [s.stats() for s in source] if isinstance(source, (list, tuple)) else source.stats()
+        return snapshot, (now, counters)
+
+
+class MetricsRegistry(object):
+    '''
+    The connections and server-wide sources shown by the MetricsServer.
+    Closed connections stay listed until keep_closed newer ones have closed
+    '''
+
+    def __init__(self, keep_closed=4):
+        self.lock = Lock()
+        self.connections = []
+        self.sources = {}
+        self.previous = {}
+        self.keep_closed = keep_closed
+        self.started_at = time.time()
+
+    def add(self, connection):
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+    def register(self, name, source):
+        with self.lock:
+            self.sources[name] = source
+
+    def closed(self, connection):
+        connection.close()
+        with self.lock:
+            closed = [c for c in self.connections if c.closed_at is not None]
+            for old in closed[:-self.keep_closed or None]:
+                self.connections.remove(old)
+                self.previous.pop(id(old), None)
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            connections = list(self.connections)
+            sources = dict(self.sources)
+        result = {'time': now, 'uptime_s': round(now - self.started_at, 3), 'connections': []}
+        for connection in connections:
+            snapshot, self.previous[id(connection)] = connection.snapshot(now, self.previous.get(id(connection)))
+            result['connections'].append(snapshot)
+        for name, source in sources.items():
+            result[name] = source.stats()
+        return result
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.registry.snapshot(), indent=1, default=str).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # no line per request in the console of the server
+        pass
+
+
+class MetricsServer(Thread):
+    """HTTP server of a MetricsRegistry on its own thread, GET /metrics"""
+
+    def __init__(self, registry, host='127.0.0.1', port=METRICS_PORT):
+        Thread.__init__(self, daemon=True)
+        self.httpd = HTTPServer((host, port), MetricsHandler)
+        self.httpd.registry = registry
+        self.address = self.httpd.server_address
+
+    def run(self):
+        self.httpd.serve_forever(poll_interval=0.5)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,164 @@
+# ###################################################################
+#
+# File:        pipeline.py
+# Description: Small building blocks to run the server as separate stages
+#              (receive, decode, control, display) in their own threads.
+#              Stages are joined by bounded StageQueues. With keep_latest a
+#              queue drops its oldest item instead of blocking the producer,
+#              so a slow stage always gets the newest frame and never makes
+#              the stages before it wait.
+#              LatestValue is the single slot version for consumers that poll
+#              at their own rate (e.g. the motor loop in run_client.py).
+#              ConsoleStatus keeps a per-frame status on one console line,
+#              rewritten in place a few times per second.
+# ###################################################################
+
+import sys
+import time
+from collections import deque
+from threading import Condition, Lock
+
+
+class StageQueue(object):
+    """Bounded queue between two pipeline stages with drop and depth counters"""
+
+    def __init__(self, name, maxsize=1, keep_latest=True, on_drop=None):
+        if maxsize < 1:
+            raise ValueError(f"queue {name} must hold at least one item, not {maxsize}")
+        self.name = name
+        self.maxsize = maxsize
+        self.keep_latest = keep_latest
+        # called with every item dropped by keep_latest, e.g. to release a pooled frame
+        self.on_drop = on_drop
+        self.items = deque()
+        self.cond = Condition()
+        self.closed = False
+        self.puts = 0
+        self.gets = 0
+        self.drops = 0
+        self.max_depth = 0
+
+    def put(self, item, timeout=None):
+        """Add an item. Returns False if the queue is closed or the put timed out"""
+        dropped = []
+        with self.cond:
+            if self.keep_latest:
+                while len(self.items) >= self.maxsize:
+                    dropped.append(self.items.popleft())
+                    self.drops += 1
+            elif not self.cond.wait_for(lambda: self.closed or len(self.items) < self.maxsize, timeout):
+                return False
+            if self.closed:
+                return False
+            self.items.append(item)
+            self.puts += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify_all()
+        if self.on_drop is not None:
+            for old in dropped:
+                self.on_drop(old)
+        return True
+
+    def get(self, timeout=None):
+        """Return the next item, or None if the queue is closed and empty or on timeout"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.closed or self.items, timeout):
+                return None
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.gets += 1
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        """Wake up every producer and consumer, pending items can still be read"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def depth(self):
+        return len(self.items)
+
+    def stats(self):
+        return {'name': self.name, 'depth': len(self.items), 'max_depth': self.max_depth,
+                'puts': self.puts, 'gets': self.gets, 'drops': self.drops}
+
+
+class LatestValue(object):
+    """Slot holding only the newest value, written by one thread and read by others"""
+
+    def __init__(self, value=None):
+        self.lock = Lock()
+        self.value = value
+        self.updated_at = None
+        self.version = 0
+
+    def set(self, value, timestamp=None):
+        with self.lock:
+            self.value = value
+            self.updated_at = time.time() if timestamp is None else timestamp
+            self.version += 1
+
+    def get(self):
+        """Return (value, time it was set, version). The version only grows on set()"""
+        with self.lock:
+            return self.value, self.updated_at, self.version
+
+
+class StatsReporter(object):
+    """Prints the counters of a set of queues at most once every interval seconds,
+    followed by the summary() of every object in extra"""
+
+    def __init__(self, queues, interval=5.0, extra=()):
+        self.queues = queues
+        self.interval = interval
+        self.extra = list(extra)
+        self.last_report = time.time()
+
+    def maybe_report(self):
+        now = time.time()
+        if self.interval <= 0 or now - self.last_report < self.interval:
+            return
+        self.last_report = now
+        print(self.format())
+
+    def format(self):
+        parts = [f"{q.name}: depth {len(q.items)} (max {q.max_depth}) "
+                 f"in {q.puts} out {q.gets} dropped {q.drops}" for q in self.queues]
+        return " | ".join(parts + [source.summary() for source in self.extra])
+
+
+class ConsoleStatus(object):
+    """One status line rewritten in place at most rate times per second.
+    When the output is not a terminal (e.g. a log file) a line is printed at
+    most once per second instead. Check due() before formatting the text"""
+
+    def __init__(self, rate=10.0, stream=None):
+        self.stream = sys.stdout if stream is None else stream
+        self.tty = self.stream.isatty()
+        self.period = 1.0 / rate if self.tty else 1.0
+        self.next_at = 0.0
+        self.shown = False
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        if now < self.next_at:
+            return False
+        self.next_at = now + self.period
+        return True
+
+    def show(self, text):
+        if self.tty:
+            # back to the start of the line, erase to its end
+            self.stream.write('\r' + text + '\x1b[K')
+            self.stream.flush()
+        else:
+            self.stream.write(text + '\n')
+        self.shown = True
+
+    def close(self):
+        """Leave the last status on its line"""
+        if self.tty and self.shown:
+            self.stream.write('\n')
+            self.shown = False
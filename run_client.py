@@ -9,147 +9,467 @@
 #              Pi. In this case, the Pi connects to two motors in the car with a
 #              L298N H-Bridge motor controller. There is a motor for
 #              forward-backward movement and another for left-right steering.
-#
-# Note: the class L298N_HBridge_DC_Motor has been taken from the donkey-car project
-#       and slightly modified
+#              Commands are received and applied to the motors in their own
+#              threads, so the video capture never waits for the server.
+#              With --autopilot-local the car drives itself: a TensorFlow Lite
+#              pilot runs on the Pi on the raw camera frames, and sending the
+#              video to the server is optional and best effort.
+#              The camera and the motors come from car_hardware.py. With
+#              --camera VIDEO --motors sim the client runs on a PC, e.g. to
+#              load test the real server.
+#              With --adaptive the frame rate and JPEG quality follow the
+#              feedback of the server to keep the command latency under a
+#              target, see adaptive_stream.py.
+#              With --transport udp the video goes in UDP datagrams, so a lost
+#              packet costs one frame instead of stalling the stream (see
+#              udp_video.py), the commands still come over TCP.
+#              With --transport shm, for a server on the same machine, the
+#              frames are written into a shared memory ring (see shm_video.py),
+#              and with --raw they are the camera's BGR arrays, no JPEG at all.
 # ###################################################################
 
 import io
 import socket
-import struct
 import time
-import picamera
-import pickle
-from threading import Thread
+from collections import deque
+from threading import Thread, Event
 from argparse import ArgumentParser
+from control_protocol import ControlPacketDecoder, ControlPacket, TYPE_CONTROL, TYPE_FEEDBACK
+from pipeline import LatestValue, StageQueue
+from video_stream import send_frame, send_end
+from udp_video import UDPFrameSender
+from car_hardware import create_camera, create_motors, save_motor_log, CAMERA_FRAMERATE
+from latency_trace import FrameTracer, SIDE_CAR, CAPTURE, SEND, RECEIVE, COMMAND_SEND, COMMAND_RECEIVE, ACTUATION
+from latency_trace import INFER_START, INFER_END
+
+
+def clamp(x, x_min, x_max):
+    return max(x_min, min(x_max, x))
 
 
-def map_range(x, X_min, X_max, Y_min, Y_max):
+def ramp(x, target, step):
     '''
-    Linear mapping between two ranges of values
+    Move x towards target by at most step
     '''
-    X_range = X_max - X_min
-    Y_range = Y_max - Y_min
-    XY_ratio = X_range/Y_range
+    if x < target:
+        return min(x + step, target)
+    return max(x - step, target)
 
-    y = ((x-X_min) / XY_ratio + Y_min) // 1
 
-    return int(y)
+class CommandReceiverThread(Thread):
+    '''
+    Receives the commands from the server on its own thread and keeps only the
+    newest one in a LatestValue slot, so the video capture never waits for them.
+    Feedback packets and round trips go to the adaptive controller, if any
+    '''
 
+    def __init__(self, client_socket, tracer, stop_event, adaptive=None):
+        Thread.__init__(self, daemon=True)
+        self.client_socket = client_socket
+        self.decoder = ControlPacketDecoder()
+        self.command = LatestValue()
+        self.tracer = tracer
+        self.stop_event = stop_event
+        self.adaptive = adaptive
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                packets = self.decoder.recv(self.client_socket)
+                if packets is None:
+                    break
+                if self.adaptive is not None:
+                    for packet in packets:
+                        if packet.type == TYPE_FEEDBACK:
+                            self.adaptive.update(packet)
+                command = self.decoder.newest(packets)
+                if command is None:
+                    continue
+                now = time.time()
+                self.command.set(command, now)
+                sent_at = self.tracer.get(command.frame_id, SEND)
+                # server receive and send times give the clock offset between car and server
+                self.tracer.clock.add(sent_at, command.received_at, command.timestamp, now)
+                self.tracer.mark(command.frame_id, RECEIVE, self.tracer.to_local(command.received_at))
+                self.tracer.mark(command.frame_id, COMMAND_SEND, self.tracer.to_local(command.timestamp))
+                self.tracer.mark(command.frame_id, COMMAND_RECEIVE, now)
+                if self.adaptive is not None:
+                    self.adaptive.command_received(now - sent_at)
+                print(f"{command.steering:.3f} {command.throttle:.3f} "
+                      f"frame {command.frame_id} rtt {(now - sent_at) * 1000:.1f} ms")
+        except OSError:
+            pass
+        finally:
+            # the server is gone, stop sending video
+            self.stop_event.set()
 
-class L298N_HBridge_DC_Motor(object):
+
+class MotorControlThread(Thread):
     '''
-    Motor controlled with an L298N hbridge from the gpio pins on Rpi
+    Applies the newest command to the motors at a fixed rate. Between commands
+    the motors move towards the newest one at most slew_rate units per second
+    (0: jump to it), so commands arriving at the video frame rate become a
+    smooth ramp at the motor rate. If no command arrived for command_timeout
+    seconds the watchdog ramps steering and throttle down to zero at ramp_rate
+    (units per second), so the car stops on its own when the server or the
+    network is late.
+    Every report_interval seconds it prints the loop rate, how late the ticks
+    wake up (jitter) and the GPIO writes per second of the motors.
     '''
 
-    def __init__(self, pin_forward, pin_backward, pwm_pin, freq=50, max_duty=90, min_value=0):
-        import RPi.GPIO as GPIO
-        self.pin_forward = pin_forward
-        self.pin_backward = pin_backward
-        self.pwm_pin = pwm_pin
-
-        GPIO.setmode(GPIO.BOARD)
-        GPIO.setup(self.pin_forward, GPIO.OUT)
-        GPIO.setup(self.pin_backward, GPIO.OUT)
-        GPIO.setup(self.pwm_pin, GPIO.OUT)
-
-        self.pwm = GPIO.PWM(self.pwm_pin, freq)
-        self.pwm.start(0)
-        self.max_duty = max_duty
-        self.min_value = min_value
-        self.throttle = 0
-
-    def run(self, speed):
-        import RPi.GPIO as GPIO
+    def __init__(self, command, steering, throttle, stop_event, rate=100, command_timeout=0.5, ramp_rate=2.0,
+                 tracer=None, slew_rate=8.0, report_interval=5.0):
+        Thread.__init__(self, daemon=True)
+        self.command = command
+        self.tracer = tracer
+        self.steering = steering
+        self.throttle = throttle
+        self.stop_event = stop_event
+        self.period = 1.0 / rate
+        self.command_timeout = command_timeout
+        self.ramp_rate = ramp_rate
+        self.slew_step = slew_rate * self.period if slew_rate > 0 else 2.0
+        self.report_interval = report_interval
+        self.steering_val = 0.0
+        self.throttle_val = 0.0
+        self.watchdog_trips = 0
+        self.ticks = 0
+        self.overruns = 0
+        self.jitter = deque(maxlen=max(1, int(rate * max(report_interval, 1.0))))
+        self.jitter_max = 0.0
+        self.started_at = None
+
+    def run(self):
+        self.started_at = time.perf_counter()
+        next_tick = self.started_at
+        next_report = self.started_at + self.report_interval
+        report_ticks, report_writes = 0, 0
+        late = False
+        applied_version = 0
+        try:
+            while not self.stop_event.is_set():
+                command, received_at, version = self.command.get()
+                if command is not None and time.time() - received_at <= self.command_timeout:
+                    late = False
+                    step = self.slew_step
+                    steering_val = ramp(self.steering_val, command.steering, step)
+                    throttle_val = ramp(self.throttle_val, command.throttle, step)
+                else:
+                    if command is not None and not late:
+                        self.watchdog_trips += 1
+                        print(f"No command for {self.command_timeout} s, stopping the car")
+                    late = True
+                    step = self.ramp_rate * self.period
+                    steering_val = ramp(self.steering_val, 0.0, step)
+                    throttle_val = ramp(self.throttle_val, 0.0, step)
+                self.apply(steering_val, throttle_val)
+                if version != applied_version and not late and self.tracer is not None:
+                    self.tracer.mark(command.frame_id, ACTUATION)
+                    self.tracer.finish(command.frame_id)
+                applied_version = version
+                self.ticks += 1
+
+                now = time.perf_counter()
+                if self.report_interval > 0 and now >= next_report:
+                    writes = self.gpio_writes()
+                    print(self.summary(self.ticks - report_ticks, writes - report_writes,
+                                       now - next_report + self.report_interval))
+                    report_ticks, report_writes = self.ticks, writes
+                    next_report = now + self.report_interval
+                next_tick += self.period
+                if now > next_tick:
+                    # a whole period late: skip the ticks missed instead of running them back to back
+                    self.overruns += 1
+                    next_tick = now
+                time.sleep(next_tick - now)
+                woke_up = time.perf_counter() - next_tick
+                self.jitter.append(woke_up)
+                self.jitter_max = max(self.jitter_max, woke_up)
+        finally:
+            self.apply(0.0, 0.0)
+
+    def apply(self, steering_val, throttle_val):
+        steering_val = clamp(steering_val, -1.0, 1.0)
+        throttle_val = clamp(throttle_val, -1.0, 1.0)
+        if steering_val != self.steering_val:
+            self.steering.run(steering_val)
+            self.steering_val = steering_val
+        if throttle_val != self.throttle_val:
+            self.throttle.run(throttle_val)
+            self.throttle_val = throttle_val
+
+    def gpio_writes(self):
+        return getattr(self.steering, 'gpio_writes', 0) + getattr(self.throttle, 'gpio_writes', 0)
+
+    def stats(self, ticks=None, writes=None, elapsed=None):
         '''
-        Update the speed of the motor where 1 is full forward and
-        -1 is full backwards.
+        Loop rate, wake up jitter of the last ticks and GPIO writes per second,
+        over the whole run unless ticks, writes and elapsed of an interval are given
         '''
-        if speed > 1 or speed < -1:
-            raise ValueError("Speed must be between 1(forward) and -1(reverse)")
-
-        self.speed = speed
-        self.throttle = int(map_range(speed, -1, 1, -self.max_duty, self.max_duty))
-        if self.throttle < self.min_value and self.min_value > 0:
-            self.throttle = self.throttle + 10
-
-        if self.throttle > 0:
-            self.pwm.ChangeDutyCycle(self.throttle)
-            GPIO.output(self.pin_forward, GPIO.HIGH)
-            GPIO.output(self.pin_backward, GPIO.LOW)
-        elif self.throttle < 0:
-            self.pwm.ChangeDutyCycle(-self.throttle)
-            GPIO.output(self.pin_forward, GPIO.LOW)
-            GPIO.output(self.pin_backward, GPIO.HIGH)
-        else:
-            self.pwm.ChangeDutyCycle(self.throttle)
-            GPIO.output(self.pin_forward, GPIO.LOW)
-            GPIO.output(self.pin_backward, GPIO.LOW)
+        if elapsed is None:
+            elapsed = time.perf_counter() - self.started_at if self.started_at is not None else 0.0
+            ticks, writes = self.ticks, self.gpio_writes()
+        elapsed = max(elapsed, 1e-6)
+        jitter = sorted(self.jitter)
+        def percentile(p):
+            return jitter[min(len(jitter) - 1, int(p * len(jitter)))] * 1000 if jitter else 0.0
+        return {'rate': ticks / elapsed, 'gpio_writes_per_s': writes / elapsed,
+                'jitter_p50_ms': percentile(0.5), 'jitter_p99_ms': percentile(0.99),
+                'jitter_max_ms': self.jitter_max * 1000, 'overruns': self.overruns,
+                'watchdog_trips': self.watchdog_trips}
+
+    def summary(self, ticks=None, writes=None, elapsed=None):
+        s = self.stats(ticks, writes, elapsed)
+        return (f"motors: {s['rate']:.1f} Hz, jitter p50 {s['jitter_p50_ms']:.2f} ms p99 {s['jitter_p99_ms']:.2f} ms "
+                f"max {s['jitter_max_ms']:.2f} ms, {s['overruns']} overruns, "
+                f"GPIO writes {s['gpio_writes_per_s']:.1f}/s, {s['watchdog_trips']} watchdog stops")
 
-    def shutdown(self):
-        import RPi.GPIO as GPIO
-        self.pwm.stop()
-        GPIO.cleanup()
 
 # Video Sending Thread
 class VideoSendThread(Thread):
     # A class to send video frames using threads
     # This class inherits from Thread, which means that will run on a separate Thread
     # whenever called, it starts the run method
-
-    def __init__(self, host, port, receive_controls=False):
+    # When receiving controls, commands are received by a CommandReceiverThread and
+    # applied to the motors by a MotorControlThread, so capture never waits for them
+    # Frames are captured and encoded by a capture thread into a small pool of
+    # reusable BytesIO buffers, while this thread sends the previous frame
+    # straight from its buffer with one sendmsg
+    # adaptive is an AdaptiveStreamController for the settings of the camera
+    # With transport 'udp' the frames go to the same port over UDP, with 'shm'
+    # into the shared memory ring of the server, raw skips the JPEG encoding
+
+    def __init__(self, host, port, receive_controls=False, motor_rate=100, command_timeout=0.5, trace_path='',
+                 camera=None, motors=None, buffers=3, adaptive=None, transport='tcp', raw=False, motor_slew=8.0):
         Thread.__init__(self)
+        if raw and transport != 'shm':
+            raise ValueError("raw frames can only be sent with the shm transport")
         # create socket and bind host
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((host, port))
-        self.connection = self.client_socket.makefile('wb')
+        self.udp = None
+        self.ring = None
+        if transport == 'udp':
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.connect((host, port))
+            self.udp = UDPFrameSender(udp_socket)
+        elif transport == 'shm':
+            from shm_video import SharedFrameRing, ring_name
+            self.ring = SharedFrameRing(ring_name(port))
+        self.raw = raw
         self.receive_controls = receive_controls
-        HBRIDGE_PIN_LEFT  = 16
-        HBRIDGE_PIN_RIGHT = 18
+        self.stop_event = Event()
+        # buffers go round: free -> written by the camera -> ready -> sent -> free
+        self.free = StageQueue('free', buffers, keep_latest=False)
+        self.ready = StageQueue('ready', buffers, keep_latest=False)
+        for _ in range(buffers):
+            self.free.put(io.BytesIO())
+        self.capture_thread = Thread(target=self.capture, name='capture', daemon=True)
+        self.tracer = FrameTracer(SIDE_CAR, trace_path)
+        self.camera = camera if camera is not None else create_camera()
+        self.steering, self.throttle = motors if motors is not None else create_motors()
+        self.adaptive = adaptive
+
+        self.receiver = None
+        self.motors = None
+        if receive_controls:
+            self.receiver = CommandReceiverThread(self.client_socket, self.tracer, self.stop_event,
+                                                  adaptive=adaptive)
+            self.motors = MotorControlThread(self.receiver.command, self.steering, self.throttle,
+                                             self.stop_event, rate=motor_rate, command_timeout=command_timeout,
+                                             tracer=self.tracer, slew_rate=motor_slew)
+
+    def capture(self):
+        def outputs():
+            while not self.stop_event.is_set():
+                stream = self.free.get()
+                if stream is None:
+                    return
+                # no truncate: the buffer keeps its memory, only the first bytes are sent
+                stream.seek(0)
+                yield stream
+        def finished(stream):
+            # called as soon as the JPEG is complete, before the camera asks for the next buffer
+            self.ready.put((stream, stream.tell(), time.time()))
+        try:
+            self.camera.capture_jpeg(outputs(), finished)
+        finally:
+            self.ready.close()
+
+    def jpeg_frames(self):
+        '''JPEGs of the capture thread, as views of the pooled buffers'''
+        self.capture_thread.start()
+        while not self.stop_event.is_set():
+            item = self.ready.get()
+            if item is None:
+                break
+            stream, length, captured_at = item
+            with stream.getbuffer() as view, view[:length] as jpg:
+                yield jpg, captured_at
+            self.free.put(stream)
+
+    def raw_frames(self):
+        '''The camera's own BGR frames, only valid until the next one'''
+        for image in self.camera.frames():
+            yield image, time.time()
+            if self.stop_event.is_set():
+                break
+
+    def send(self, frame_id, frame):
+        if self.ring is not None:
+            self.ring.write(frame_id, frame)
+        elif self.udp is not None:
+            self.udp.send_frame(frame_id, frame)
+        else:
+            send_frame(self.client_socket, frame)
+
+    def run(self):
+        try:
+            if self.receive_controls:
+                self.receiver.start()
+                self.motors.start()
+            # send jpeg format video stream
+            frame_id = 0
+            for frame, captured_at in (self.raw_frames() if self.raw else self.jpeg_frames()):
+                frame_id += 1
+                self.tracer.mark(frame_id, CAPTURE, captured_at)
+                self.send(frame_id, frame)
+                self.tracer.mark(frame_id, SEND)
+                if self.adaptive is not None:
+                    self.adaptive.frame_sent()
+                if not self.receive_controls:
+                    self.tracer.finish(frame_id)
+
+            # Pack zero as little endian unsigned long and send it to signal end of connection
+            if self.ring is not None:
+                self.ring.close()
+            elif self.udp is not None:
+                self.udp.send_end()
+            else:
+                send_end(self.client_socket)
+
+        finally:
+            self.stop_event.set()
+            self.free.close()
+            if self.capture_thread.is_alive():
+                self.capture_thread.join()
+            if self.motors is not None and self.motors.is_alive():
+                self.motors.join()
+                print(self.motors.summary())
+            self.camera.close()
+            self.steering.shutdown()
+            self.throttle.shutdown()
+            self.tracer.close()
+            print(self.tracer.summary())
+            if self.udp is not None:
+                print(f"UDP: {self.udp.frames_sent} frames in {self.udp.datagrams_sent} datagrams, "
+                      f"{self.udp.send_errors} send errors")
+                self.udp.sock.close()
+            if self.ring is not None:
+                self.ring.release()
+            self.client_socket.close()
 
-        HBRIDGE_PIN_FWD   = 11
-        HBRIDGE_PIN_BWD   = 13
 
-        HBRIDGE_EN_PW_LR  = 33
-        HBRIDGE_EN_PW_FB  = 32
+class VideoUploadThread(Thread):
+    '''
+    Best effort video for the server while the car drives itself: only the
+    newest frame is encoded and sent, and if the server can't be reached or
+    goes away the upload just stops, the car keeps driving
+    '''
 
-        print("Init of steering")
-        self.steering = L298N_HBridge_DC_Motor(HBRIDGE_PIN_LEFT, HBRIDGE_PIN_RIGHT, HBRIDGE_EN_PW_LR, max_duty=80)
-        print("Init of throttle")
-        self.throttle = L298N_HBridge_DC_Motor(HBRIDGE_PIN_FWD, HBRIDGE_PIN_BWD, HBRIDGE_EN_PW_FB, max_duty=60, min_value=30)
+    def __init__(self, host, port, quality=85):
+        Thread.__init__(self, daemon=True)
+        self.host = host
+        self.port = port
+        self.quality = quality
+        self.frames = StageQueue('upload', 1, keep_latest=True)
+        self.frames_sent = 0
 
     def run(self):
+        import cv2
         try:
-            with picamera.PiCamera() as camera:
-                camera.resolution = (160, 120)  # pi camera resolution
-                camera.framerate = 10  # 10 frames/sec
-                time.sleep(2)  # give 2 secs for camera to initilize
-                stream = io.BytesIO()
-
-                # send jpeg format video stream
-                for foo in camera.capture_continuous(stream, 'jpeg', use_video_port=True):
-                    self.connection.write(struct.pack('<L', stream.tell()))
-                    self.connection.flush()
-                    stream.seek(0)
-                    self.connection.write(stream.read())
-                    stream.seek(0)
-                    stream.truncate()
-
-                    # Now receive the steering and throttle and run
-                    if self.receive_controls:
-                        message = self.client_socket.recv(64)
-                        steering_val, throttle_val = map(float, message.decode().split(","))
-                        print(f"{steering_val} {throttle_val}")
-                        self.steering.run(steering_val)
-                        self.throttle.run(throttle_val)
+            client_socket = socket.create_connection((self.host, self.port), timeout=5)
+        except OSError as e:
+            print(f"No video upload, could not connect to {self.host}:{self.port}: {e}")
+            self.frames.close()
+            return
+        try:
+            while True:
+                image = self.frames.get()
+                if image is None:
+                    break
+                ret, jpg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+                if not ret:
+                    continue
+                send_frame(client_socket, jpg)
+                self.frames_sent += 1
+            send_end(client_socket)
+        except OSError as e:
+            print(f"Video upload stopped: {e}")
+        finally:
+            self.frames.close()
+            client_socket.close()
+
+    def stop(self):
+        self.frames.close()
 
-            # Pack zero as little endian unsigned long and send it to signal end of connection
-            self.connection.write(struct.pack('<L', 0))
 
+class LocalAutopilotThread(Thread):
+    '''
+    Drives the car with a pilot running on the Pi: the raw camera frames go
+    straight to the model and its commands to a MotorControlThread, with no
+    JPEG and no network round trip. If upload is a VideoUploadThread a copy
+    of every frame is handed to it, it never makes the pilot wait
+    '''
+
+    def __init__(self, model_path, camera, steering, throttle, upload=None, motor_rate=100,
+                 command_timeout=0.5, trace_path='', motor_slew=8.0):
+        Thread.__init__(self)
+        from local_pilot import TFLitePilot
+        self.pilot = TFLitePilot(model_path)
+        self.camera = camera
+        self.steering = steering
+        self.throttle = throttle
+        self.upload = upload
+        self.stop_event = Event()
+        self.tracer = FrameTracer(SIDE_CAR, trace_path)
+        self.command = LatestValue()
+        self.motors = MotorControlThread(self.command, steering, throttle, self.stop_event, rate=motor_rate,
+                                         command_timeout=command_timeout, tracer=self.tracer, slew_rate=motor_slew)
+
+    def run(self):
+        try:
+            self.motors.start()
+            if self.upload is not None:
+                self.upload.start()
+            frame_id = 0
+            for image in self.camera.frames():
+                frame_id += 1
+                self.tracer.mark(frame_id, CAPTURE)
+                self.tracer.mark(frame_id, INFER_START)
+                steering_val, throttle_val = self.pilot.run(image)
+                now = time.time()
+                self.tracer.mark(frame_id, INFER_END, now)
+                self.command.set(ControlPacket(TYPE_CONTROL, frame_id, frame_id, now, now,
+                                               steering_val, throttle_val), now)
+                if self.upload is not None:
+                    # the camera reuses its buffer for the next frame
+                    self.upload.frames.put(image.copy())
+                if self.stop_event.is_set():
+                    break
         finally:
-            GPIO.cleanup()
-            self.connection.close()
-            self.client_socket.close()
+            self.stop_event.set()
+            if self.motors.is_alive():
+                self.motors.join()
+                print(self.motors.summary())
+            if self.upload is not None:
+                self.upload.stop()
+                self.upload.join()
+            self.camera.close()
+            self.steering.shutdown()
+            self.throttle.shutdown()
+            self.tracer.close()
+            print(self.tracer.summary())
 
 
 if __name__ == "__main__":
@@ -171,17 +491,144 @@ if __name__ == "__main__":
                         default='192.168.1.3',
                         help='destination host name or ip',
                         required=False)
+    parser.add_argument('--motor-rate', type=int,
+                        dest='motor_rate',
+                        default=100,
+                        help='times per second the newest command is applied to the motors',
+                        required=False)
+    parser.add_argument('--motor-slew', type=float,
+                        dest='motor_slew',
+                        default=8.0,
+                        help='fastest change of steering and throttle towards a new command, '
+                             'in units per second (0: no limit)',
+                        required=False)
+    parser.add_argument('--command-timeout', type=float,
+                        dest='command_timeout',
+                        default=0.5,
+                        help='seconds without commands before the car is ramped down to a stop',
+                        required=False)
+    parser.add_argument('--trace', type=str,
+                        dest='trace_path',
+                        default='',
+                        help='binary log file for the per-frame stage timestamps (see latency_trace.py)',
+                        required=False)
+    parser.add_argument('--autopilot-local', type=str,
+                        dest='autopilot_local',
+                        default='',
+                        help='drive with this TensorFlow Lite model on the car instead of the server',
+                        required=False)
+    parser.add_argument('--upload-video',
+                        dest='upload_video',
+                        action='store_const', const=True,
+                        default=False,
+                        help='with --autopilot-local: also send the video to the server, best effort',
+                        required=False)
+    parser.add_argument('--camera', type=str,
+                        dest='camera',
+                        default='pi',
+                        help='pi for the RPi camera, or a video file or image folder to play back instead',
+                        required=False)
+    parser.add_argument('--fps', type=int,
+                        dest='fps',
+                        default=CAMERA_FRAMERATE,
+                        help='camera frames per second',
+                        required=False)
+    parser.add_argument('--adaptive',
+                        dest='adaptive',
+                        action='store_const', const=True,
+                        default=False,
+                        help='with --receive_controls: adapt the frame rate and JPEG quality to the server feedback',
+                        required=False)
+    parser.add_argument('--min-fps', type=int,
+                        dest='min_fps',
+                        default=5,
+                        help='with --adaptive: lowest frame rate',
+                        required=False)
+    parser.add_argument('--max-fps', type=int,
+                        dest='max_fps',
+                        default=30,
+                        help='with --adaptive: highest frame rate',
+                        required=False)
+    parser.add_argument('--min-quality', type=int,
+                        dest='min_quality',
+                        default=30,
+                        help='with --adaptive: lowest JPEG quality',
+                        required=False)
+    parser.add_argument('--max-quality', type=int,
+                        dest='max_quality',
+                        default=90,
+                        help='with --adaptive: highest JPEG quality',
+                        required=False)
+    parser.add_argument('--latency-target', type=float,
+                        dest='latency_target',
+                        default=100,
+                        help='with --adaptive: command round trip to stay under, in milliseconds',
+                        required=False)
+    parser.add_argument('--transport', type=str,
+                        dest='transport',
+                        default='tcp',
+                        choices=['tcp', 'udp', 'shm'],
+                        help='send the video over TCP, UDP where a lost datagram only drops its frame, '
+                             'or shared memory to a server on this machine',
+                        required=False)
+    parser.add_argument('--raw',
+                        dest='raw',
+                        action='store_const', const=True,
+                        default=False,
+                        help='with --transport shm: send the raw BGR frames, no JPEG encoding',
+                        required=False)
+    parser.add_argument('--motors', type=str,
+                        dest='motors',
+                        default='l298n',
+                        choices=['l298n', 'sim'],
+                        help='l298n for the H-bridge on the GPIO pins, sim to only record the commands',
+                        required=False)
+    parser.add_argument('--motor-log', type=str,
+                        dest='motor_log',
+                        default='',
+                        help='with --motors sim: save the recorded duty cycles to this CSV file',
+                        required=False)
     args = vars(parser.parse_args())
+    if args['raw'] and args['transport'] != 'shm':
+        parser.error("--raw needs --transport shm")
 
     host = args['host']
     port = args['port']
 
     threads = []
 
-    newthread = VideoSendThread(host, port,  receive_controls=args['receive_controls'])
+    camera = create_camera(args['camera'], framerate=args['fps'],
+                           max_framerate=args['max_fps'] if args['adaptive'] else None)
+    steering, throttle = create_motors(args['motors'])
+    if args['autopilot_local']:
+        upload = VideoUploadThread(host, port) if args['upload_video'] else None
+        newthread = LocalAutopilotThread(args['autopilot_local'], camera, steering, throttle, upload=upload,
+                                         motor_rate=args['motor_rate'], command_timeout=args['command_timeout'],
+                                         trace_path=args['trace_path'], motor_slew=args['motor_slew'])
+    else:
+        adaptive = None
+        if args['adaptive'] and args['receive_controls']:
+            from adaptive_stream import AdaptiveStreamController
+            adaptive = AdaptiveStreamController(camera.settings, args['min_fps'], args['max_fps'],
+                                                args['min_quality'], args['max_quality'],
+                                                latency_target=args['latency_target'] / 1000.0)
+        newthread = VideoSendThread(host, port,  receive_controls=args['receive_controls'],
+                                    motor_rate=args['motor_rate'], command_timeout=args['command_timeout'],
+                                    trace_path=args['trace_path'], camera=camera, motors=(steering, throttle),
+                                    adaptive=adaptive, transport=args['transport'], raw=args['raw'],
+                                    motor_slew=args['motor_slew'])
     newthread.start()
     threads.append(newthread)
 
-    for t in threads:
-        t.join()
-
+    try:
+        for t in threads:
+            t.join()
+    except KeyboardInterrupt:
+        # the capture loop checks stop_event after every frame
+        for t in threads:
+            t.stop_event.set()
+            t.join()
+
+    if args['motor_log'] and args['motors'] == 'sim':
+        save_motor_log(args['motor_log'], [steering, throttle])
+        print(f"Motor commands saved in {args['motor_log']}")
@@ -7,95 +7,316 @@
 #              then depending on the mode it does:
 #                  autopilot mode: process the frames with a keras model, and sends back to
 #                          the Raspberry Pi the throttle and steering values for autonomous
-#                          driving
+#                          driving (as binary packets, see control_protocol.py)
 #                  manual mode: interprets PS4 controller commands and sends them to the
 #                          client as steering and throttle to control a remote car
-#               Note: in manual mode, the PS4 and the video reception are processed in two
-#               different threads
+#               Note: reception, decoding, the model or PS4 controller and the display
+#               run as separate stages in their own threads, see pipeline.py
+#               The model is loaded while the server waits for the car to connect.
+#               Every feedback_interval seconds the control stage also sends a
+#               feedback packet with the receive rate, the decode and model times and
+#               the frames dropped, the car adapts its frame rate and JPEG quality to it.
+#               With --transport udp the video comes in UDP datagrams instead (see
+#               udp_video.py), frames that lose a datagram are dropped, and the TCP
+#               connection only carries the commands.
+#               With --transport shm a client on the same machine writes the frames,
+#               JPEG or raw BGR, into a shared memory ring instead (see shm_video.py).
+#               Decoded frames are reference counted and released once the display and
+#               the control stage are done with them (see frame_pool.py).
+#               With --metrics-port the counters of every stage can be read live over
+#               HTTP while the car drives (see metrics.py).
 # ###################################################################
 
+import time
+# taken before the slow imports, for the startup time report
+START_TIME = time.time()
 import cv2
-import os
 import numpy as np
-from threading import Thread
+from threading import Thread, Event
+from concurrent.futures import Future, ThreadPoolExecutor
 import socket
 from argparse import ArgumentParser
 from PS4Controller import PS4Controller
+from video_stream import FrameReader
+from udp_video import UDPFrameReceiver
+from pipeline import StageQueue, StatsReporter, ConsoleStatus
+from frame_pool import FramePool
+from metrics import ConnectionMetrics, MetricsRegistry, MetricsServer, METRICS_PORT
+from display import DisplayThread, parse_display, DISPLAY_CHOICES
+from control_protocol import ControlPacketEncoder
+from latency_trace import FrameTracer, SIDE_SERVER, RECEIVE, DECODE, INFER_START, INFER_END, COMMAND_SEND
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
 class VideoClientThread(Thread):
-    """Class to Receive video data from client"""
+    """Class to Receive video data from client
 
-    def __init__(self, ip, port, connection, model_path='', send_ps4=False):
+    The thread itself is the receive stage. It starts one thread per
+    remaining stage, joined by bounded StageQueues:
+        receive -> decode -> control (model or PS4 controller, sends the command)
+    Decoded frames are also handed to the DisplayThread, unless display_fps is None.
+    """
+
+    def __init__(self, ip, port, connection, model_path='', send_ps4=False,
+                 keep_latest=True, queue_size=1, stats_interval=5.0, trace_path='',
+                 display_fps=0.0, controller=None, model=None, record_dir='', feedback_interval=1.0,
+                 video_socket=None, udp_timeout=0.1, video_ring=None, metrics_registry=None):
         Thread.__init__(self)
         self.ip = ip
         self.port = port
         self.connection = connection
         self.model = None
         self.ps4 = None
-        if send_ps4:
-            self.ps4 = PS4Controller()
-            self.ps4_events = self.ps4.generate_event()
-
-
-        if model_path != '':
-            from keras_pilot import KerasLinear
-            from keras_pilot import KerasCategorical
-            IMAGE_W = 160
-            IMAGE_H = 120
-            input_shape = (IMAGE_H, IMAGE_W, 3)
-            roi_crop = (0, 0)
-            # self.model = KerasLinear(input_shape=input_shape, roi_crop=roi_crop)
-            # Categorical model seems to work better
-            self.model = KerasCategorical(input_shape=input_shape, roi_crop=roi_crop)
-            self.model.load(model_path)
+        self.stop_event = Event()
+        self.encoder = ControlPacketEncoder()
+        self.pool = FramePool()
+        self.decode_queue = StageQueue('decode', queue_size, keep_latest)
+        self.control_queue = StageQueue('control', queue_size, keep_latest, on_drop=self.release_dropped)
+        self.queues = [self.decode_queue, self.control_queue]
+        # video from a UDP socket, only the datagrams from the ip of this connection,
+        # or from a shared memory ring. Either way the connection is watched for its close
+        self.udp = video_socket is not None
+        self.shm = video_ring is not None
+        if self.udp:
+            self.reader = UDPFrameReceiver(video_socket, peer=ip, timeout=udp_timeout)
+        elif self.shm:
+            # shared_memory needs Python 3.8, imported only for --transport shm
+            from shm_video import ShmFrameReceiver
+            self.reader = ShmFrameReceiver(video_ring)
+        else:
+            self.reader = FrameReader(self.connection)
+        self.separate_video = self.udp or self.shm
+        self.stats = StatsReporter(self.queues, stats_interval,
+                                   extra=[self.reader, self.pool] if self.separate_video else [self.pool])
+        self.tracer = FrameTracer(SIDE_SERVER, trace_path)
+        # counters for the feedback packets and the metrics endpoint, each written by one stage only
+        self.feedback_interval = feedback_interval
+        self.metrics = ConnectionMetrics(f"{ip}:{port}", sources={'queues': self.queues, 'pool': self.pool})
+        if self.separate_video:
+            self.metrics.sources['reader'] = self.reader
+        self.metrics_registry = metrics_registry
+        self.feedback_snapshot = None
+        self.recorder = None
+        if record_dir:
+            from session_recorder import SessionRecorder
+            self.recorder = SessionRecorder(record_dir)
+            self.metrics.sources['recorder'] = self.recorder
+            print(f"Recording the session in {self.recorder.directory}")
+        self.display = None
+        if display_fps is not None:
+            self.display = DisplayThread(display_fps, on_quit=self.stop)
+            self.metrics.sources['display'] = self.display
+        # any object with a read() of the newest (steering, throttle) like PS4Controller can drive the car
+        if controller is not None:
+            self.ps4 = controller
+        elif send_ps4:
+            self.ps4 = PS4Controller().start()
+        self.own_ps4 = controller is None and send_ps4
+        self.status = ConsoleStatus()
+
+        # model can also be a Future of a pilot still loading, the control stage waits for it
+        if model is not None:
+            self.model = model
+        elif model_path != '':
+            from keras_pilot import load_pilot
+            self.model = load_pilot(model_path)
         print("[+] New server socket thread started for " + ip + ":" + str(port))
 
+    def stop(self):
+        """Stop every stage, also wakes up the receive stage blocked in recv"""
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        for q in self.queues:
+            q.close()
+        if self.separate_video:
+            self.reader.close()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    @staticmethod
+    def release_dropped(item):
+        '''A frame dropped on the way to the control stage goes back to the pool'''
+        frame = item[2]
+        if frame is not None:
+            frame.release()
+
+    def watch_connection(self):
+        '''With UDP or shared memory video the client closing the TCP connection ends the stream'''
+        try:
+            while self.connection.recv(4096):
+                pass
+        except OSError:
+            pass
+        self.stop()
+
     def run(self):
-        stream_bytes = b' '
-        cv2.namedWindow("video feed", cv2.WINDOW_KEEPRATIO)
+        reader = self.reader
+        stages = [Thread(target=self.decode_stage, name='decode')]
+        if self.separate_video:
+            stages.append(Thread(target=self.watch_connection, name='watch', daemon=True))
+        if self.model is not None or self.ps4 is not None:
+            stages.append(Thread(target=self.control_stage, name='control'))
+        for t in stages:
+            t.start()
+        if self.display is not None:
+            self.display.start()
+        if self.recorder is not None:
+            self.recorder.start()
+        if self.metrics_registry is not None:
+            self.metrics_registry.add(self.metrics)
 
         # stream video frames one by one
         try:
             print("Video thread started")
             frame_num = 0
-            i = 0
-            while True:
-                i += 1
-                stream_bytes += self.connection.recv(1024)
-                first = stream_bytes.find(b'\xff\xd8')
-                last = stream_bytes.find(b'\xff\xd9')
-                if first != -1 and last != -1:
-                    jpg = stream_bytes[first:last + 2]
-                    stream_bytes = stream_bytes[last + 2:]
-                    image = cv2.imdecode(np.fromstring(jpg, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
-                    frame_num += 1
-                    cv2.imshow("video feed", image)
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        break
-                    if self.model is not None:
-                        print(f"im shape {image.shape} {image.dtype}")
-                        steering, throttle = self.model.run(image)
-                        print(f"steering {steering} throtle {throttle}")
-                        message = f'{steering}, {throttle}'
-                        self.connection.send(message.encode())
-                    if self.ps4 is not None:
-                        os.system('clear')
-                        steering, throttle = next(self.ps4_events)
-                        print(f"steering {steering} throttle {throttle}")
-                        message = f'{steering}, {throttle}'
-                        self.connection.send(message.encode())
-
-            cv2.destroyAllWindows()
+            while not self.stop_event.is_set():
+                try:
+                    frames = reader.read_frames()
+                except OSError:
+                    break
+                if frames is None:
+                    break
+                frame_num = reader.last_frame_id
+                self.metrics.received(len(frames), sum(memoryview(f).nbytes for f in frames))
+                self.tracer.mark(frame_num, RECEIVE)
+                # the receive buffer is reused by the next recv, so the newest
+                # frame is copied once to hand it over to the decode stage
+                frame = frames[-1]
+                if isinstance(frame, memoryview):
+                    frame = bytes(frame)
+                self.decode_queue.put((frame_num, frame))
+                self.stats.maybe_report()
 
         finally:
+            self.stop()
+            for t in stages:
+                t.join()
+            if self.own_ps4:
+                self.ps4.stop()
+            if self.display is not None:
+                self.display.stop()
+                self.display.join()
+            if self.recorder is not None:
+                self.recorder.stop()
+                self.recorder.join()
+                print(f"Recorded {self.recorder.stats()}")
             self.connection.close()
+            if self.separate_video:
+                print(reader.summary())
+            self.tracer.close()
+            print(self.tracer.summary())
+            print(self.pool.summary())
+            if self.metrics_registry is not None:
+                self.metrics_registry.closed(self.metrics)
             print("Connection closed on thread 1")
 
+    def decode_stage(self):
+        while True:
+            item = self.decode_queue.get()
+            if item is None:
+                break
+            frame_num, jpg = item
+            start = time.time()
+            if isinstance(jpg, np.ndarray):
+                # raw frame from the shared memory ring, nothing to decode
+                frame, jpg = self.pool.wrap(jpg), None
+            else:
+                frame = self.pool.decode(jpg, cv2.IMREAD_UNCHANGED)
+            decoded_at = time.time()
+            self.metrics.decoded(decoded_at - start, frame is not None)
+            self.tracer.mark(frame_num, DECODE, decoded_at)
+            if frame is not None and self.display is not None:
+                self.display.show("video feed", frame.retain().array, frame.release)
+            # a frame that fails to decode still goes to the control stage: the
+            # controller does not need it and the model stops the car for it
+            if self.model is not None or self.ps4 is not None:
+                # the JPEG goes along for the recorder, the control stage releases the frame
+                if not self.control_queue.put((frame_num, jpg, frame)) and frame is not None:
+                    frame.release()
+            else:
+                self.tracer.finish(frame_num)
+                if frame is not None:
+                    frame.release()
+
+    def control_stage(self):
+        if isinstance(self.model, Future):
+            try:
+                self.model = self.model.result()
+            except Exception as e:
+                print(f"Could not load the model: {e}")
+                self.stop()
+                return
+        first_command = True
+        while True:
+            item = self.control_queue.get()
+            if item is None:
+                break
+            frame_num, jpg, frame = item
+            image = frame.array if frame is not None else None
+            start = time.time()
+            self.tracer.mark(frame_num, INFER_START, start)
+            if self.model is not None:
+                steering, throttle = self.model.run(image)
+            else:
+                steering, throttle = self.ps4.read()
+            sent_at = time.time()
+            self.tracer.mark(frame_num, INFER_END, sent_at)
+            self.metrics.command_sent(sent_at - start)
+            packet = self.encoder.pack(frame_num, steering, throttle, timestamp=sent_at,
+                                       received_at=self.tracer.get(frame_num, RECEIVE))
+            if self.feedback_interval:
+                packet += self.feedback_packet(sent_at)
+            try:
+                self.connection.sendall(packet)
+            except OSError:
+                self.stop()
+                break
+            self.tracer.mark(frame_num, COMMAND_SEND, sent_at)
+            if self.recorder is not None:
+                if jpg is None:
+                    # raw frames from shared memory are only encoded for the recorder
+                    jpg = cv2.imencode('.jpg', image)[1]
+                self.recorder.add(frame_num, jpg, self.tracer.get(frame_num, RECEIVE), sent_at, steering, throttle)
+            if frame is not None:
+                frame.release()
+            self.tracer.finish(frame_num)
+            if first_command:
+                first_command = False
+                print(f"Startup: first command sent {sent_at - START_TIME:.2f} s after the server started")
+            if self.status.due(sent_at):
+                shape = f"{image.shape} " if image is not None else ""
+                self.status.show(f"frame {frame_num} {shape}steering {steering:+.2f} throttle {throttle:+.2f}")
+        self.status.close()
+
+    def feedback_packet(self, now):
+        '''
+        A feedback packet with the rates and mean times since the previous one,
+        or b'' if it is not time for one yet
+        '''
+        m = self.metrics
+        counters = (now, m.frames_received, m.frames_decoded, m.decode.total, m.commands_sent, m.infer.total)
+        if self.feedback_snapshot is None:
+            self.feedback_snapshot = counters
+            return b''
+        if now - self.feedback_snapshot[0] < self.feedback_interval:
+            return b''
+        elapsed, received, decoded, decode_time, commands, infer_time = (
+            a - b for a, b in zip(counters, self.feedback_snapshot))
+        self.feedback_snapshot = counters
+        receive_fps = received / elapsed
+        decode_ms = decode_time / decoded * 1000 if decoded else 0.0
+        infer_ms = infer_time / commands * 1000 if commands else 0.0
+        drop_rate = max(0.0, 1.0 - commands / received) if received else 0.0
+        return self.encoder.pack_feedback(m.frames_received, receive_fps, decode_ms, infer_ms, drop_rate,
+                                          timestamp=now)
 
-def start_multihreaded_server(server_host, port, model_path="", PS4_server=False):
+
+def start_multihreaded_server(server_host, port, model_path="", PS4_server=False, transport='tcp',
+                              metrics_port=0, metrics_host='127.0.0.1', **options):
 
     TCP_IP = server_host
     TCP_PORT = port
@@ -105,16 +326,49 @@ def start_multihreaded_server(server_host, port, model_path="", PS4_server=False
     tcpServer.bind((TCP_IP, TCP_PORT))
     threads = []
 
+    # UDP video arrives on the same port number
+    if transport == 'udp':
+        udpServer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # room for bursts of datagrams while the receive stage is busy
+        udpServer.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        udpServer.bind((TCP_IP, TCP_PORT))
+        options['video_socket'] = udpServer
+    ring = None
+    if transport == 'shm':
+        from shm_video import SharedFrameRing, ring_name
+        ring = SharedFrameRing(ring_name(TCP_PORT), create=True)
+        options['video_ring'] = ring
+
+    # the model loads while waiting for the car
+    model = None
+    loader = ThreadPoolExecutor(max_workers=1)
+    if model_path != '':
+        from keras_pilot import load_pilot
+        model = loader.submit(load_pilot, model_path)
+    loader.shutdown(wait=False)
+
+    metrics_server = None
+    if metrics_port:
+        registry = MetricsRegistry()
+        metrics_server = MetricsServer(registry, metrics_host, metrics_port)
+        metrics_server.start()
+        options['metrics_registry'] = registry
+        print(f"Metrics on http://{metrics_host}:{metrics_port}/metrics")
+
     # Video connection
     tcpServer.listen(4)
     print(f"Python server: on {server_host}:{port} Waiting for Video connection from TCP clients...")
     (conn, (ip, port)) = tcpServer.accept()
-    newthread = VideoClientThread(ip, port, conn, model_path=model_path, send_ps4=PS4_server)
+    newthread = VideoClientThread(ip, port, conn, send_ps4=PS4_server, model=model, **options)
     newthread.start()
     threads.append(newthread)
 
     for t in threads:
         t.join()
+    if ring is not None:
+        ring.release()
+    if metrics_server is not None:
+        metrics_server.stop()
 
 
 if __name__ == '__main__':
@@ -136,15 +390,77 @@ if __name__ == '__main__':
                         default='0.0.0.0',
                         help='destination host name or ip',
                         required=False)
+    parser.add_argument('--handoff', type=str,
+                        dest='handoff',
+                        default='latest',
+                        choices=['latest', 'fifo'],
+                        help='queues between stages: keep only the newest frames (latest) '
+                             'or block until the next stage catches up (fifo)',
+                        required=False)
+    parser.add_argument('--queue-size', type=int,
+                        dest='queue_size',
+                        default=1,
+                        help='number of frames each queue between stages can hold',
+                        required=False)
+    parser.add_argument('--display', type=parse_display,
+                        dest='display',
+                        default='full',
+                        help=f'video window: {DISPLAY_CHOICES}',
+                        required=False)
+    parser.add_argument('--trace', type=str,
+                        dest='trace_path',
+                        default='',
+                        help='binary log file for the per-frame stage timestamps (see latency_trace.py)',
+                        required=False)
+    parser.add_argument('--feedback-interval', type=float,
+                        dest='feedback_interval',
+                        default=1.0,
+                        help='seconds between the feedback packets the car adapts its video to, 0 to send none',
+                        required=False)
+    parser.add_argument('--transport', type=str,
+                        dest='transport',
+                        default='tcp',
+                        choices=['tcp', 'udp', 'shm'],
+                        help='video over TCP, UDP where frames that lose a datagram are dropped, or '
+                             'shared memory for a client on this machine (the client must use the same)',
+                        required=False)
+    parser.add_argument('--udp-timeout', type=float,
+                        dest='udp_timeout',
+                        default=0.1,
+                        help='with --transport udp: seconds to wait for the missing datagrams of a frame',
+                        required=False)
+    parser.add_argument('--record', type=str,
+                        dest='record_dir',
+                        default='',
+                        help='save every frame with the command sent for it in a session folder of this '
+                             'directory (see session_recorder.py)',
+                        required=False)
+    parser.add_argument('--metrics-port', type=int,
+                        dest='metrics_port',
+                        default=0,
+                        help=f'serve live metrics as JSON over HTTP on this port, e.g. {METRICS_PORT} (0: off)',
+                        required=False)
+    parser.add_argument('--metrics-host', type=str,
+                        dest='metrics_host',
+                        default='127.0.0.1',
+                        help='address of the metrics server, 0.0.0.0 to read them from another machine',
+                        required=False)
     args = vars(parser.parse_args())
+    if args['queue_size'] < 1:
+        parser.error("--queue-size must be at least 1")
 
     server_host = args['host']
     port = args['port']
+    options = dict(keep_latest=args['handoff'] == 'latest', queue_size=args['queue_size'],
+                   trace_path=args['trace_path'], display_fps=args['display'],
+                   record_dir=args['record_dir'], feedback_interval=args['feedback_interval'],
+                   transport=args['transport'], udp_timeout=args['udp_timeout'],
+                   metrics_port=args['metrics_port'], metrics_host=args['metrics_host'])
 
     if args['mode'] == "autopilot":
         model_path = './models/pilot_home_day_cat_aug.h5'
-        start_multihreaded_server(server_host, port, model_path=model_path, PS4_server=False)
+        start_multihreaded_server(server_host, port, model_path=model_path, PS4_server=False, **options)
     if args['mode'] == "manual":
-        start_multihreaded_server(server_host, port, model_path="", PS4_server=True)
+        start_multihreaded_server(server_host, port, model_path="", PS4_server=True, **options)
     if args['mode'] == "video-only":
-        start_multihreaded_server(server_host, port, model_path="", PS4_server=False)
+        start_multihreaded_server(server_host, port, model_path="", PS4_server=False, **options)
@@ -0,0 +1,368 @@
+# ###################################################################
+#
+# File:        run_server_async.py
+# Description: asyncio version of run_server.py that can drive several cars
+#              at the same time. It accepts any number of video connections
+#              and keeps accepting new ones after a car disconnects.
+#              The sockets are handled by the event loop, JPEG decoding runs in
+#              a thread pool and the keras model in a single inference thread
+#              that batches the frames of all cars (see inference_scheduler.py),
+#              so the event loop never blocks on CPU-bound work.
+#              With --workers N decoding and the model run in N worker
+#              processes instead (see worker_pool.py), each with its own
+#              model, for more cars than one process can take under the GIL.
+#              With --metrics-port the counters of every car can be read live
+#              over HTTP (see metrics.py).
+#              The model loads in the background while cars can already connect.
+#              Modes are the same as in run_server.py:
+#                  autopilot mode: every car is driven by the keras model
+#                  manual mode: every car is driven by the PS4 controller
+#                  video-only mode: the video of every car is only displayed
+# ###################################################################
+
+import time
+# taken before the slow imports, for the startup time report
+START_TIME = time.time()
+import asyncio
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+from display import DisplayThread, parse_display, DISPLAY_CHOICES
+from inference_scheduler import BatchInferenceScheduler
+from worker_pool import parse_affinity
+from metrics import ConnectionMetrics, MetricsRegistry, MetricsServer, METRICS_PORT
+from video_stream import FrameReader
+from control_protocol import ControlPacketEncoder
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+
+class ConnectionStats(object):
+    """Throughput and latency counters of one car connection"""
+
+    def __init__(self, name):
+        self.name = name
+        self.connected_at = time.time()
+        self.frames = 0
+        self.frames_skipped = 0
+        self.bytes = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.last_frames = 0
+        self.last_bytes = 0
+        self.last_latency_sum = 0.0
+        self.last_report = time.time()
+
+    def add_frame(self, latency):
+        self.frames += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def report(self):
+        """Return a one line summary since the previous report and reset the interval"""
+        now = time.time()
+        elapsed = max(now - self.last_report, 1e-6)
+        frames = self.frames - self.last_frames
+        fps = frames / elapsed
+        kbps = (self.bytes - self.last_bytes) / elapsed / 1024
+        latency = (self.latency_sum - self.last_latency_sum) / frames * 1000 if frames else 0.0
+        line = (f"{self.name}: {fps:.1f} fps {kbps:.1f} KB/s latency {latency:.1f} ms "
+                f"(max {self.latency_max * 1000:.1f} ms) skipped {self.frames_skipped}")
+        self.last_frames = self.frames
+        self.last_bytes = self.bytes
+        self.last_latency_sum = self.latency_sum
+        self.latency_max = 0.0
+        self.last_report = now
+        return line
+
+
+class CarProtocol(asyncio.BufferedProtocol):
+    """Protocol handling one car: receives frames and sends back the commands
+
+    Frames are received straight into the FrameReader buffer. While a frame
+    is decoded and processed, reading is paused, so the memoryview handed to
+    the decoder stays valid and is never copied. Frames that arrive together
+    are skipped except for the newest one.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.reader = FrameReader()
+        self.encoder = ControlPacketEncoder()
+        self.transport = None
+        self.stats = None
+        self.metrics = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        ip, port = transport.get_extra_info('peername')[:2]
+        self.stats = ConnectionStats(f"{ip}:{port}")
+        self.metrics = ConnectionMetrics(self.stats.name)
+        if self.server.metrics is not None:
+            self.server.metrics.add(self.metrics)
+        self.server.connections.add(self)
+        print(f"[+] New car connection from {ip}:{port}")
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        if self.server.metrics is not None:
+            self.server.metrics.closed(self.metrics)
+        print(f"[-] Connection closed for {self.stats.name}: {self.stats.frames} frames")
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.reader.buffer_updated(nbytes)
+        self.stats.bytes += nbytes
+        frames = self.reader.parse_frames()
+        if frames:
+            self.metrics.received(len(frames), sum(frame.nbytes for frame in frames))
+            self.stats.frames_skipped += len(frames) - 1
+            self.transport.pause_reading()
+            frame_id = self.reader.frames_received
+            asyncio.ensure_future(self.process(frames[-1], frame_id, time.time()))
+        if self.reader.closed:
+            self.transport.close()
+
+    async def process(self, jpg, frame_id, received_at):
+        try:
+            command = await self.server.process_frame(self.stats.name, jpg, self.metrics)
+            if command is not None and not self.transport.is_closing():
+                steering, throttle = command
+                self.transport.write(self.encoder.pack(frame_id, steering, throttle, received_at=received_at))
+                self.server.command_sent()
+            self.stats.add_frame(time.time() - received_at)
+        except (Exception, asyncio.CancelledError) as e:
+            # nobody awaits this task, report the error here and go on with the next frame.
+            # CancelledError is not an Exception since Python 3.8, the scheduler cancels
+            # the frames waiting when the model could not be loaded
+            print(f"[!] Frame {frame_id} of {self.stats.name} failed: {e!r}")
+        finally:
+            if not self.transport.is_closing():
+                self.transport.resume_reading()
+
+
+class AsyncVideoServer(object):
+    """Accepts car connections and shares one model or PS4 controller between them"""
+
+    def __init__(self, model_path='', send_ps4=False, decode_workers=2, display_fps=0.0,
+                 stats_interval=5.0, batch_size=8, batch_deadline_us=1000, workers=0, affinity=None,
+                 metrics_port=0, metrics_host='127.0.0.1'):
+        self.model = None
+        self.scheduler = None
+        self.workers = None
+        self.ps4 = None
+        self.connections = set()
+        self.stats_interval = stats_interval
+        self.decode_executor = ThreadPoolExecutor(max_workers=decode_workers)
+        # a single thread loads the model
+        self.control_executor = ThreadPoolExecutor(max_workers=1)
+        self.display_fps = display_fps
+        self.display = None
+        self.stopped = None
+        self.first_command = True
+        self.metrics = None
+        self.metrics_server = None
+        if metrics_port:
+            self.metrics = MetricsRegistry()
+            self.metrics_server = MetricsServer(self.metrics, metrics_host, metrics_port)
+        if send_ps4:
+            from PS4Controller import PS4Controller
+            self.ps4 = PS4Controller().start()
+
+        if workers > 0:
+            from worker_pool import WorkerPool
+            # every worker loads the model, frames wait in the pool until then
+            self.workers = WorkerPool(model_path, workers=workers, affinity=affinity)
+            self.workers.start()
+        elif model_path != '':
+            from keras_pilot import load_pilot
+            # the scheduler starts batching once the model is loaded, frames wait until then
+            self.model = self.control_executor.submit(load_pilot, model_path)
+            self.scheduler = BatchInferenceScheduler(self.model, max_batch=batch_size,
+                                                     deadline_us=batch_deadline_us)
+            self.scheduler.start()
+
+    def command_sent(self):
+        if self.first_command:
+            self.first_command = False
+            print(f"Startup: first command sent {time.time() - START_TIME:.2f} s after the server started")
+
+    @staticmethod
+    def decode(jpg, metrics):
+        start = time.perf_counter()
+        image = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        metrics.decoded(time.perf_counter() - start, image is not None)
+        return image
+
+    async def process_frame(self, name, jpg, metrics):
+        """Decode a frame and compute the command for it. Returns None in video-only mode"""
+        loop = asyncio.get_running_loop()
+        if self.workers is not None:
+            # decoding and the model in a worker process, timed together as the inference,
+            # the decode time measured by the worker feeds the decode histogram
+            start = time.perf_counter()
+            command, frame, decoded, decode_ms = await asyncio.wrap_future(
+                self.workers.submit(jpg, self.display is not None))
+            metrics.decoded(decode_ms / 1000, decoded)
+            if frame is not None:
+                # the display shows it from its shared memory slot, then frees the slot
+                self.display.show(name, frame.array, frame.release)
+        else:
+            image = await loop.run_in_executor(self.decode_executor, self.decode, jpg, metrics)
+            if image is not None and self.display is not None:
+                self.display.show(name, image)
+            start = time.perf_counter()
+            command = None
+            if self.scheduler is not None:
+                command = await asyncio.wrap_future(self.scheduler.submit(image))
+        if self.ps4 is not None:
+            # the controller thread keeps the newest state, reading it never blocks the event loop
+            command = self.ps4.read()
+        if command is not None:
+            metrics.command_sent(time.perf_counter() - start)
+        return command
+
+    async def report_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            for connection in list(self.connections):
+                print(connection.stats.report())
+            if self.scheduler is not None and self.connections:
+                print("inference batches: " + ", ".join(f"{k} {v:.4g}" for k, v in self.scheduler.stats().items()))
+            if self.workers is not None and self.connections:
+                print(self.workers.summary())
+
+    async def serve(self, host, port):
+        loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        server = await loop.create_server(lambda: CarProtocol(self), host, port, reuse_address=True)
+        print(f"Python server: on {host}:{port} Waiting for Video connections from TCP clients...")
+        if self.display_fps is not None:
+            self.display = DisplayThread(self.display_fps,
+                                         on_quit=lambda: loop.call_soon_threadsafe(self.stopped.set))
+            self.display.start()
+        if self.metrics_server is not None:
+            for name, source in [('display', self.display), ('inference_batches', self.scheduler),
+                                 ('workers', self.workers)]:
+                if source is not None:
+                    self.metrics.register(name, source)
+            self.metrics_server.start()
+            host, port = self.metrics_server.address[:2]
+            print(f"Metrics on http://{host}:{port}/metrics")
+        stats_task = asyncio.ensure_future(self.report_stats())
+        try:
+            await self.stopped.wait()
+        finally:
+            stats_task.cancel()
+            server.close()
+            for connection in list(self.connections):
+                connection.transport.close()
+            await server.wait_closed()
+            if self.display is not None:
+                self.display.stop()
+                self.display.join()
+            if self.scheduler is not None:
+                self.scheduler.stop()
+            if self.ps4 is not None:
+                self.ps4.stop()
+            if self.workers is not None:
+                self.workers.stop()
+                print(self.workers.summary())
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+            self.decode_executor.shutdown()
+            self.control_executor.shutdown()
+
+
+def start_async_server(server_host, port, model_path="", PS4_server=False, decode_workers=2,
+                       display_fps=0.0, batch_size=8, batch_deadline_us=1000, workers=0, affinity=None,
+                       metrics_port=0, metrics_host='127.0.0.1'):
+    server = AsyncVideoServer(model_path=model_path, send_ps4=PS4_server,
+                              decode_workers=decode_workers, display_fps=display_fps,
+                              batch_size=batch_size, batch_deadline_us=batch_deadline_us,
+                              workers=workers, affinity=affinity,
+                              metrics_port=metrics_port, metrics_host=metrics_host)
+    try:
+        asyncio.run(server.serve(server_host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('--mode', type=str,
+                        dest='mode',
+                        default='video-only',
+                        choices=['autopilot',  'manual', 'video-only'],
+                        help='execution mode: (autopilot | manual | video-only)',
+                        required=False)
+    parser.add_argument('--port', type=int,
+                        dest='port',
+                        default=8887,
+                        help='socket port',
+                        required=False)
+    parser.add_argument('--host', type=str,
+                        dest='host',
+                        default='0.0.0.0',
+                        help='destination host name or ip',
+                        required=False)
+    parser.add_argument('--decode-workers', type=int,
+                        dest='decode_workers',
+                        default=2,
+                        help='number of threads decoding JPEG frames',
+                        required=False)
+    parser.add_argument('--display', type=parse_display,
+                        dest='display',
+                        default='full',
+                        help=f'one video window per car: {DISPLAY_CHOICES}',
+                        required=False)
+    parser.add_argument('--batch-size', type=int,
+                        dest='batch_size',
+                        default=8,
+                        help='autopilot: maximum number of frames (from all cars) per model forward pass',
+                        required=False)
+    parser.add_argument('--batch-deadline-us', type=int,
+                        dest='batch_deadline_us',
+                        default=1000,
+                        help='autopilot: microseconds to wait for a batch to fill up before running it',
+                        required=False)
+    parser.add_argument('--workers', type=int,
+                        dest='workers',
+                        default=0,
+                        help='worker processes decoding the frames and running the model (0: threads of this process)',
+                        required=False)
+    parser.add_argument('--affinity', type=parse_affinity,
+                        dest='affinity',
+                        default='',
+                        help='with --workers: pin the workers to CPUs, auto or a comma separated list of CPUs',
+                        required=False)
+    parser.add_argument('--metrics-port', type=int,
+                        dest='metrics_port',
+                        default=0,
+                        help=f'serve live metrics as JSON over HTTP on this port, e.g. {METRICS_PORT} (0: off)',
+                        required=False)
+    parser.add_argument('--metrics-host', type=str,
+                        dest='metrics_host',
+                        default='127.0.0.1',
+                        help='address of the metrics server, 0.0.0.0 to read them from another machine',
+                        required=False)
+    args = vars(parser.parse_args())
+
+    server_host = args['host']
+    port = args['port']
+    options = dict(decode_workers=args['decode_workers'], display_fps=args['display'],
+                   batch_size=args['batch_size'], batch_deadline_us=args['batch_deadline_us'],
+                   workers=args['workers'], affinity=args['affinity'],
+                   metrics_port=args['metrics_port'], metrics_host=args['metrics_host'])
+
+    if args['mode'] == "autopilot":
+        model_path = './models/pilot_home_day_cat_aug.h5'
+        start_async_server(server_host, port, model_path=model_path, PS4_server=False, **options)
+    if args['mode'] == "manual":
+        start_async_server(server_host, port, model_path="", PS4_server=True, **options)
+    if args['mode'] == "video-only":
+        start_async_server(server_host, port, model_path="", PS4_server=False, **options)
@@ -15,11 +15,14 @@
 # ###################################################################
 
 import cv2
-import os
+import time
 import numpy as np
 import socket
 from argparse import ArgumentParser
 from PS4Controller import PS4Controller
+from video_stream import FrameReader
+from control_protocol import ControlPacketEncoder
+from pipeline import ConsoleStatus
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
@@ -33,62 +36,61 @@ class VideoClient():
         self.connection = connection
         self.model = None
         self.ps4 = None
+        self.encoder = ControlPacketEncoder()
+        self.status = ConsoleStatus()
         if send_ps4:
-            self.ps4 = PS4Controller()
-            self.ps4_events = self.ps4.generate_event()
+            self.ps4 = PS4Controller().start()
 
 
         if model_path != '':
-            from keras_pilot import KerasLinear
-            from keras_pilot import KerasCategorical
-            IMAGE_W = 160
-            IMAGE_H = 120
-            input_shape = (IMAGE_H, IMAGE_W, 3)
-            roi_crop = (0, 0)
-            # self.model = KerasLinear(input_shape=input_shape, roi_crop=roi_crop)
-            # Categorical model seems to work better
-            self.model = KerasCategorical(input_shape=input_shape, roi_crop=roi_crop)
-            self.model.load(model_path)
+            from keras_pilot import load_pilot
+            self.model = load_pilot(model_path)
         print("[+] New server socket thread started for " + ip + ":" + str(port))
 
     def run(self):
-        stream_bytes = b' '
+        reader = FrameReader(self.connection)
         cv2.namedWindow("video feed", cv2.WINDOW_KEEPRATIO)
 
         # stream video frames one by one
         try:
             print("Video thread started")
             frame_num = 0
-            i = 0
             while True:
-                i += 1
-                stream_bytes += self.connection.recv(1024)
-                first = stream_bytes.find(b'\xff\xd8')
-                last = stream_bytes.find(b'\xff\xd9')
-                if first != -1 and last != -1:
-                    jpg = stream_bytes[first:last + 2]
-                    stream_bytes = stream_bytes[last + 2:]
-                    image = cv2.imdecode(np.fromstring(jpg, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
-                    frame_num += 1
+                frames = reader.read_frames()
+                if frames is None:
+                    break
+                received_at = time.time()
+                # when several frames are buffered only the newest one is worth
+                # processing, the others are already stale
+                jpg = frames[-1]
+                image = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+                frame_num += len(frames)
+                # a frame that fails to decode still gets a command: the controller
+                # does not need it and the model stops the car for it
+                if image is not None:
                     cv2.imshow("video feed", image)
-                    if cv2.waitKey(1) & 0xFF == ord('q'):
-                        break
-                    if self.model is not None:
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+                if self.model is not None:
+                    if image is not None:
                         print(f"im shape {image.shape} {image.dtype}")
-                        steering, throttle = self.model.run(image)
-                        print(f"steering {steering} throtle {throttle}")
-                        message = f'{steering}, {throttle}'
-                        self.connection.send(message.encode())
-                    if self.ps4 is not None:
-                        os.system('clear')
-                        steering, throttle = next(self.ps4_events)
-                        print(f"steering {steering} throttle {throttle}")
-                        message = f'{steering}, {throttle}'
-                        self.connection.send(message.encode())
+                    steering, throttle = self.model.run(image)
+                    print(f"steering {steering} throtle {throttle}")
+                    self.connection.sendall(self.encoder.pack(frame_num, steering, throttle,
+                                                              received_at=received_at))
+                if self.ps4 is not None:
+                    steering, throttle = self.ps4.read()
+                    self.connection.sendall(self.encoder.pack(frame_num, steering, throttle,
+                                                              received_at=received_at))
+                    if self.status.due():
+                        self.status.show(f"frame {frame_num} steering {steering:+.2f} throttle {throttle:+.2f}")
 
             cv2.destroyAllWindows()
 
         finally:
+            self.status.close()
+            if self.ps4 is not None:
+                self.ps4.stop()
             self.connection.close()
             print("Connection closed on thread 1")
 
@@ -0,0 +1,209 @@
+# ###################################################################
+#
+# File:        session_recorder.py
+# Description: Records a driving session on the server to build training
+#              data: every frame that gets a command is saved with the
+#              steering and throttle sent back for it.
+#              The received JPEG bytes are appended as they are, no decode
+#              or re-encode, to segment files (segment_00000.mjpeg, ...)
+#              that rotate when they reach segment_size bytes. index.bin has
+#              one fixed size record per frame:
+#                  frame_id    uint32
+#                  segment     uint32
+#                  offset      uint64  position of the JPEG in the segment
+#                  length      uint32
+#                  received_at float64 server time the frame was received
+#                  sent_at     float64 server time the command was sent
+#                  steering    float32
+#                  throttle    float32
+#              Frames are handed over to a background thread that writes
+#              them in batches with one writev per file, so the server
+#              stages never wait for the disk.
+#              Running this file lists a session or exports it as a tub:
+#                  python session_recorder.py sessions/session_20200320_101500 --tub tub_dir
+# ###################################################################
+
+import os
+import json
+import time
+import numpy as np
+from threading import Thread
+from argparse import ArgumentParser
+from pipeline import StageQueue
+
+INDEX_DTYPE = np.dtype([('frame_id', '<u4'), ('segment', '<u4'), ('offset', '<u8'), ('length', '<u4'),
+                        ('received_at', '<f8'), ('sent_at', '<f8'), ('steering', '<f4'), ('throttle', '<f4')])
+INDEX_FILE = 'index.bin'
+
+
+def segment_name(segment):
+    return f"segment_{segment:05d}.mjpeg"
+
+
+class SessionRecorder(Thread):
+    '''
+    Writes the frames given to add() into a new session_<date>_<time> folder of root.
+    If the disk can't keep up the queue fills up and frames are dropped
+    (counted in dropped), add() never blocks
+    '''
+
+    def __init__(self, root, segment_size=64 << 20, batch_size=64, queue_size=1024):
+        Thread.__init__(self, daemon=True)
+        self.directory = os.path.join(root, time.strftime('session_%Y%m%d_%H%M%S'))
+        os.makedirs(self.directory, exist_ok=True)
+        self.segment_size = segment_size
+        self.batch_size = batch_size
+        self.queue = StageQueue('recorder', queue_size, keep_latest=False)
+        self.index = open(os.path.join(self.directory, INDEX_FILE), 'ab', buffering=0)
+        self.segment = -1
+        self.segment_file = None
+        self.segment_bytes = 0
+        self.frames = 0
+        self.bytes = 0
+        self.dropped = 0
+
+    def add(self, frame_id, jpg, received_at, sent_at, steering, throttle):
+        if not self.queue.put((frame_id, jpg, received_at, sent_at, steering, throttle), timeout=0):
+            self.dropped += 1
+
+    def stop(self):
+        '''Pending frames are still written'''
+        self.queue.close()
+
+    def run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    item = self.queue.get(timeout=0)
+                    if item is None:
+                        break
+                    batch.append(item)
+                self.write(batch)
+        finally:
+            if self.segment_file is not None:
+                self.segment_file.close()
+            self.index.close()
+
+    def write(self, batch):
+        buffers = []
+        records = np.zeros(len(batch), dtype=INDEX_DTYPE)
+        for i, (frame_id, jpg, received_at, sent_at, steering, throttle) in enumerate(batch):
+            if self.segment_file is None or (self.segment_bytes and
+                                             self.segment_bytes + len(jpg) > self.segment_size):
+                self._write_segment(buffers)
+                buffers = []
+                self._rotate()
+            records[i] = (frame_id, self.segment, self.segment_bytes, len(jpg), received_at, sent_at,
+                          steering, throttle)
+            buffers.append(jpg)
+            self.segment_bytes += len(jpg)
+            self.bytes += len(jpg)
+        self._write_segment(buffers)
+        # the index is written after the frames it points to
+        os.write(self.index.fileno(), records.tobytes())
+        self.frames += len(batch)
+
+    def _write_segment(self, buffers):
+        if not buffers:
+            return
+        # os.writev can write less than asked for, e.g. when interrupted
+        total = sum(len(b) for b in buffers)
+        written = os.writev(self.segment_file.fileno(), buffers)
+        if written < total:
+            self.segment_file.write(b''.join(buffers)[written:])
+
+    def _rotate(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.segment += 1
+        self.segment_bytes = 0
+        self.segment_file = open(os.path.join(self.directory, segment_name(self.segment)), 'ab', buffering=0)
+
+    def stats(self):
+        return {'frames': self.frames, 'bytes': self.bytes, 'segments': self.segment + 1,
+                'dropped': self.dropped, 'queued': self.queue.depth()}
+
+
+class SessionReader(object):
+    '''
+    Random access to a recorded session: reader.jpg(frame_id) returns the
+    JPEG bytes of that frame, reader.index holds every record as a numpy array
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILE), 'rb') as f:
+            data = f.read()
+        # a record cut by a crash at the end of the file is ignored
+        self.index = np.frombuffer(data[:len(data) - len(data) % INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+        self.files = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def find(self, frame_id):
+        '''Position of frame_id in the index, frame ids are increasing'''
+        i = int(np.searchsorted(self.index['frame_id'], frame_id))
+        if i == len(self.index) or self.index['frame_id'][i] != frame_id:
+            raise KeyError(f"frame {frame_id} is not in {self.directory}")
+        return i
+
+    def jpg(self, frame_id):
+        return self.read(self.find(frame_id))
+
+    def read(self, i):
+        '''JPEG bytes of the i-th recorded frame'''
+        record = self.index[i]
+        segment = int(record['segment'])
+        if segment not in self.files:
+            self.files[segment] = open(os.path.join(self.directory, segment_name(segment)), 'rb')
+        f = self.files[segment]
+        f.seek(int(record['offset']))
+        return f.read(int(record['length']))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+
+def export_tub(reader, tub_dir):
+    '''Write the session as a donkey tub, see tub_dataset.py'''
+    os.makedirs(tub_dir, exist_ok=True)
+    start = reader.index['received_at'][0] if len(reader) else 0.0
+    for i, record in enumerate(reader.index):
+        num = int(record['frame_id'])
+        name = f"{num}_cam-image_array_.jpg"
+        with open(os.path.join(tub_dir, name), 'wb') as f:
+            f.write(reader.read(i))
+        with open(os.path.join(tub_dir, f"record_{num}.json"), 'w') as f:
+            json.dump({'cam/image_array': name, 'user/angle': float(record['steering']),
+                       'user/throttle': float(record['throttle']), 'user/mode': 'user',
+                       'milliseconds': int((record['received_at'] - start) * 1000)}, f)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('session', type=str, help='session folder written by the server with --record')
+    parser.add_argument('--tub', type=str,
+                        dest='tub',
+                        default='',
+                        help='export the session as a donkey tub in this folder',
+                        required=False)
+    args = vars(parser.parse_args())
+
+    reader = SessionReader(args['session'])
+    if len(reader):
+        index = reader.index
+        duration = index['received_at'][-1] - index['received_at'][0]
+        print(f"{len(reader)} frames, {index['length'].sum() / 1e6:.1f} MB, {duration:.1f} s, "
+              f"frames {index['frame_id'][0]} to {index['frame_id'][-1]}")
+    if args['tub']:
+        export_tub(reader, args['tub'])
+        print(f"Exported to {args['tub']}")
+    reader.close()
@@ -0,0 +1,217 @@
+# ###################################################################
+#
+# File:        shm_video.py
+# Description: Shared memory transport for the video stream, when the car
+#              side (run_client.py with the simulated camera, or
+#              tests/run_client_test.py) and the server run on the same
+#              machine. The frames skip the TCP loopback and the JPEG marker
+#              scan: the client writes each one into a ring of slots in a
+#              multiprocessing.shared_memory block, and the server copies
+#              the newest one out. Frames are JPEG bytes, or raw BGR arrays
+#              to skip the JPEG encoding and decoding altogether.
+#              Layout, all uint32 so that every counter is written at once:
+#                  ring header (16 words): magic, slots, slot_size, closed, write_seq
+#                  per slot: header (8 words): seq, kind, length, height, width, channels
+#                            followed by slot_size bytes of data
+#              The writer clears the seq of a slot, fills it, sets its seq to
+#              the frame id and then publishes write_seq. The reader copies
+#              the slot of write_seq and keeps the copy only if the slot seq
+#              is still the same afterwards, so the writer never waits.
+#              The TCP connection stays open for the commands.
+# ###################################################################
+
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+MAGIC = 0x5EC0CA25
+KIND_JPEG = 1
+KIND_BGR = 2
+RING_WORDS = 16
+SLOT_WORDS = 8
+SLOTS = 4
+SLOT_SIZE = 1024 * 1024
+# ring header words
+_SLOTS, _SLOT_SIZE, _CLOSED, _WRITE_SEQ = 1, 2, 3, 4
+# slot header words
+_SEQ, _KIND, _LENGTH, _HEIGHT, _WIDTH, _CHANNELS = 0, 1, 2, 3, 4, 5
+
+
+def ring_name(port):
+    '''Name of the ring of the server listening on port'''
+    return f"car_video_{port}"
+
+
+class SharedFrameRing(object):
+    '''
+    Ring of frame slots in shared memory. The server creates it (create=True)
+    and removes it in release(), the client attaches to it by name.
+    One process writes, one reads
+    '''
+
+    def __init__(self, name, create=False, slots=SLOTS, slot_size=SLOT_SIZE):
+        self.owner = create
+        if create:
+            size = 4 * RING_WORDS + slots * (4 * SLOT_WORDS + slot_size)
+            try:
+                self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+            except FileExistsError:
+                # left over by a server that did not exit cleanly
+                stale = shared_memory.SharedMemory(name)
+                stale.close()
+                stale.unlink()
+                self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name)
+            # only the creator removes the block, not the resource tracker of this process
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.header = np.ndarray((RING_WORDS,), dtype=np.uint32, buffer=self.shm.buf)
+        if create:
+            self.header[:] = 0
+            self.header[_SLOTS] = slots
+            self.header[_SLOT_SIZE] = slot_size
+            self.header[0] = MAGIC
+        elif self.header[0] != MAGIC:
+            raise ValueError(f"{name} is not a frame ring")
+        self.slots = int(self.header[_SLOTS])
+        self.slot_size = int(self.header[_SLOT_SIZE])
+        self.slot_headers = []
+        self.slot_data = []
+        offset = 4 * RING_WORDS
+        for _ in range(self.slots):
+            self.slot_headers.append(np.ndarray((SLOT_WORDS,), dtype=np.uint32, buffer=self.shm.buf, offset=offset))
+            offset += 4 * SLOT_WORDS
+            self.slot_data.append(np.ndarray((self.slot_size,), dtype=np.uint8, buffer=self.shm.buf, offset=offset))
+            offset += self.slot_size
+
+    def write(self, frame_id, frame):
+        '''
+        frame_id counts from 1. frame is a buffer of JPEG bytes (cv2.imencode
+        output too) or a height x width x channels uint8 image, copied once into the slot
+        '''
+        if isinstance(frame, np.ndarray) and frame.ndim == 3:
+            kind = KIND_BGR
+            height, width, channels = frame.shape
+            length = frame.nbytes
+        else:
+            kind = KIND_JPEG
+            frame = np.frombuffer(frame, dtype=np.uint8)
+            height = width = channels = 0
+            length = len(frame)
+        if length > self.slot_size:
+            raise ValueError(f"frame of {length} bytes does not fit in a slot of {self.slot_size}")
+        slot = frame_id % self.slots
+        header = self.slot_headers[slot]
+        header[_SEQ] = 0
+        if kind == KIND_BGR:
+            self.slot_data[slot][:length].reshape(frame.shape)[...] = frame
+        else:
+            self.slot_data[slot][:length] = frame
+        header[_KIND] = kind
+        header[_LENGTH] = length
+        header[_HEIGHT] = height
+        header[_WIDTH] = width
+        header[_CHANNELS] = channels
+        header[_SEQ] = frame_id
+        self.header[_WRITE_SEQ] = frame_id
+
+    def read(self, frame_id):
+        '''
+        Copy of the frame frame_id: bytearray of JPEG bytes or an image array.
+        None if the writer overwrote it meanwhile
+        '''
+        slot = frame_id % self.slots
+        header = self.slot_headers[slot]
+        if header[_SEQ] != frame_id:
+            return None
+        kind, length = int(header[_KIND]), int(header[_LENGTH])
+        if length > self.slot_size:
+            return None
+        if kind == KIND_BGR:
+            shape = (int(header[_HEIGHT]), int(header[_WIDTH]), int(header[_CHANNELS]))
+            if shape[0] * shape[1] * shape[2] != length:
+                return None
+            frame = self.slot_data[slot][:length].reshape(shape).copy()
+        else:
+            frame = bytearray(self.slot_data[slot][:length])
+        if header[_SEQ] != frame_id:
+            return None
+        return frame
+
+    @property
+    def write_seq(self):
+        return int(self.header[_WRITE_SEQ])
+
+    @property
+    def closed(self):
+        return bool(self.header[_CLOSED])
+
+    def close(self):
+        '''The writer ends the stream'''
+        self.header[_CLOSED] = 1
+
+    def release(self):
+        # numpy views must go before the shared memory can be closed
+        self.header = None
+        self.slot_headers = []
+        self.slot_data = []
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class ShmFrameReceiver(object):
+    """Reads the newest frames of a SharedFrameRing
+
+    Same use as video_stream.FrameReader: read_frames() waits for a new frame
+    and returns it in a list, or None at the end of the stream. There is no
+    wake up across processes, the ring is polled every poll_interval seconds.
+    Frames are copies, JPEG bytearrays or BGR arrays (kind of the newest one in
+    last_kind), and last_frame_id is the writer's frame id.
+    """
+
+    def __init__(self, ring, poll_interval=0.0005):
+        self.ring = ring
+        self.poll_interval = poll_interval
+        self.closed = False
+        self.last_frame_id = 0
+        self.last_kind = None
+        self.frames_read = 0
+        self.frames_skipped = 0
+        self.overwritten = 0
+        self.bytes_read = 0
+
+    def close(self):
+        '''Makes read_frames() return None, from any thread'''
+        self.closed = True
+
+    def read_frames(self):
+        while not self.closed:
+            frame_id = self.ring.write_seq
+            if frame_id > self.last_frame_id:
+                frame = self.ring.read(frame_id)
+                if frame is None:
+                    # the writer is already past it, try its newest frame
+                    self.overwritten += 1
+                    continue
+                if self.last_frame_id:
+                    self.frames_skipped += frame_id - self.last_frame_id - 1
+                self.last_frame_id = frame_id
+                self.last_kind = KIND_BGR if isinstance(frame, np.ndarray) else KIND_JPEG
+                self.frames_read += 1
+                self.bytes_read += len(frame) if self.last_kind == KIND_JPEG else frame.nbytes
+                return [frame]
+            if self.ring.closed:
+                return None
+            time.sleep(self.poll_interval)
+        return None
+
+    def stats(self):
+        return {'frames_read': self.frames_read, 'frames_skipped': self.frames_skipped,
+                'overwritten': self.overwritten, 'bytes': self.bytes_read}
+
+    def summary(self):
+        s = self.stats()
+        return (f"shm: {s['frames_read']} frames read, {s['frames_skipped']} skipped, "
+                f"{s['overwritten']} overwritten while copied, {s['bytes'] / 1e6:.1f} MB")
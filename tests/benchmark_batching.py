@@ -0,0 +1,117 @@
+# ###################################################################
+#
+# File:        benchmark_batching.py
+# Description: This script measures throughput versus latency of the batched
+#              inference scheduler (inference_scheduler.py) for batch sizes
+#              1 to 16. For every batch size, as many simulated cars as the
+#              batch size submit a frame, wait for its command and submit
+#              the next one, like cars connected to run_server_async.py do.
+#              Results are printed as a table and can be saved as CSV to plot
+#              the throughput-latency curve.
+#
+# ###################################################################
+
+import os
+import sys
+import csv
+import time
+import numpy as np
+from threading import Thread
+from argparse import ArgumentParser
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from keras_pilot import KerasCategorical
+from inference_scheduler import BatchInferenceScheduler
+
+IMAGE_W = 160
+IMAGE_H = 120
+
+
+def run_car(scheduler, image, stop_at, latencies):
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        scheduler.submit(image).result()
+        latencies.append(time.perf_counter() - start)
+
+
+def benchmark(pilot, batch_size, cars, deadline_us, duration):
+    scheduler = BatchInferenceScheduler(pilot, max_batch=batch_size, deadline_us=deadline_us)
+    scheduler.start()
+    image = np.random.randint(0, 255, (IMAGE_H, IMAGE_W, 3), dtype=np.uint8)
+    # warm up, the first forward pass for a new batch shape is slow
+    scheduler.predict(np.stack([image] * batch_size))
+    latencies = []
+    stop_at = time.perf_counter() + duration
+    threads = [Thread(target=run_car, args=(scheduler, image, stop_at, latencies)) for _ in range(cars)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    scheduler.stop()
+    scheduler.join()
+    latencies = np.array(latencies) * 1000
+    stats = scheduler.stats()
+    return {'batch_size': batch_size, 'cars': cars, 'deadline_us': deadline_us,
+            'fps': len(latencies) / elapsed,
+            'latency_p50_ms': np.percentile(latencies, 50),
+            'latency_p95_ms': np.percentile(latencies, 95),
+            'latency_p99_ms': np.percentile(latencies, 99),
+            'mean_batch': stats['mean_batch']}
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument('--model', type=str,
+                        dest='model',
+                        default='../models/pilot_home_day_cat_aug.h5',
+                        help='keras categorical model',
+                        required=False)
+    parser.add_argument('--max-batch', type=int,
+                        dest='max_batch',
+                        default=16,
+                        help='largest batch size to measure',
+                        required=False)
+    parser.add_argument('--cars', type=int,
+                        dest='cars',
+                        default=0,
+                        help='number of simulated cars (default: same as the batch size)',
+                        required=False)
+    parser.add_argument('--deadline-us', type=int,
+                        dest='deadline_us',
+                        default=1000,
+                        help='batch deadline in microseconds',
+                        required=False)
+    parser.add_argument('--duration', type=float,
+                        dest='duration',
+                        default=5.0,
+                        help='seconds to run each batch size',
+                        required=False)
+    parser.add_argument('--csv', type=str,
+                        dest='csv',
+                        default='',
+                        help='file to save the results as CSV',
+                        required=False)
+    args = vars(parser.parse_args())
+
+    pilot = KerasCategorical(input_shape=(IMAGE_H, IMAGE_W, 3), roi_crop=(0, 0))
+    pilot.load(args['model'])
+
+    results = []
+    print(f"{'batch':>5} {'cars':>5} {'fps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'mean batch':>10}")
+    for batch_size in range(1, args['max_batch'] + 1):
+        cars = args['cars'] if args['cars'] > 0 else batch_size
+        r = benchmark(pilot, batch_size, cars, args['deadline_us'], args['duration'])
+        results.append(r)
+        print(f"{r['batch_size']:>5} {r['cars']:>5} {r['fps']:>8.1f} {r['latency_p50_ms']:>8.2f} "
+              f"{r['latency_p95_ms']:>8.2f} {r['latency_p99_ms']:>8.2f} {r['mean_batch']:>10.2f}")
+
+    if args['csv']:
+        with open(args['csv'], 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+        print(f"Results saved in {args['csv']}")
@@ -0,0 +1,335 @@
+# ###################################################################
+#
+# File:        benchmark_server.py
+# Description: Headless benchmark of the server hot path. It needs no camera,
+#              no display and no Raspberry Pi: a client thread replays
+#              images/training_data_sample.mp4 (or synthetic frames) over a
+#              localhost socket into the real VideoClientThread of
+#              run_server.py, with the video window disabled.
+#              Modes:
+#                  video-only: receive and decode only
+#                  autopilot:  with models/pilot_home_day_cat_aug.h5
+#                  manual:     with a stub controller instead of the PS4
+#              With --transport shm the frames go through the shared memory
+#              ring instead of the socket, with --raw as decoded BGR frames.
+#              Each mode runs in its own process, so peak RSS is measured per
+#              mode. Results are printed and can be saved as JSON and compared
+#              against a previous run:
+#                  python benchmark_server.py --output new.json --baseline old.json
+#
+# ###################################################################
+
+import os
+import sys
+import json
+import time
+import math
+import socket
+import struct
+import resource
+import subprocess
+import tempfile
+import warnings
+from threading import Thread
+from argparse import ArgumentParser
+warnings.simplefilter(action='ignore', category=FutureWarning)
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+MODES = ['video-only', 'autopilot', 'manual']
+IMAGE_W = 160
+IMAGE_H = 120
+
+
+class StubController(object):
+    """Stands in for PS4Controller, slowly sweeps the steering"""
+
+    def __init__(self):
+        self.i = 0
+
+    def read(self):
+        self.i += 1
+        return round(math.sin(self.i / 20.0), 2), 0.5
+
+
+def load_frames(video_path, num_frames, quality):
+    """JPEG frames from the sample video, or synthetic frames if it can't be read"""
+    import cv2
+    import numpy as np
+    images = []
+    cap = cv2.VideoCapture(video_path)
+    while len(images) < num_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        images.append(cv2.resize(frame, (IMAGE_W, IMAGE_H), interpolation=cv2.INTER_AREA))
+    cap.release()
+    if not images:
+        print(f"Could not read {video_path}, using synthetic frames")
+        rng = np.random.RandomState(0)
+        base = rng.randint(0, 255, (IMAGE_H, IMAGE_W, 3), dtype=np.uint8)
+        images = [np.roll(base, i, axis=1) for i in range(num_frames)]
+    return [cv2.imencode('.jpg', im, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes() for im in images]
+
+
+class ReplayClient(Thread):
+    """Sends the frames like run_client.py and counts the commands received"""
+
+    def __init__(self, port, frames, duration, fps, receive_controls, ring=None):
+        Thread.__init__(self)
+        from control_protocol import ControlPacketDecoder
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.ring = ring
+        self.frames = frames
+        self.duration = duration
+        self.period = 1.0 / fps if fps > 0 else 0.0
+        self.receive_controls = receive_controls
+        self.decoder = ControlPacketDecoder()
+        self.frames_sent = 0
+        self.sent_at = {}
+        self.rtts = []
+        self.receiver = Thread(target=self.receive, daemon=True)
+
+    def receive(self):
+        from control_protocol import TYPE_CONTROL
+        while True:
+            try:
+                packets = self.decoder.recv(self.sock)
+            except OSError:
+                break
+            if packets is None:
+                break
+            now = time.time()
+            for packet in packets:
+                if packet.type != TYPE_CONTROL:
+                    continue
+                sent_at = self.sent_at.pop(packet.frame_id, None)
+                if sent_at is not None:
+                    self.rtts.append(now - sent_at)
+
+    def run(self):
+        if self.receive_controls:
+            self.receiver.start()
+        stop_at = time.time() + self.duration
+        next_frame = time.time()
+        while time.time() < stop_at:
+            jpg = self.frames[self.frames_sent % len(self.frames)]
+            self.frames_sent += 1
+            self.sent_at[self.frames_sent] = time.time()
+            if self.ring is not None:
+                self.ring.write(self.frames_sent, jpg)
+            else:
+                self.sock.sendall(struct.pack('<L', len(jpg)) + jpg)
+            if self.period:
+                next_frame += self.period
+                time.sleep(max(0.0, next_frame - time.time()))
+        if self.ring is not None:
+            self.ring.close()
+        else:
+            self.sock.sendall(struct.pack('<L', 0))
+        self.sock.shutdown(socket.SHUT_WR)
+        if self.receive_controls:
+            self.receiver.join(timeout=5)
+        self.sock.close()
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def run_mode(mode, frames, duration, fps, model_path, transport='tcp'):
+    """Run one mode in this process and return its results"""
+    from run_server import VideoClientThread
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    options = dict(display_fps=None, stats_interval=0)
+    ring = None
+    if transport == 'shm':
+        from shm_video import SharedFrameRing, ring_name
+        ring = SharedFrameRing(ring_name(port), create=True)
+        options['video_ring'] = ring
+    if mode == 'autopilot':
+        options['model_path'] = model_path
+    if mode == 'manual':
+        options['controller'] = StubController()
+
+    client = ReplayClient(port, frames, duration, fps, receive_controls=mode != 'video-only', ring=ring)
+    conn, (ip, client_port) = server.accept()
+    video = VideoClientThread(ip, client_port, conn, **options)
+    start = time.time()
+    video.start()
+    client.start()
+    client.join()
+    video.join()
+    elapsed = time.time() - start
+    server.close()
+    if ring is not None:
+        ring.release()
+
+    decoded = video.decode_queue.gets
+    commands = len(client.rtts)
+    return {'mode': mode,
+            'transport': transport,
+            'duration_s': elapsed,
+            'frames_sent': client.frames_sent,
+            'frames_decoded': decoded,
+            'commands': commands,
+            'send_fps': client.frames_sent / elapsed,
+            'decode_fps': decoded / elapsed,
+            'command_fps': commands / elapsed,
+            'rtt_p50_ms': percentile(client.rtts, 50) * 1000,
+            'rtt_p95_ms': percentile(client.rtts, 95) * 1000,
+            'rtt_p99_ms': percentile(client.rtts, 99) * 1000,
+            'stages': video.tracer.stats(),
+            'queues': [q.stats() for q in video.queues],
+            'frame_pool': video.pool.stats(),
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def compare(results, baseline):
+    """Print the relative change of the main numbers against a baseline run"""
+    old = {r['mode']: r for r in baseline['results']}
+    for r in results:
+        if r['mode'] not in old:
+            continue
+        print(f"{r['mode']}:")
+        for key in ['decode_fps', 'command_fps', 'rtt_p50_ms', 'rtt_p95_ms', 'peak_rss_mb']:
+            before, after = old[r['mode']].get(key), r.get(key)
+            if not before or before != before or after != after:
+                continue
+            print(f"    {key:<12} {before:10.2f} -> {after:10.2f} ({(after - before) / before * 100:+.1f}%)")
+
+
+def print_result(r):
+    print(f"{r['mode']}: sent {r['send_fps']:.1f} fps decoded {r['decode_fps']:.1f} fps "
+          f"commands {r['command_fps']:.1f}/s rtt p50 {r['rtt_p50_ms']:.2f} ms p95 {r['rtt_p95_ms']:.2f} ms "
+          f"p99 {r['rtt_p99_ms']:.2f} ms peak RSS {r['peak_rss_mb']:.1f} MB")
+    for stage, s in r['stages'].items():
+        print(f"    {stage:<28} p50 {s['p50_ms']:7.2f} ms p95 {s['p95_ms']:7.2f} ms p99 {s['p99_ms']:7.2f} ms")
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument('--modes', type=str,
+                        dest='modes',
+                        default=','.join(MODES),
+                        help='comma separated modes to run: video-only, autopilot, manual',
+                        required=False)
+    parser.add_argument('--video', type=str,
+                        dest='video',
+                        default=os.path.join(ROOT, 'images', 'training_data_sample.mp4'),
+                        help='video to replay, synthetic frames are used if it cannot be read',
+                        required=False)
+    parser.add_argument('--model', type=str,
+                        dest='model',
+                        default=os.path.join(ROOT, 'models', 'pilot_home_day_cat_aug.h5'),
+                        help='keras model for the autopilot mode',
+                        required=False)
+    parser.add_argument('--duration', type=float,
+                        dest='duration',
+                        default=10.0,
+                        help='seconds to stream in each mode',
+                        required=False)
+    parser.add_argument('--fps', type=float,
+                        dest='fps',
+                        default=0,
+                        help='frames per second sent by the client, 0 for as fast as possible',
+                        required=False)
+    parser.add_argument('--frames', type=int,
+                        dest='frames',
+                        default=300,
+                        help='number of distinct frames to load from the video',
+                        required=False)
+    parser.add_argument('--quality', type=int,
+                        dest='quality',
+                        default=85,
+                        help='JPEG quality of the replayed frames',
+                        required=False)
+    parser.add_argument('--transport', type=str,
+                        dest='transport',
+                        default='tcp',
+                        choices=['tcp', 'shm'],
+                        help='frames over the localhost socket or the shared memory ring',
+                        required=False)
+    parser.add_argument('--raw',
+                        dest='raw',
+                        action='store_const', const=True,
+                        default=False,
+                        help='with --transport shm: send decoded BGR frames, no JPEG',
+                        required=False)
+    parser.add_argument('--output', type=str,
+                        dest='output',
+                        default='',
+                        help='file to save the results as JSON',
+                        required=False)
+    parser.add_argument('--baseline', type=str,
+                        dest='baseline',
+                        default='',
+                        help='JSON results of a previous run to compare with',
+                        required=False)
+    parser.add_argument('--child-output', type=str,
+                        dest='child_output',
+                        default='',
+                        help='internal: run the single mode in --modes and write its result to this file',
+                        required=False)
+    parser.add_argument('--verbose',
+                        dest='verbose',
+                        action='store_const', const=True,
+                        default=False,
+                        help='show the output of the server',
+                        required=False)
+    args = vars(parser.parse_args())
+
+    if args['child_output']:
+        frames = load_frames(args['video'], args['frames'], args['quality'])
+        if args['raw'] and args['transport'] == 'shm':
+            import cv2
+            import numpy as np
+            frames = [cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_COLOR) for jpg in frames]
+        result = run_mode(args['modes'], frames, args['duration'], args['fps'], args['model'], args['transport'])
+        with open(args['child_output'], 'w') as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    # every mode runs in a fresh process so that peak RSS belongs to that mode only
+    results = []
+    for mode in args['modes'].split(','):
+        print(f"Running {mode} for {args['duration']} s")
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            child_output = f.name
+        command = [sys.executable, os.path.abspath(__file__), '--modes', mode,
+                   '--video', args['video'], '--model', args['model'],
+                   '--duration', str(args['duration']), '--fps', str(args['fps']),
+                   '--frames', str(args['frames']), '--quality', str(args['quality']),
+                   '--transport', args['transport'], '--child-output', child_output]
+        if args['raw']:
+            command.append('--raw')
+        out = None if args['verbose'] else subprocess.DEVNULL
+        code = subprocess.call(command, stdout=out, stderr=out)
+        if code != 0:
+            print(f"{mode} failed with exit code {code}, run with --verbose to see why")
+            os.remove(child_output)
+            continue
+        with open(child_output) as f:
+            result = json.load(f)
+        os.remove(child_output)
+        results.append(result)
+        print_result(result)
+
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'duration_s': args['duration'],
+              'fps': args['fps'], 'results': results}
+    if args['output']:
+        with open(args['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved in {args['output']}")
+    if args['baseline']:
+        with open(args['baseline']) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,166 @@
+# ###################################################################
+#
+# File:        benchmark_workers.py
+# Description: This script measures how the throughput of the server scales
+#              with the number of cores, decoding and running the pilot in
+#              threads of one process (as run_server_async.py does by default)
+#              against the worker processes of worker_pool.py
+#              (run_server_async.py --workers N), for 1 to --max-workers
+#              threads or workers. Simulated cars submit a JPEG frame of the
+#              sample video, wait for its command and submit the next one.
+#              With --model every thread or worker runs the keras pilot,
+#              without it a pure Python loop of --busy-ms milliseconds stands
+#              in for the model (no tensorflow needed):
+#                  python benchmark_workers.py --max-workers 8 --affinity auto --csv workers.csv
+# ###################################################################
+
+import os
+import sys
+import csv
+import time
+import numpy as np
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from worker_pool import WorkerPool, parse_affinity, busy_loop
+from benchmark_server import load_frames
+
+
+class ThreadPilot(object):
+    """Decoding and the pilot in a pool of threads of this process"""
+
+    def __init__(self, threads, model_path, busy_ms):
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.busy_ms = busy_ms
+        self.pilot = None
+        if model_path != '':
+            from keras_pilot import load_pilot
+            self.pilot = load_pilot(model_path)
+
+    def run(self, jpg):
+        import cv2
+        image = cv2.imdecode(np.frombuffer(jpg, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if self.pilot is not None:
+            return self.pilot.run(image)
+        return busy_loop(self.busy_ms)
+
+    def submit(self, jpg):
+        return self.executor.submit(self.run, jpg)
+
+    def stop(self):
+        self.executor.shutdown()
+
+
+class ProcessPilot(object):
+    """Decoding and the pilot in a WorkerPool"""
+
+    def __init__(self, workers, model_path, busy_ms, affinity):
+        self.pool = WorkerPool(model_path, workers=workers, affinity=affinity, busy_ms=busy_ms)
+        self.pool.start()
+
+    def submit(self, jpg):
+        return self.pool.submit(jpg)
+
+    def stop(self):
+        self.pool.stop()
+
+
+def run_car(pilot, frames, offset, stop_at, latencies):
+    i = offset
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        pilot.submit(frames[i % len(frames)]).result()
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+def benchmark(pilot, frames, cars, duration):
+    # warm up: the workers load the model and the first frames are slow
+    for _ in range(2):
+        [f.result() for f in [pilot.submit(frames[i % len(frames)]) for i in range(cars)]]
+    latencies = []
+    stop_at = time.perf_counter() + duration
+    threads = [Thread(target=run_car, args=(pilot, frames, i, stop_at, latencies)) for i in range(cars)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    return {'fps': len(latencies) / elapsed,
+            'latency_p50_ms': np.percentile(latencies, 50),
+            'latency_p95_ms': np.percentile(latencies, 95)}
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument('--model', type=str,
+                        dest='model',
+                        default='',
+                        help='keras categorical model (default: a pure Python loop stands in for it)',
+                        required=False)
+    parser.add_argument('--busy-ms', type=float,
+                        dest='busy_ms',
+                        default=5.0,
+                        help='milliseconds of the stand-in for the model',
+                        required=False)
+    parser.add_argument('--max-workers', type=int,
+                        dest='max_workers',
+                        default=os.cpu_count(),
+                        help='largest number of threads or worker processes to measure',
+                        required=False)
+    parser.add_argument('--cars', type=int,
+                        dest='cars',
+                        default=0,
+                        help='number of simulated cars (default: twice the number of workers)',
+                        required=False)
+    parser.add_argument('--affinity', type=parse_affinity,
+                        dest='affinity',
+                        default='',
+                        help='pin the workers to CPUs, auto or a comma separated list of CPUs',
+                        required=False)
+    parser.add_argument('--duration', type=float,
+                        dest='duration',
+                        default=5.0,
+                        help='seconds to run each measure',
+                        required=False)
+    parser.add_argument('--csv', type=str,
+                        dest='csv',
+                        default='',
+                        help='file to save the results as CSV',
+                        required=False)
+    args = vars(parser.parse_args())
+
+    frames = load_frames(os.path.join(ROOT, 'images', 'training_data_sample.mp4'), 100, 85)
+    print(f"{os.cpu_count()} CPUs, {len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else '?'} "
+          f"available to this process")
+    results = []
+    print(f"{'mode':>9} {'workers':>7} {'cars':>5} {'fps':>8} {'p50 ms':>8} {'p95 ms':>8} {'speedup':>7}")
+    for mode in ['threads', 'processes']:
+        single_fps = None
+        for workers in range(1, args['max_workers'] + 1):
+            cars = args['cars'] if args['cars'] > 0 else 2 * workers
+            if mode == 'threads':
+                pilot = ThreadPilot(workers, args['model'], args['busy_ms'])
+            else:
+                pilot = ProcessPilot(workers, args['model'], args['busy_ms'], args['affinity'])
+            r = benchmark(pilot, frames, cars, args['duration'])
+            pilot.stop()
+            single_fps = single_fps or r['fps']
+            r = dict(mode=mode, workers=workers, cars=cars, speedup=r['fps'] / single_fps, **r)
+            results.append(r)
+            print(f"{r['mode']:>9} {r['workers']:>7} {r['cars']:>5} {r['fps']:>8.1f} {r['latency_p50_ms']:>8.2f} "
+                  f"{r['latency_p95_ms']:>8.2f} {r['speedup']:>7.2f}")
+
+    if args['csv']:
+        with open(args['csv'], 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+        print(f"Results saved in {args['csv']}")
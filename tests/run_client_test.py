@@ -5,10 +5,12 @@
 # Description: This script is used for testing the client-server setup on the PC
 #              It opens a connection in localhost and sends video streaming
 #              from the USB camera
+#              With --transport shm the frames go through the shared memory
+#              ring of a server started with --transport shm, and with --raw
+#              they are not JPEG encoded at all
 #
 # ###################################################################
 
-import io
 import socket
 import struct
 import time
@@ -17,6 +19,10 @@ import cv2
 from threading import Thread
 from argparse import ArgumentParser
 import pickle
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from control_protocol import ControlPacketDecoder
 
 # Video Sending Thread
 class VideoSendThread(Thread):
@@ -24,21 +30,27 @@ class VideoSendThread(Thread):
     # This class inherits from Thread, which means that will run on a separate Thread
     # whenever called, it starts the run method
 
-    def __init__(self, host, port, receive_controls=False):
+    def __init__(self, host, port, receive_controls=False, transport='tcp', raw=False):
         Thread.__init__(self)
+        if raw and transport != 'shm':
+            raise ValueError("raw frames can only be sent with the shm transport")
         # create socket and bind host
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.client_socket.connect((host, port))
         self.connection = self.client_socket.makefile('wb')
+        self.ring = None
+        if transport == 'shm':
+            from shm_video import SharedFrameRing, ring_name
+            self.ring = SharedFrameRing(ring_name(port))
+        self.raw = raw
         self.IMAGE_W = 160
         self.IMAGE_H = 120
         self.receive_controls = receive_controls
+        self.commands = ControlPacketDecoder()
 
     def run(self):
         try:
             start = time.time()
-            message = b''
-            stream = io.BytesIO()
             cap = cv2.VideoCapture(0)
             frame_count = 0
             while True:
@@ -46,29 +58,42 @@ class VideoSendThread(Thread):
                 # encode the frame in JPEG format
                 ret, frame = cap.read()
                 frame = cv2.resize(frame, (self.IMAGE_W, self.IMAGE_H), cv2.INTER_AREA)
-                (flag, encodedImage) = cv2.imencode(".jpg", frame)
-                # ensure the frame was successfully encoded
-                if not flag:
-                    continue
-                # change the output frame in the byte format
-                encodedImage_byte = b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(
-                    encodedImage) + b'\r\n'
-                self.connection.write(encodedImage_byte)
-                self.connection.flush()
-                stream.seek(0)
-                self.connection.write(stream.read())
-                stream.seek(0)
-                stream.truncate()
+                if self.raw:
+                    frame_count += 1
+                    self.ring.write(frame_count, frame)
+                else:
+                    (flag, encodedImage) = cv2.imencode(".jpg", frame)
+                    # ensure the frame was successfully encoded
+                    if not flag:
+                        continue
+                    frame_count += 1
+                    if self.ring is not None:
+                        self.ring.write(frame_count, encodedImage)
+                    else:
+                        # send the frame length followed by the JPEG bytes, as run_client.py does
+                        self.connection.write(struct.pack('<L', len(encodedImage)))
+                        self.connection.write(encodedImage.data)
+                        self.connection.flush()
+
+                sent_at = time.time()
 
                 # Receive the steering and throttle
                 if self.receive_controls:
-                    message = self.client_socket.recv(64)
-                    steering, throttle = map(float, message.decode().split(","))
-                    print(f"{steering} {throttle}")
+                    command = None
+                    while command is None:
+                        packets = self.commands.recv(self.client_socket)
+                        if packets is None:
+                            return
+                        command = self.commands.newest(packets)
+                    print(f"{command.steering} {command.throttle} frame {command.frame_id} "
+                          f"rtt {(time.time() - sent_at) * 1000:.1f} ms")
 
             # Pack zero as little endian unsigned long and send it to signal end of connection
             self.connection.write(struct.pack('<L', 0))
         finally:
+            if self.ring is not None:
+                self.ring.close()
+                self.ring.release()
             self.connection.close()
             self.client_socket.close()
 
@@ -91,7 +116,21 @@ if __name__ == "__main__":
                         default='localhost',
                         help='destination host name or ip',
                         required=False)
+    parser.add_argument('--transport', type=str,
+                        dest='transport',
+                        default='tcp',
+                        choices=['tcp', 'shm'],
+                        help='send the frames over TCP or through the shared memory ring of the server',
+                        required=False)
+    parser.add_argument('--raw',
+                        dest='raw',
+                        action='store_const', const=True,
+                        default=False,
+                        help='with --transport shm: send the raw frames, no JPEG',
+                        required=False)
     args = vars(parser.parse_args())
+    if args['raw'] and args['transport'] != 'shm':
+        parser.error("--raw needs --transport shm")
 
     port = args['port']
     host = args['host']
@@ -101,7 +140,8 @@ if __name__ == "__main__":
 
     threads = []
 
-    newthread = VideoSendThread(host, port, receive_controls=args['receive_controls'])
+    newthread = VideoSendThread(host, port, receive_controls=args['receive_controls'],
+                                transport=args['transport'], raw=args['raw'])
     newthread.start()
     threads.append(newthread)
 
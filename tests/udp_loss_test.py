@@ -0,0 +1,177 @@
+# ###################################################################
+#
+# File:        udp_loss_test.py
+# Description: Localhost test of the UDP video transport (udp_video.py) on a
+#              lossy link. Frames of images/training_data_sample.mp4 are sent
+#              with UDPFrameSender through a proxy thread that drops,
+#              duplicates and reorders datagrams at random, into a
+#              UDPFrameReceiver. Every frame received is checked against the
+#              frame sent, and the loss and reassembly statistics are printed
+#              for each loss rate:
+#                  python udp_loss_test.py --loss 0,0.01,0.05 --duplicate 0.01 --reorder 0.01
+# ###################################################################
+
+import os
+import sys
+import time
+import random
+import socket
+from threading import Thread
+from argparse import ArgumentParser
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from udp_video import UDPFrameSender, UDPFrameReceiver, DATAGRAM_SIZE
+from benchmark_server import load_frames
+
+
+class LossyProxy(Thread):
+    """Forwards the datagrams it receives to target, except the ones it loses"""
+
+    def __init__(self, target, loss, duplicate=0.0, reorder=0.0, seed=0):
+        Thread.__init__(self, daemon=True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.5)
+        self.address = self.sock.getsockname()
+        self.target = target
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        self.dropped = 0
+        self.forwarded = 0
+        self.running = True
+
+    def run(self):
+        held = None
+        while self.running:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            if self.random.random() < self.loss:
+                self.dropped += 1
+                continue
+            if held is None and self.random.random() < self.reorder:
+                # sent after the next datagram
+                held = data
+                continue
+            self.forward(data)
+            if self.random.random() < self.duplicate:
+                self.forward(data)
+            if held is not None:
+                self.forward(held)
+                held = None
+
+    def forward(self, data):
+        self.sock.sendto(data, self.target)
+        self.forwarded += 1
+
+
+def run_loss(frames, loss, duplicate, reorder, fps, num_frames, timeout, datagram_size):
+    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    receiver_socket.bind(('127.0.0.1', 0))
+    receiver = UDPFrameReceiver(receiver_socket, peer='127.0.0.1', timeout=timeout)
+    proxy = LossyProxy(receiver_socket.getsockname(), loss, duplicate, reorder)
+    proxy.start()
+
+    sender_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender_socket.connect(proxy.address)
+    sender = UDPFrameSender(sender_socket, datagram_size)
+
+    def send():
+        period = 1.0 / fps
+        next_frame = time.time()
+        for frame_id in range(1, num_frames + 1):
+            sender.send_frame(frame_id, frames[(frame_id - 1) % len(frames)])
+            next_frame += period
+            time.sleep(max(0.0, next_frame - time.time()))
+        # the proxy can lose the end of stream too, the receiver is closed below anyway
+        sender.send_end()
+
+    def close():
+        send_thread.join()
+        time.sleep(timeout + 0.5)
+        receiver.close()
+
+    send_thread = Thread(target=send, daemon=True)
+    send_thread.start()
+    Thread(target=close, daemon=True).start()
+    received = corrupt = 0
+    while True:
+        batch = receiver.read_frames()
+        if batch is None:
+            break
+        received += len(batch)
+        # the newest frame is last, the ones before it completed in the same call
+        if bytes(batch[-1]) != frames[(receiver.last_frame_id - 1) % len(frames)]:
+            corrupt += 1
+    proxy.running = False
+    proxy.join()
+    sender_socket.close()
+    receiver_socket.close()
+    return received, corrupt, sender, proxy, receiver
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument('--loss', type=str,
+                        dest='loss',
+                        default='0,0.01,0.05,0.1',
+                        help='comma separated datagram loss rates to test',
+                        required=False)
+    parser.add_argument('--duplicate', type=float,
+                        dest='duplicate',
+                        default=0.0,
+                        help='rate of datagrams sent twice',
+                        required=False)
+    parser.add_argument('--reorder', type=float,
+                        dest='reorder',
+                        default=0.0,
+                        help='rate of datagrams swapped with the next one',
+                        required=False)
+    parser.add_argument('--frames', type=int,
+                        dest='frames',
+                        default=300,
+                        help='frames to send for each loss rate',
+                        required=False)
+    parser.add_argument('--fps', type=float,
+                        dest='fps',
+                        default=100,
+                        help='frames per second sent',
+                        required=False)
+    parser.add_argument('--quality', type=int,
+                        dest='quality',
+                        default=85,
+                        help='JPEG quality of the frames',
+                        required=False)
+    parser.add_argument('--timeout', type=float,
+                        dest='timeout',
+                        default=0.1,
+                        help='seconds the receiver waits for the missing datagrams of a frame',
+                        required=False)
+    parser.add_argument('--datagram-size', type=int,
+                        dest='datagram_size',
+                        default=DATAGRAM_SIZE,
+                        help='bytes per datagram',
+                        required=False)
+    args = vars(parser.parse_args())
+
+    frames = load_frames(os.path.join(ROOT, 'images', 'training_data_sample.mp4'), 100, args['quality'])
+    failed = False
+    for loss in [float(x) for x in args['loss'].split(',')]:
+        received, corrupt, sender, proxy, receiver = run_loss(
+            frames, loss, args['duplicate'], args['reorder'], args['fps'], args['frames'], args['timeout'],
+            args['datagram_size'])
+        per_frame = sender.datagrams_sent / max(1, sender.frames_sent)
+        expected = 1.0 - (1.0 - loss) ** per_frame
+        print(f"loss {loss:.1%}: {received}/{sender.frames_sent} frames received, {corrupt} corrupt, "
+              f"{per_frame:.1f} datagrams per frame, {proxy.dropped} dropped by the proxy, "
+              f"expected frame loss about {expected:.1%}")
+        print(f"    {receiver.summary()}")
+        if corrupt or (loss == 0 and not args['reorder'] and received < sender.frames_sent):
+            failed = True
+    print("FAILED" if failed else "OK")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,228 @@
+# ###################################################################
+#
+# File:        tub_dataset.py
+# Description: Reads a donkey car tub (record_<n>.json files with the
+#              steering and throttle, plus the camera image they name) for
+#              training and evaluation.
+#              The tub is indexed once: the JPEGs are decoded by a pool of
+#              worker processes and saved as .npy shards of frames and labels,
+#              plus an index.json. Later runs memory-map the shards, so they
+#              start at once and never decode a JPEG again. Indexing again
+#              only adds the records that are not in the shards yet.
+#                  python tub_dataset.py ~/mycar/data/tub_5_20-03-08
+# ###################################################################
+
+import os
+import re
+import glob
+import json
+import time
+import numpy as np
+from multiprocessing import Pool
+from argparse import ArgumentParser
+
+RECORD_PATTERN = re.compile(r'record_(\d+)\.json$')
+LABEL_DTYPE = np.dtype([('record', '<i8'), ('angle', '<f4'), ('throttle', '<f4'), ('milliseconds', '<i8')])
+INDEX_FILE = 'index.json'
+
+
+def find_records(tub_dir):
+    '''Record numbers of the tub, sorted'''
+    numbers = []
+    for name in os.listdir(tub_dir):
+        match = RECORD_PATTERN.match(name)
+        if match:
+            numbers.append(int(match.group(1)))
+    return sorted(numbers)
+
+
+def image_path(tub_dir, num, record):
+    path = os.path.join(tub_dir, record.get('cam/image_array', ''))
+    if os.path.isfile(path):
+        return path
+    # images renamed by hand keep the record number as prefix, e.g. 42_test_image_car.jpg
+    candidates = sorted(glob.glob(os.path.join(tub_dir, f"{num}_*.jpg")))
+    return candidates[0] if candidates else None
+
+
+def read_record(args):
+    '''
+    Worker: decode one record, returns (num, image, angle, throttle, milliseconds).
+    image is None if it can't be read
+    '''
+    import cv2
+    tub_dir, num, shape = args
+    with open(os.path.join(tub_dir, f"record_{num}.json")) as f:
+        record = json.load(f)
+    path = image_path(tub_dir, num, record)
+    image = cv2.imread(path) if path is not None else None
+    if image is not None and shape is not None and image.shape != tuple(shape):
+        image = cv2.resize(image, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+    return (num, image, record.get('user/angle', 0.0), record.get('user/throttle', 0.0),
+            record.get('milliseconds', 0))
+
+
+class TubDataset(object):
+    '''
+    Frames and labels of a tub, memory-mapped from the shards in cache_dir
+    (by default a "cache" folder inside the tub).
+    dataset[i] gives (image, angle, throttle), batches() whole arrays
+    '''
+
+    def __init__(self, tub_dir, cache_dir='', shard_size=1000, workers=None):
+        self.tub_dir = tub_dir
+        self.cache_dir = cache_dir or os.path.join(tub_dir, 'cache')
+        self.shard_size = shard_size
+        self.workers = workers
+        self.shape = None
+        self.shards = []
+        self.images = []
+        self.labels = []
+        self.offsets = [0]
+        self.load_index()
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def load_index(self):
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            index = json.load(f)
+        self.shape = tuple(index['shape'])
+        self.shards = index['shards']
+        self.images = [np.load(os.path.join(self.cache_dir, s['images']), mmap_mode='r') for s in self.shards]
+        self.labels = [np.load(os.path.join(self.cache_dir, s['labels']), mmap_mode='r') for s in self.shards]
+        self.offsets = [0]
+        for labels in self.labels:
+            self.offsets.append(self.offsets[-1] + len(labels))
+
+    def save_index(self):
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'shape': list(self.shape), 'shards': self.shards}, f)
+        os.replace(path + '.tmp', path)
+
+    def update(self):
+        '''
+        Decode the records that are not in the shards yet into new shards.
+        Returns the number of records added
+        '''
+        indexed = set()
+        for labels in self.labels:
+            indexed.update(labels['record'].tolist())
+        new = [num for num in find_records(self.tub_dir) if num not in indexed]
+        if not new:
+            return 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        added = 0
+        with Pool(self.workers) as pool:
+            if self.shape is None:
+                # the first readable image sets the frame size of the dataset
+                for num in new:
+                    image = read_record((self.tub_dir, num, None))[1]
+                    if image is not None:
+                        self.shape = image.shape
+                        break
+                else:
+                    return 0
+            for start in range(0, len(new), self.shard_size):
+                chunk = new[start:start + self.shard_size]
+                added += self._write_shard(pool, chunk)
+        self.save_index()
+        self.load_index()
+        return added
+
+    def _write_shard(self, pool, numbers):
+        name = f"shard_{len(self.shards):05d}"
+        images_path = os.path.join(self.cache_dir, name + '_images.npy')
+        labels_path = os.path.join(self.cache_dir, name + '_labels.npy')
+        # frames are written straight into the memory-mapped file, never all in memory
+        images = np.lib.format.open_memmap(images_path + '.tmp', mode='w+', dtype=np.uint8,
+                                           shape=(len(numbers),) + self.shape)
+        labels = np.zeros(len(numbers), dtype=LABEL_DTYPE)
+        n = 0
+        jobs = [(self.tub_dir, num, self.shape) for num in numbers]
+        for num, image, angle, throttle, milliseconds in pool.imap(read_record, jobs, chunksize=16):
+            if image is None:
+                print(f"Skipping record {num}, its image can't be read")
+                continue
+            images[n] = image
+            labels[n] = (num, angle, throttle, milliseconds)
+            n += 1
+        images.flush()
+        del images
+        if n < len(numbers):
+            # unreadable images left empty rows at the end, rewrite without them
+            np.save(images_path, np.load(images_path + '.tmp', mmap_mode='r')[:n])
+            os.remove(images_path + '.tmp')
+        else:
+            os.replace(images_path + '.tmp', images_path)
+        np.save(labels_path, labels[:n])
+        self.shards.append({'images': os.path.basename(images_path), 'labels': os.path.basename(labels_path),
+                            'count': n})
+        return n
+
+    def _locate(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"frame {i} out of range, the dataset has {len(self)}")
+        shard = int(np.searchsorted(self.offsets, i, side='right')) - 1
+        return shard, i - self.offsets[shard]
+
+    def __getitem__(self, i):
+        shard, j = self._locate(i)
+        label = self.labels[shard][j]
+        return self.images[shard][j], float(label['angle']), float(label['throttle'])
+
+    def batches(self, batch_size=64, shuffle=False, seed=None):
+        '''
+        Yield (images, angles, throttles) arrays of up to batch_size frames.
+        Without shuffle the batches are contiguous slices of the shards
+        '''
+        if not shuffle:
+            for images, labels in zip(self.images, self.labels):
+                for start in range(0, len(labels), batch_size):
+                    batch = labels[start:start + batch_size]
+                    yield (np.asarray(images[start:start + batch_size]),
+                           np.asarray(batch['angle']), np.asarray(batch['throttle']))
+            return
+        order = np.random.RandomState(seed).permutation(len(self))
+        for start in range(0, len(order), batch_size):
+            # sorted indices read the memory-mapped files in order
+            indices = np.sort(order[start:start + batch_size])
+            items = [self._locate(i) for i in indices]
+            yield (np.stack([self.images[s][j] for s, j in items]),
+                   np.array([self.labels[s][j]['angle'] for s, j in items]),
+                   np.array([self.labels[s][j]['throttle'] for s, j in items]))
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser()
+    parser.add_argument('tub', type=str, help='tub directory with the record_<n>.json files')
+    parser.add_argument('--cache-dir', type=str,
+                        dest='cache_dir',
+                        default='',
+                        help='where to write the shards, by default a cache folder inside the tub',
+                        required=False)
+    parser.add_argument('--workers', type=int,
+                        dest='workers',
+                        default=None,
+                        help='processes decoding the JPEGs, by default one per CPU',
+                        required=False)
+    parser.add_argument('--shard-size', type=int,
+                        dest='shard_size',
+                        default=1000,
+                        help='frames per shard',
+                        required=False)
+    args = vars(parser.parse_args())
+
+    start = time.time()
+    dataset = TubDataset(args['tub'], cache_dir=args['cache_dir'], shard_size=args['shard_size'],
+                         workers=args['workers'])
+    added = dataset.update()
+    print(f"{added} new records indexed in {time.time() - start:.2f} s, "
+          f"{len(dataset)} frames of {dataset.shape} in {dataset.cache_dir}")
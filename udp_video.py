@@ -0,0 +1,224 @@
+# ###################################################################
+#
+# File:        udp_video.py
+# Description: UDP transport for the video stream, an alternative to the
+#              TCP framing of video_stream.py. Over TCP one lost packet
+#              holds back every frame behind it until it is resent, over
+#              UDP a frame that loses a datagram is just dropped.
+#              Every frame is split into datagrams of at most datagram_size
+#              bytes, each with a 16 bytes header:
+#                  magic    uint16
+#                  kind     uint16  1 data, 2 end of stream
+#                  frame_id uint32  frames are numbered from 1 by the sender
+#                  length   uint32  size of the whole frame
+#                  offset   uint32  position of this datagram in the frame
+#              The receiver reassembles the frames and returns only complete
+#              ones, newest last. A frame still incomplete after timeout
+#              seconds, or older than a frame already returned, is dropped.
+#              The TCP connection stays open for the commands, and its
+#              close ends the stream too (the end datagram can be lost).
+# ###################################################################
+
+import time
+import socket
+import struct
+
+DATAGRAM = struct.Struct('<HHIII')
+MAGIC = 0xF4A3
+KIND_DATA = 1
+KIND_END = 2
+DATAGRAM_SIZE = 1400  # fits in the 1500 bytes MTU of Ethernet and Wi-Fi with the IP and UDP headers
+
+
+class UDPFrameSender(object):
+    '''
+    Sends frames on a connected UDP socket. Datagrams are sent with sendmsg
+    straight from the caller's buffer, errors (e.g. no server yet) are counted
+    and the frame is lost, as any other lost frame
+    '''
+
+    def __init__(self, sock, datagram_size=DATAGRAM_SIZE):
+        self.sock = sock
+        self.payload_size = datagram_size - DATAGRAM.size
+        self.frames_sent = 0
+        self.datagrams_sent = 0
+        self.send_errors = 0
+
+    def send_frame(self, frame_id, payload):
+        view = memoryview(payload).cast('B')
+        length = len(view)
+        try:
+            for offset in range(0, length, self.payload_size):
+                header = DATAGRAM.pack(MAGIC, KIND_DATA, frame_id, length, offset)
+                self.sock.sendmsg([header, view[offset:offset + self.payload_size]])
+                self.datagrams_sent += 1
+        except OSError:
+            self.send_errors += 1
+            return False
+        self.frames_sent += 1
+        return True
+
+    def send_end(self, copies=3):
+        '''A few copies, any of them ends the stream'''
+        for _ in range(copies):
+            try:
+                self.sock.send(DATAGRAM.pack(MAGIC, KIND_END, 0, 0, 0))
+            except OSError:
+                pass
+
+
+class PartialFrame(object):
+
+    def __init__(self, length, now):
+        self.data = bytearray(length)
+        self.offsets = set()
+        self.received = 0
+        self.first_at = now
+
+
+class UDPFrameReceiver(object):
+    """Reassembles the frames sent by a UDPFrameSender
+
+    Same use as video_stream.FrameReader: read_frames() blocks until at least
+    one frame is complete and returns them, or None at the end of the stream.
+    Frame ids come from the sender, last_frame_id is the id of the newest frame
+    returned. Only datagrams from peer (an ip) are accepted if it is given.
+    """
+
+    def __init__(self, sock, peer=None, timeout=0.1, max_frame_size=1024 * 1024):
+        self.sock = sock
+        self.peer = peer
+        self.timeout = timeout
+        self.max_frame_size = max_frame_size
+        # wake up regularly to drop the frames that timed out
+        sock.settimeout(timeout / 2)
+        self.buffer = bytearray(65536)
+        self.view = memoryview(self.buffer)
+        self.pending = {}
+        self.expired_at = 0.0
+        self.closed = False
+        self.last_frame_id = 0
+        self.newest_seen = 0
+        self.first_seen = 0
+        self.frames_seen = 0
+        self.datagrams = 0
+        self.bytes_received = 0
+        self.invalid = 0
+        self.duplicates = 0
+        self.frames_complete = 0
+        self.frames_incomplete = 0
+        self.datagrams_late = 0
+        self.reassembly_time = 0.0
+        self.max_reassembly_time = 0.0
+
+    def close(self):
+        '''Makes read_frames() return None, from any thread'''
+        self.closed = True
+
+    def read_frames(self):
+        frames = []
+        while not frames:
+            if self.closed:
+                return None
+            try:
+                nbytes, address = self.sock.recvfrom_into(self.buffer)
+            except socket.timeout:
+                self.expire(time.time())
+                continue
+            except OSError:
+                return None
+            if self.peer is not None and address[0] != self.peer:
+                continue
+            now = time.time()
+            frame = self.add_datagram(nbytes, now)
+            if frame is not None:
+                frames.append(frame)
+            elif now - self.expired_at > self.timeout / 2:
+                self.expire(now)
+        return frames
+
+    def add_datagram(self, nbytes, now):
+        '''Returns the frame this datagram completes, if any'''
+        self.datagrams += 1
+        self.bytes_received += nbytes
+        if nbytes < DATAGRAM.size:
+            self.invalid += 1
+            return None
+        magic, kind, frame_id, length, offset = DATAGRAM.unpack_from(self.buffer)
+        if magic != MAGIC:
+            self.invalid += 1
+            return None
+        if kind == KIND_END:
+            self.closed = True
+            return None
+        size = nbytes - DATAGRAM.size
+        if kind != KIND_DATA or length > self.max_frame_size or offset + size > length or size == 0:
+            self.invalid += 1
+            return None
+        if frame_id <= self.last_frame_id:
+            # its frame was returned or dropped for a newer one
+            self.datagrams_late += 1
+            return None
+        frame = self.pending.get(frame_id)
+        if frame is None:
+            if len(self.pending) >= 64:
+                self.expire(now, force=True)
+            frame = self.pending[frame_id] = PartialFrame(length, now)
+            self.frames_seen += 1
+            if not self.first_seen:
+                self.first_seen = frame_id
+            self.newest_seen = max(self.newest_seen, frame_id)
+        if offset in frame.offsets:
+            self.duplicates += 1
+            return None
+        frame.offsets.add(offset)
+        frame.data[offset:offset + size] = self.view[DATAGRAM.size:nbytes]
+        frame.received += size
+        if frame.received < len(frame.data):
+            return None
+
+        del self.pending[frame_id]
+        elapsed = now - frame.first_at
+        self.reassembly_time += elapsed
+        self.max_reassembly_time = max(self.max_reassembly_time, elapsed)
+        self.frames_complete += 1
+        self.last_frame_id = frame_id
+        # older frames still missing datagrams would arrive too late to be of any use
+        for older in [i for i in self.pending if i < frame_id]:
+            del self.pending[older]
+            self.frames_incomplete += 1
+        return frame.data
+
+    def expire(self, now, force=False):
+        '''Drop the frames that waited for timeout seconds, or the oldest one with force'''
+        self.expired_at = now
+        expired = [i for i, frame in self.pending.items() if now - frame.first_at > self.timeout]
+        if force and not expired and self.pending:
+            expired = [min(self.pending)]
+        for i in expired:
+            del self.pending[i]
+            self.frames_incomplete += 1
+
+    def stats(self):
+        # frame ids never seen at all lost every one of their datagrams
+        sent = self.newest_seen - self.first_seen + 1 if self.first_seen else 0
+        missing = max(0, sent - self.frames_seen)
+        return {'datagrams': self.datagrams,
+                'bytes': self.bytes_received,
+                'frames_complete': self.frames_complete,
+                'frames_incomplete': self.frames_incomplete,
+                'frames_missing': missing,
+                'datagrams_late': self.datagrams_late,
+                'duplicates': self.duplicates,
+                'invalid': self.invalid,
+                'frame_loss': 1.0 - self.frames_complete / sent if sent else 0.0,
+                'reassembly_ms_mean': (self.reassembly_time / self.frames_complete * 1000
+                                       if self.frames_complete else 0.0),
+                'reassembly_ms_max': self.max_reassembly_time * 1000}
+
+    def summary(self):
+        s = self.stats()
+        return (f"udp: {s['frames_complete']} frames complete, {s['frames_incomplete']} incomplete, "
+                f"{s['frames_missing']} missing, loss {s['frame_loss']:.1%}, "
+                f"reassembly mean {s['reassembly_ms_mean']:.2f} ms max {s['reassembly_ms_max']:.2f} ms, "
+                f"{s['datagrams']} datagrams, {s['datagrams_late']} late {s['duplicates']} duplicates {s['invalid']} invalid")
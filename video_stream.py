@@ -0,0 +1,160 @@
+# ###################################################################
+#
+# File:        video_stream.py
+# Description: Framing layer for the video stream sent by run_client.py.
+#              Every frame on the wire is a little endian unsigned long
+#              ('<L') with the JPEG size followed by the JPEG bytes. A zero
+#              length marks the end of the stream.
+#              FrameReader receives into a preallocated bytearray with
+#              recv_into and returns complete frames as memoryviews into
+#              that buffer, so they reach the decoder without being copied.
+#              send_frame() is the sending side: header and payload go out in
+#              a single sendmsg, straight from the caller's buffer.
+# ###################################################################
+
+import struct
+
+HEADER = struct.Struct('<L')
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+END_OF_STREAM = HEADER.pack(0)
+
+
+def send_frame(sock, payload):
+    '''
+    Send one frame with a single vectored sendmsg, the payload (any buffer,
+    e.g. a memoryview of BytesIO.getbuffer()) is not copied
+    '''
+    header = HEADER.pack(len(payload))
+    sent = sock.sendmsg([header, payload])
+    # sendmsg can return early, e.g. when interrupted by a signal
+    if sent < len(header) + len(payload):
+        if sent < len(header):
+            sock.sendall(header[sent:])
+            sent = len(header)
+        sock.sendall(memoryview(payload)[sent - len(header):])
+
+
+def send_end(sock):
+    sock.sendall(END_OF_STREAM)
+
+
+class FrameReader(object):
+    """Class to split a length-prefixed JPEG stream into frames
+
+    The frames returned by read_frames() or parse_frames() are memoryviews
+    into the receive buffer. They are only valid until the next call to
+    read_frames(), get_buffer() or recv(): consume them (e.g. cv2.imdecode
+    on np.frombuffer(frame, np.uint8)) or copy them with bytes(frame) before
+    receiving again.
+    """
+
+    def __init__(self, connection=None, buffer_size=64 * 1024, max_frame_size=1024 * 1024):
+        self.connection = connection
+        self.max_frame_size = max_frame_size
+        self.max_buffer_size = max(buffer_size, max_frame_size + HEADER.size)
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        # unconsumed data lives in self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = 0
+        self.closed = False
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.resyncs = 0
+
+    @property
+    def last_frame_id(self):
+        """Id of the newest frame returned, frames are numbered from 1 in the order they arrive"""
+        return self.frames_received
+
+    def get_buffer(self, min_size=4096):
+        """Return a writable memoryview of the free space at the end of the buffer"""
+        if len(self.buffer) - self.end < min_size:
+            self._make_room(min_size)
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """Mark nbytes written into the view returned by get_buffer() as received"""
+        self.end += nbytes
+        self.bytes_received += nbytes
+
+    def recv(self):
+        """Do a single recv_into on the connection. Returns False on end of stream"""
+        nbytes = self.connection.recv_into(self.get_buffer())
+        if nbytes == 0:
+            self.closed = True
+            return False
+        self.buffer_updated(nbytes)
+        return True
+
+    def read_frames(self):
+        """Block until at least one frame is complete and return all buffered frames
+
+        Returns None when the client closed the connection or sent the
+        zero length end of stream marker.
+        """
+        while True:
+            frames = self.parse_frames()
+            if frames or self.closed:
+                return frames if frames else None
+            if not self.recv():
+                return None
+
+    def parse_frames(self):
+        """Return every complete frame currently in the buffer, without receiving"""
+        frames = []
+        buf = self.buffer
+        while not self.closed:
+            available = self.end - self.start
+            if available < HEADER.size:
+                break
+            (length,) = HEADER.unpack_from(buf, self.start)
+            if length == 0:
+                self.closed = True
+                break
+            if length < 2 * len(JPEG_SOI) or length > self.max_frame_size:
+                self._resync()
+                continue
+            payload = self.start + HEADER.size
+            # check the JPEG start marker as soon as it is here, not only
+            # once a possibly bogus length has been fully received
+            if self.end - payload >= 2 and buf[payload:payload + 2] != JPEG_SOI:
+                self._resync()
+                continue
+            if available < HEADER.size + length:
+                break
+            if buf[payload + length - 2:payload + length] != JPEG_EOI:
+                self._resync()
+                continue
+            frames.append(self.view[payload:payload + length])
+            self.start = payload + length
+            self.frames_received += 1
+        if self.start == self.end:
+            self.start = self.end = 0
+        return frames
+
+    def _resync(self):
+        """Skip corrupt data up to the next JPEG start marker preceded by a header"""
+        self.resyncs += 1
+        soi = self.buffer.find(JPEG_SOI, self.start + HEADER.size + 1, self.end)
+        if soi == -1:
+            # keep a possible header and half a marker for the next recv
+            self.start = max(self.start + 1, self.end - HEADER.size - 1)
+        else:
+            self.start = soi - HEADER.size
+
+    def _make_room(self, min_size):
+        pending = self.end - self.start
+        min_size = min(min_size, self.max_buffer_size - pending)
+        if pending + min_size <= len(self.buffer):
+            # move the unconsumed bytes to the front, no allocation needed
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        else:
+            new_size = min(max(2 * len(self.buffer), pending + min_size), self.max_buffer_size)
+            buffer = bytearray(new_size)
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start = 0
+        self.end = pending
@@ -0,0 +1,412 @@
+# ###################################################################
+#
+# File:        worker_pool.py
+# Description: Pool of worker processes decoding the frames and running the
+#              model, for run_server_async.py --workers N. In one process
+#              the JPEG decoding and the model compete for the GIL with the
+#              socket handling, so past a few cars adding threads does not
+#              add throughput. Here the connections stay in the main process
+#              and every worker process has its own KerasCategorical.
+#              Frames are not pickled: the main process copies each one into
+#              a free slot of a shared memory block and sends the worker a
+#              fixed size job message (slot, kind, length, shape) through
+#              a pipe. The worker decodes it straight from the slot, runs the
+#              model and answers with a fixed size result message (command,
+#              timings, and the shape of the decoded image it wrote back into
+#              the slot when the caller wants to display it).
+#              Layout of a slot: slot_size bytes of input (JPEG bytes or a
+#              raw BGR image) followed by image_size bytes for the decoded image.
+#              There are slots_per_worker slots per worker, frames submitted
+#              while all of them are in use wait for the first one released.
+#              Workers can be pinned to CPUs (Linux only):
+#                  'auto'     worker i on CPU i, cycling over the CPUs available
+#                  '2,3,4,5'  worker i on the i-th CPU of the list
+# ###################################################################
+
+import os
+import time
+import signal
+import struct
+import numpy as np
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+from threading import Thread, Lock
+from argparse import ArgumentTypeError
+
+KIND_JPEG = 1
+KIND_BGR = 2
+# slot, kind, length, height, width, channels, want_image
+JOB = struct.Struct('<IIIIIII')
+# slot, has_command, decoded, image (0 none, 1 input region, 2 image region), height, width, channels,
+# steering, throttle, decode_ms, infer_ms
+RESULT = struct.Struct('<IIIIIIIdddd')
+IMAGE_NONE = 0
+IMAGE_INPUT = 1
+IMAGE_DECODED = 2
+SLOT_SIZE = 512 * 1024
+IMAGE_SIZE = 640 * 480 * 3
+
+
+def parse_affinity(value):
+    '''
+    argparse type of the --affinity option, the CPUs for the workers: ''
+    gives None (no pinning), 'auto' the CPUs available to this process, or
+    a comma separated list of CPUs
+    '''
+    if not value:
+        return None
+    if not hasattr(os, 'sched_setaffinity'):
+        print("CPU affinity is not supported on this platform, workers are not pinned")
+        return None
+    if value == 'auto':
+        return sorted(os.sched_getaffinity(0))
+    try:
+        return [int(cpu) for cpu in value.split(',')]
+    except ValueError:
+        raise ArgumentTypeError(f"must be auto or a list of CPUs, not {value}")
+
+
+def busy_loop(ms):
+    '''
+    Stand-in for the model when there is no tensorflow (benchmarks): keeps
+    the CPU busy for ms milliseconds in pure Python, holding the GIL
+    '''
+    end = time.perf_counter() + ms / 1000.0
+    count = 0
+    while time.perf_counter() < end:
+        count += 1
+    return 0.0, 0.0
+
+
+class FrameSlots(object):
+    '''
+    Slots of a shared memory block. The main process creates it (no name,
+    a unique one is picked) and removes it in release(), the workers attach to it
+    '''
+
+    def __init__(self, slots, slot_size=SLOT_SIZE, image_size=IMAGE_SIZE, name=None):
+        self.owner = name is None
+        self.slots = slots
+        self.slot_size = slot_size
+        self.image_size = image_size
+        self.stride = slot_size + image_size
+        # Python 3.8, imported here so that parse_affinity works without it
+        from multiprocessing import shared_memory
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=slots * self.stride)
+        else:
+            # the workers share the resource tracker of the main process, which unlinks the block
+            self.shm = shared_memory.SharedMemory(name)
+        self.name = self.shm.name
+        self.buffer = np.ndarray((slots * self.stride,), dtype=np.uint8, buffer=self.shm.buf)
+
+    def input(self, slot, length=None):
+        start = slot * self.stride
+        return self.buffer[start:start + (self.slot_size if length is None else length)]
+
+    def image(self, slot, shape):
+        start = slot * self.stride + self.slot_size
+        return self.buffer[start:start + int(np.prod(shape))].reshape(shape)
+
+    def release(self):
+        # numpy views must go before the shared memory can be closed
+        self.buffer = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # an image is still referenced (e.g. by the display), the mapping goes with the process
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+def worker_main(index, slots_name, slots, slot_size, image_size, conn, model_path, cpus, busy_ms):
+    '''Loop of a worker process: one job message in, one result message out'''
+    # Ctrl-C reaches the whole process group, the main process stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    import cv2
+    # one worker per core, OpenCV does not need threads of its own
+    cv2.setNumThreads(1)
+    frame_slots = FrameSlots(slots, slot_size, image_size, name=slots_name)
+    pilot = None
+    if model_path != '':
+        try:
+            from keras_pilot import load_pilot
+            pilot = load_pilot(model_path)
+        except Exception as e:
+            print(f"Worker {index}: could not load the model: {e}")
+            conn.close()
+            return
+    where = f" on CPUs {sorted(cpus)}" if cpus else ""
+    print(f"Worker {index} (pid {os.getpid()}){where} ready")
+    job = bytearray(JOB.size)
+    while True:
+        try:
+            if conn.recv_bytes_into(job) == 0:
+                break
+        except (EOFError, OSError):
+            break
+        slot, kind, length, height, width, channels, want_image = JOB.unpack(job)
+        start = time.perf_counter()
+        data = frame_slots.input(slot, length)
+        if kind == KIND_BGR:
+            image = data.reshape((height, width, channels))
+        else:
+            image = cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+        decoded = time.perf_counter()
+        command = None
+        if image is not None:
+            if pilot is not None:
+                command = pilot.run(image)
+            elif busy_ms:
+                command = busy_loop(busy_ms)
+        inferred = time.perf_counter()
+        shape = (0, 0, 0)
+        result_image = IMAGE_NONE
+        if image is not None and want_image:
+            if kind == KIND_BGR:
+                result_image, shape = IMAGE_INPUT, image.shape
+            elif image.ndim == 3 and image.nbytes <= image_size:
+                frame_slots.image(slot, image.shape)[...] = image
+                result_image, shape = IMAGE_DECODED, image.shape
+        steering, throttle = command if command is not None else (0.0, 0.0)
+        conn.send_bytes(RESULT.pack(slot, command is not None, image is not None, result_image, *shape,
+                                    float(steering), float(throttle),
+                                    (decoded - start) * 1000, (inferred - decoded) * 1000))
+    frame_slots.release()
+    conn.close()
+
+
+class SlotFrame(object):
+    '''
+    Decoded image of a frame, in its shared memory slot. The slot is used
+    for new frames after the last release(), like frame_pool.PooledFrame
+    '''
+
+    __slots__ = ('array', 'pool', 'slot', 'refs', 'lock')
+
+    def __init__(self, array, pool, slot):
+        self.array = array
+        self.pool = pool
+        self.slot = slot
+        self.refs = 1
+        self.lock = Lock()
+
+    def retain(self):
+        with self.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            last = self.refs == 0
+        if last:
+            self.pool.free_slot(self.slot)
+
+
+class Job(object):
+
+    __slots__ = ('frame', 'want_image', 'future', 'worker', 'submitted_at')
+
+    def __init__(self, frame, want_image, future):
+        self.frame = frame
+        self.want_image = want_image
+        self.future = future
+        self.worker = None
+        self.submitted_at = time.perf_counter()
+
+
+class WorkerPool(Thread):
+    """Worker processes decoding the frames and computing their commands
+
+    submit() returns a concurrent.futures.Future of (command, frame, decoded,
+    decode_ms): command is the (steering, throttle) of the model, or None
+    without a model, and frame a SlotFrame of the decoded image if want_image
+    was set (None otherwise, or if the frame could not be decoded), to be
+    released by the caller. decoded is False if the frame could not be
+    decoded, decode_ms the time the worker took to decode it. The frame
+    passed to submit is copied into a slot when one is free, it must stay
+    valid until then. This thread collects the results of the workers.
+    affinity is a list of CPUs (see parse_affinity), worker i is pinned to
+    the i-th one, cycling over the list.
+    """
+
+    def __init__(self, model_path='', workers=2, affinity=None, slots_per_worker=2,
+                 slot_size=SLOT_SIZE, image_size=IMAGE_SIZE, busy_ms=0.0):
+        Thread.__init__(self, daemon=True)
+        self.lock = Lock()
+        self.slots = FrameSlots(workers * slots_per_worker, slot_size, image_size)
+        self.free_slots = list(range(self.slots.slots))
+        self.in_flight = {}
+        self.waiting = deque()
+        self.running = True
+        self.frames = [0] * workers
+        self.decode_ms = [0.0] * workers
+        self.infer_ms = [0.0] * workers
+        self.busy = [0] * workers
+        self.frames_waited = 0
+        self.max_waiting = 0
+        self.started_at = time.time()
+        # spawn: a fork would copy the threads and sockets of the server
+        context = multiprocessing.get_context('spawn')
+        self.connections = []
+        self.processes = []
+        for i in range(workers):
+            conn, worker_conn = context.Pipe()
+            cpus = {affinity[i % len(affinity)]} if affinity else None
+            process = context.Process(target=worker_main, name=f"worker-{i}", daemon=True,
+                                      args=(i, self.slots.name, self.slots.slots, slot_size, image_size,
+                                            worker_conn, model_path, cpus, busy_ms))
+            process.start()
+            worker_conn.close()
+            self.connections.append(conn)
+            self.processes.append(process)
+        self.alive = set(range(workers))
+
+    def submit(self, frame, want_image=False):
+        future = Future()
+        with self.lock:
+            if not self.running or not self.alive:
+                future.cancel()
+                return future
+            job = Job(frame, want_image, future)
+            if self.free_slots:
+                self._dispatch(job, self.free_slots.pop())
+            else:
+                self.waiting.append(job)
+                self.frames_waited += 1
+                self.max_waiting = max(self.max_waiting, len(self.waiting))
+        return future
+
+    def _dispatch(self, job, slot):
+        '''Copy the frame into slot and send it to the least busy worker, with the lock held'''
+        frame = job.frame
+        job.frame = None
+        if isinstance(frame, np.ndarray) and frame.ndim == 3:
+            kind = KIND_BGR
+            height, width, channels = frame.shape
+            length = frame.nbytes
+        else:
+            kind = KIND_JPEG
+            frame = np.frombuffer(frame, dtype=np.uint8)
+            height = width = channels = 0
+            length = len(frame)
+        if length > self.slots.slot_size:
+            self.free_slots.append(slot)
+            job.future.set_exception(ValueError(f"frame of {length} bytes does not fit in a slot "
+                                                f"of {self.slots.slot_size}"))
+            return
+        if kind == KIND_BGR:
+            self.slots.input(slot, length).reshape(frame.shape)[...] = frame
+        else:
+            self.slots.input(slot, length)[...] = frame
+        worker = min(self.alive, key=lambda i: self.busy[i])
+        job.worker = worker
+        self.busy[worker] += 1
+        self.in_flight[slot] = job
+        self.connections[worker].send_bytes(JOB.pack(slot, kind, length, height, width, channels,
+                                                     job.want_image))
+
+    def free_slot(self, slot):
+        with self.lock:
+            if self.waiting and self.running and self.alive:
+                self._dispatch(self.waiting.popleft(), slot)
+            else:
+                self.free_slots.append(slot)
+
+    def run(self):
+        result = bytearray(RESULT.size)
+        while self.alive:
+            connections = {self.connections[i]: i for i in self.alive}
+            for conn in wait(list(connections)):
+                worker = connections[conn]
+                try:
+                    conn.recv_bytes_into(result)
+                except (EOFError, OSError):
+                    self._worker_exited(worker)
+                    continue
+                self._complete(worker, RESULT.unpack(result))
+        with self.lock:
+            while self.waiting:
+                self.waiting.popleft().future.cancel()
+
+    def _complete(self, worker, result):
+        slot, has_command, decoded, image, height, width, channels, steering, throttle, decode_ms, infer_ms = result
+        with self.lock:
+            job = self.in_flight.pop(slot)
+            self.busy[worker] -= 1
+            self.frames[worker] += 1
+            self.decode_ms[worker] += decode_ms
+            self.infer_ms[worker] += infer_ms
+        frame = None
+        if image == IMAGE_INPUT:
+            frame = SlotFrame(self.slots.input(slot, height * width * channels).reshape((height, width, channels)),
+                              self, slot)
+        elif image == IMAGE_DECODED:
+            frame = SlotFrame(self.slots.image(slot, (height, width, channels)), self, slot)
+        else:
+            self.free_slot(slot)
+        job.future.set_result(((steering, throttle) if has_command else None, frame, bool(decoded), decode_ms))
+
+    def _worker_exited(self, worker):
+        with self.lock:
+            self.alive.discard(worker)
+            slots = [slot for slot, job in self.in_flight.items() if job.worker == worker]
+            failed = [self.in_flight.pop(slot) for slot in slots]
+            if not self.alive:
+                failed.extend(self.waiting)
+                self.waiting.clear()
+        if self.running:
+            print(f"Worker {worker} exited, {len(self.alive)} left")
+        # the frames waiting go to the workers left
+        for slot in slots:
+            self.free_slot(slot)
+        for job in failed:
+            job.future.set_exception(RuntimeError(f"worker {worker} exited"))
+
+    def stop(self):
+        '''Stop the workers and wait for them, the frames still waiting are cancelled'''
+        with self.lock:
+            self.running = False
+            for conn in self.connections:
+                try:
+                    conn.send_bytes(b'')
+                except OSError:
+                    pass
+        # this thread collects the last results until every worker has exited
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join(timeout=1)
+        if self.is_alive():
+            self.join(timeout=5)
+        for conn in self.connections:
+            conn.close()
+        self.slots.release()
+
+    def stats(self):
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        with self.lock:
+            frames = sum(self.frames)
+            return {'workers': len(self.processes),
+                    'alive': len(self.alive),
+                    'frames': frames,
+                    'fps': frames / elapsed,
+                    'frames_per_worker': list(self.frames),
+                    'decode_ms': sum(self.decode_ms) / frames if frames else 0.0,
+                    'infer_ms': sum(self.infer_ms) / frames if frames else 0.0,
+                    'frames_waited': self.frames_waited,
+                    'max_waiting': self.max_waiting}
+
+    def summary(self):
+        s = self.stats()
+        per_worker = ' '.join(str(n) for n in s['frames_per_worker'])
+        return (f"workers: {s['alive']}/{s['workers']} processes, {s['frames']} frames ({per_worker}), "
+                f"decode {s['decode_ms']:.2f} ms infer {s['infer_ms']:.2f} ms per frame, "
+                f"{s['frames_waited']} frames waited for a slot (at most {s['max_waiting']})")